@@ -1,7 +1,12 @@
-from sqlmodel import Session, select, delete
+from sqlmodel import Session, select
 from database import engine
-from models import User, Role, UserRolePermission, Permission
+from models import User, Role, Permission
 from auth import get_password_hash
+from assignments import announce_grant_changes, apply_assignments
+from invalidation import invalidation_bus
+
+# Every commit also publishes an invalidation event so a running API picks the
+# change up without a restart
 
 with Session(engine) as session:
     # Check if user already exists
@@ -15,6 +20,8 @@ with Session(engine) as session:
             status='Active'
         )
         session.add(user)
+        session.flush()
+        invalidation_bus.publish(session, tables=[User.__tablename__], users=[user.id])
         session.commit()
         session.refresh(user)
         print("User created.")
@@ -26,19 +33,11 @@ with Session(engine) as session:
     if not role:
         print("Admin role not found. Please initialize roles first.")
     else:
-        # Get all permissions for Admin
-        perm_objs = session.exec(select(Permission)).all()
-        for perm in perm_objs:
-            urp = session.exec(
-                select(UserRolePermission).where(
-                    (UserRolePermission.user_id == user.id) &
-                    (UserRolePermission.role_id == role.id) &
-                    (UserRolePermission.permission_id == perm.id)
-                )
-            ).first()
-            if not urp:
-                urp = UserRolePermission(user_id=user.id, role_id=role.id, permission_id=perm.id)
-                session.add(urp)
+        # Admin membership plus overrides for permissions outside the Admin template
+        perm_ids = set(session.exec(select(Permission.id)).all())
+        changes = apply_assignments(session, {(user.id, role.id): perm_ids})
+        if changes:
+            announce_grant_changes(session, [user.id])
         session.commit()
         print("Admin role and all permissions assigned.")
 
@@ -78,6 +77,8 @@ with Session(engine) as session:
                 status='Active'
             )
             session.add(user)
+            session.flush()
+            invalidation_bus.publish(session, tables=[User.__tablename__], users=[user.id])
             session.commit()
             session.refresh(user)
             print(f"User {u['username']} created.")
@@ -88,12 +89,10 @@ with Session(engine) as session:
         if not role:
             print(f"Role {u['role']} not found. Please initialize roles first.")
             continue
-        perm_objs = session.exec(select(Permission)).all()
-        # Remove any existing role-permission assignments for this user/role
-        session.exec(delete(UserRolePermission).where((UserRolePermission.user_id == user.id) & (UserRolePermission.role_id == role.id)))
-        # Assign all permissions for this role
-        for perm in perm_objs:
-            urp = UserRolePermission(user_id=user.id, role_id=role.id, permission_id=perm.id)
-            session.add(urp)
+        # Replace this user/role's grants with all permissions
+        perm_ids = set(session.exec(select(Permission.id)).all())
+        changes = apply_assignments(session, {(user.id, role.id): perm_ids})
+        if changes:
+            announce_grant_changes(session, [user.id])
         session.commit()
         print(f"Role {u['role']} and permissions assigned to {u['username']}.") 
\ No newline at end of file
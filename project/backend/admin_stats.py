@@ -0,0 +1,119 @@
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterable, Tuple
+
+from sqlalchemy import case, update
+from sqlmodel import Session, select, func
+
+from models import AdminMetrics, Role, User, UserRole
+
+ADMIN_ROLES = ["Admin", "Sub-Admin", "Analyst"]
+CHUNK = 500
+
+# (admin, active, sub_admin, analyst) flags, the most one user adds to the counters
+Contribution = Tuple[int, int, int, int]
+
+
+# One row per user holding an admin role
+def _per_user():
+    return (
+        select(
+            UserRole.user_id,
+            func.max(case((User.status == "Active", 1), else_=0)).label("active"),
+            func.max(case((Role.name == "Sub-Admin", 1), else_=0)).label("sub_admin"),
+            func.max(case((Role.name == "Analyst", 1), else_=0)).label("analyst"),
+        )
+        .join(Role, Role.id == UserRole.role_id)
+        .join(User, User.id == UserRole.user_id)
+        .where(Role.name.in_(ADMIN_ROLES))
+        .group_by(UserRole.user_id)
+    )
+
+
+# One pass over the admin grants: collapse to one row per user, then count
+def compute_admin_metrics(session: Session) -> dict:
+    per_user = _per_user().subquery()
+    total, active, sub_admins, analysts = session.execute(
+        select(
+            func.count(),
+            func.coalesce(func.sum(per_user.c.active), 0),
+            func.coalesce(func.sum(per_user.c.sub_admin), 0),
+            func.coalesce(func.sum(per_user.c.analyst), 0),
+        ).select_from(per_user)
+    ).one()
+    return {"totalAdmins": total, "activeAdmins": active, "subAdmins": sub_admins, "analysts": analysts}
+
+
+# Full recompute inside the caller's transaction, for startup, reconcile and the
+# nightly rollups job; the write paths apply deltas instead. The caller commits.
+def refresh_admin_metrics(session: Session) -> AdminMetrics:
+    metrics = compute_admin_metrics(session)
+    row = session.get(AdminMetrics, 1) or AdminMetrics(id=1)
+    row.total_admins = metrics["totalAdmins"]
+    row.active_admins = metrics["activeAdmins"]
+    row.sub_admins = metrics["subAdmins"]
+    row.analysts = metrics["analysts"]
+    row.updated_at = datetime.utcnow()
+    session.add(row)
+    return row
+
+
+# What the given users currently add to the counters; users without an admin
+# role are left out
+def admin_contributions(session: Session, user_ids: Iterable[int]) -> Dict[int, Contribution]:
+    user_ids = sorted(set(user_ids))
+    result: Dict[int, Contribution] = {}
+    for i in range(0, len(user_ids), CHUNK):
+        for user_id, active, sub_admin, analyst in session.execute(
+            _per_user().where(UserRole.user_id.in_(user_ids[i:i + CHUNK]))
+        ):
+            result[user_id] = (1, active, sub_admin, analyst)
+    return result
+
+
+# Adds the difference between two contribution snapshots in one UPDATE, so
+# concurrent writers do not overwrite each other's counts. Without a stored row
+# there is nothing to adjust; read_admin_metrics computes it in full.
+def apply_admin_delta(session: Session, before: Dict[int, Contribution], after: Dict[int, Contribution]):
+    totals = [0, 0, 0, 0]
+    for sign, contribs in ((-1, before), (1, after)):
+        for flags in contribs.values():
+            for i, flag in enumerate(flags):
+                totals[i] += sign * flag
+    if not any(totals):
+        return
+    total, active, sub_admins, analysts = totals
+    session.execute(update(AdminMetrics).where(AdminMetrics.id == 1).values(
+        total_admins=AdminMetrics.total_admins + total,
+        active_admins=AdminMetrics.active_admins + active,
+        sub_admins=AdminMetrics.sub_admins + sub_admins,
+        analysts=AdminMetrics.analysts + analysts,
+        updated_at=datetime.utcnow(),
+    ))
+
+
+# For users created in this transaction, who added nothing before
+def count_new_admins(session: Session, user_ids: Iterable[int]):
+    apply_admin_delta(session, {}, admin_contributions(session, user_ids))
+
+
+# Wrap writes to users' memberships or status; only those users are read, before
+# and after, and the counters move by the difference in the same transaction
+@contextmanager
+def track_admins(session: Session, user_ids: Iterable[int]):
+    user_ids = set(user_ids)
+    if not user_ids:
+        yield
+        return
+    before = admin_contributions(session, user_ids)
+    yield
+    session.flush()
+    apply_admin_delta(session, before, admin_contributions(session, user_ids))
+
+
+def read_admin_metrics(session: Session) -> dict:
+    row = session.get(AdminMetrics, 1)
+    if row is None:
+        row = refresh_admin_metrics(session)
+        session.commit()
+    return {"totalAdmins": row.total_admins, "activeAdmins": row.active_admins, "subAdmins": row.sub_admins, "analysts": row.analysts}
@@ -0,0 +1,273 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import Integer, bindparam, case, cast, delete, func, or_
+from sqlmodel import Session, select
+
+from models import UserAnalytics, UsageReading, DetectedAlert, DashboardRollup, UsageRollup, JobWatermark
+from analytics import fetch_array, month_key, key_period, MONTH_BITS
+from generate_data import insert_sql
+from invalidation import invalidation_bus
+from rollups import track_consumers
+
+# Batch usage-anomaly detection. Every consumer's monthly usage is divided by
+# its segment's seasonal factor (from the usage rollups), then each month is
+# compared with the consumer's previous WINDOW months:
+#   spike  z-score above Z          drop  z-score below -Z
+#   zero   no usage on a meter that averaged at least ZERO_FLOOR kWh
+# The standard deviation is floored at MIN_REL_STD of the mean so very steady
+# meters do not alert on small wobbles. Consumers are scored in chunks across a
+# process pool; workers return only the cells whose result changes and the
+# parent writes them to DetectedAlert (ingested AlertRecord counts are never
+# touched), which the consumer history, dashboard rollups and export add to the
+# ingested alerts. Incremental runs rescore only consumers with readings added or
+# corrected since the last run: UsageReading ids or ingest revisions above the
+# stored watermarks.
+#   python alert_detection.py              # incremental, full on the first run
+#   python alert_detection.py --full --workers 8
+
+WINDOW = int(os.getenv("ALERT_WINDOW", "6"))
+Z_THRESHOLD = float(os.getenv("ALERT_Z", "3.0"))
+MIN_HISTORY = 3
+MIN_REL_STD = 0.1
+ZERO_FLOOR = 1.0
+CHUNK_SIZE = 20_000
+JOB = "alert_detection"
+REVISION_JOB = "alert_detection.revision"
+
+KINDS = np.array([None, "spike", "drop", "zero"], dtype=object)
+NONE, SPIKE, DROP, ZERO = 0, 1, 2, 3
+
+_period_key = cast(func.substr(UsageReading.period, 1, 4), Integer) * 12 + cast(func.substr(UsageReading.period, 6, 2), Integer) - 1
+_alert_key = cast(func.substr(DetectedAlert.period, 1, 4), Integer) * 12 + cast(func.substr(DetectedAlert.period, 6, 2), Integer) - 1
+_alert_code = case((DetectedAlert.kind == "spike", SPIKE), (DetectedAlert.kind == "drop", DROP), else_=ZERO)
+
+
+# (consumers x months) anomaly codes from usage, presence (bool) and the seasonal
+# factor of each cell
+def score(usage: np.ndarray, present: np.ndarray, factors: np.ndarray, window: int = WINDOW,
+          z: float = Z_THRESHOLD, min_history: int = MIN_HISTORY) -> np.ndarray:
+    n, months = usage.shape
+    adjusted = np.where(present, usage / factors, 0.0)
+    weight = present.astype(np.float64)
+    zero_col = np.zeros((n, 1))
+    sums = np.hstack([zero_col, np.cumsum(adjusted, axis=1)])
+    squares = np.hstack([zero_col, np.cumsum(adjusted ** 2, axis=1)])
+    counts = np.hstack([zero_col, np.cumsum(weight, axis=1)])
+    # Statistics of the `window` months before each month
+    t = np.arange(months)
+    lo = np.maximum(t - window, 0)
+    k = counts[:, t] - counts[:, lo]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (sums[:, t] - sums[:, lo]) / k
+        var = (squares[:, t] - squares[:, lo]) / k - mean ** 2
+        std = np.maximum(np.sqrt(np.clip(var, 0.0, None)), MIN_REL_STD * np.abs(mean))
+        zscore = (adjusted - mean) / std
+    scored = present & (k >= min_history) & (mean > 0)
+    codes = np.zeros((n, months), dtype=np.int8)
+    zero = scored & (usage <= 0) & (mean >= ZERO_FLOOR)
+    codes[zero] = ZERO
+    codes[scored & ~zero & (zscore > z)] = SPIKE
+    codes[scored & ~zero & (zscore < -z)] = DROP
+    return codes
+
+
+# Seasonal factor per segment and month: the segment's mean usage per reading
+# that month over its mean across all months. 1 where the rollups have no data.
+def segment_factors(session: Session) -> Tuple[List[str], int, np.ndarray]:
+    rows = session.execute(
+        select(UsageRollup.segment, UsageRollup.period, func.sum(UsageRollup.usage_total), func.sum(UsageRollup.readings))
+        .group_by(UsageRollup.segment, UsageRollup.period)
+    ).all()
+    segments = sorted({r[0] for r in rows})
+    if not rows:
+        return segments, 0, np.ones((0, 0))
+    keys = [month_key(r[1]) for r in rows]
+    first_key = min(keys)
+    means = np.full((len(segments), max(keys) - first_key + 1), np.nan)
+    for (segment, _, total, readings), key in zip(rows, keys):
+        if readings:
+            means[segments.index(segment), key - first_key] = total / readings
+    with np.errstate(invalid="ignore"):
+        factors = means / np.nanmean(means, axis=1, keepdims=True)
+    return segments, first_key, np.where(np.isfinite(factors) & (factors > 0), factors, 1.0)
+
+
+def _worker_init():
+    # Forked workers must not reuse the parent's pooled connections
+    from database import engine
+    engine.dispose(close=False)
+
+
+# Scores consumers numbered lo..hi (optionally only those in `only`) and returns
+# the (consumer, period, kind) cells that differ from DetectedAlert; kind None
+# means a stored detection no longer holds
+def score_range(lo: int, hi: int, only: Optional[Sequence[int]], segments: List[str], factor_key: int,
+                factors: np.ndarray, window: int, z: float) -> dict:
+    from database import engine
+    with Session(engine) as session:
+        consumers = session.execute(
+            select(UserAnalytics.number, UserAnalytics.segment)
+            .where(UserAnalytics.number >= lo, UserAnalytics.number <= hi).order_by(UserAnalytics.number)
+        ).all()
+        readings = fetch_array(session, select(UsageReading.consumer_number * MONTH_BITS + _period_key, UsageReading.usage)
+                               .where(UsageReading.consumer_number >= lo, UsageReading.consumer_number <= hi), 2)
+        stored = fetch_array(session, select(DetectedAlert.consumer_number * MONTH_BITS + _alert_key, _alert_code)
+                             .where(DetectedAlert.consumer_number >= lo, DetectedAlert.consumer_number <= hi), 2)
+    if only is not None:
+        only = set(only)
+        consumers = [c for c in consumers if c[0] in only]
+    numbers = np.array([c[0] for c in consumers], dtype=np.int64)
+    stats = {"consumers": len(numbers), "readings": 0, "flagged": {"spike": 0, "drop": 0, "zero": 0}, "rows": []}
+    if not len(numbers) or not len(readings):
+        return stats
+
+    packed = readings[:, 0].astype(np.int64)
+    owners, keys = packed // MONTH_BITS, packed % MONTH_BITS
+    rows = np.searchsorted(numbers, owners).clip(max=len(numbers) - 1)
+    known = numbers[rows] == owners
+    rows, keys, values = rows[known], keys[known], readings[known, 1]
+    if not len(keys):
+        return stats
+    first_key = int(keys.min())
+    months = int(keys.max()) - first_key + 1
+    usage = np.zeros((len(numbers), months))
+    present = np.zeros((len(numbers), months), dtype=bool)
+    usage[rows, keys - first_key] = values
+    present[rows, keys - first_key] = True
+
+    # Seasonal factor for every cell: segment row, month column (1 outside the rollup range)
+    segment_index = np.array([segments.index(c[1]) if c[1] in segments else len(segments) for c in consumers])
+    table = np.ones((len(segments) + 1, months))
+    if factors.size:
+        cols = np.arange(months) + first_key - factor_key
+        inside = (cols >= 0) & (cols < factors.shape[1])
+        table[:len(segments), inside] = factors[:, cols[inside]]
+    codes = score(usage, present, table[segment_index], window, z)
+
+    # What is stored now, as the same code matrix
+    current = np.zeros((len(numbers), months), dtype=np.int8)
+    if len(stored):
+        packed = stored[:, 0].astype(np.int64)
+        owners, keys = packed // MONTH_BITS, packed % MONTH_BITS
+        rows = np.searchsorted(numbers, owners).clip(max=len(numbers) - 1)
+        cols = keys - first_key
+        keep = (numbers[rows] == owners) & (cols >= 0) & (cols < months)
+        current[rows[keep], cols[keep]] = stored[keep, 1]
+    changed = current != codes
+    r, c = np.nonzero(changed)
+    flagged = codes[r, c]
+    stats["readings"] = int(present.sum())
+    for code, name in ((SPIKE, "spike"), (DROP, "drop"), (ZERO, "zero")):
+        stats["flagged"][name] = int((codes == code).sum())
+    stats["rows"] = list(zip(
+        numbers[r].tolist(),
+        [key_period(first_key + col) for col in c.tolist()],
+        KINDS[flagged].tolist(),
+    ))
+    return stats
+
+
+def _chunks(numbers: List[int], size: int):
+    for i in range(0, len(numbers), size):
+        yield numbers[i:i + size]
+
+
+# A consumer's first detection or last cleared one changes its alert case in
+# the dashboard rollups, so those are adjusted in the same transaction
+def _write(session: Session, rows: List[Tuple]):
+    flagged = [r for r in rows if r[2] is not None]
+    cleared = [{"number": r[0], "period": r[1]} for r in rows if r[2] is None]
+    with track_consumers(session, {r[0] for r in rows}):
+        if flagged:
+            sql = insert_sql(session.get_bind(), DetectedAlert, ["consumer_number", "period", "kind"]) + \
+                " ON CONFLICT (consumer_number, period) DO UPDATE SET kind = excluded.kind"
+            session.connection().exec_driver_sql(sql, flagged)
+        if cleared:
+            table = DetectedAlert.__table__
+            session.connection().execute(
+                delete(table).where(table.c.consumer_number == bindparam("number"), table.c.period == bindparam("period")), cleared
+            )
+    invalidation_bus.publish(session, tables=[DetectedAlert.__tablename__, DashboardRollup.__tablename__])
+    session.commit()
+
+
+def detect(engine, full: bool = False, workers: Optional[int] = None, chunk_size: int = CHUNK_SIZE,
+           window: int = WINDOW, z: float = Z_THRESHOLD, dry_run: bool = False) -> dict:
+    started = time.perf_counter()
+    with Session(engine) as session:
+        state = session.get(JobWatermark, JOB)
+        revision_state = session.get(JobWatermark, REVISION_JOB)
+        newest = session.exec(select(func.max(UsageReading.id))).one() or 0
+        revision = session.exec(select(func.max(UsageReading.revision))).one() or 0
+        if full or state is None or revision_state is None:
+            mode = "full"
+            numbers = session.exec(select(UserAnalytics.number).order_by(UserAnalytics.number)).all()
+        else:
+            mode = "incremental"
+            numbers = session.exec(
+                select(UsageReading.consumer_number)
+                .where(or_(UsageReading.id > state.value, UsageReading.revision > revision_state.value))
+                .distinct().order_by(UsageReading.consumer_number)
+            ).all()
+        segments, factor_key, factors = segment_factors(session)
+
+    report = {"mode": mode, "consumers": 0, "readings": 0, "flagged": {"spike": 0, "drop": 0, "zero": 0}, "rows_written": 0}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_worker_init) as pool:
+        futures = [
+            pool.submit(score_range, chunk[0], chunk[-1], None if mode == "full" else chunk,
+                        segments, factor_key, factors, window, z)
+            for chunk in _chunks(list(numbers), chunk_size)
+        ]
+        with Session(engine) as session:
+            for future in as_completed(futures):
+                result = future.result()
+                report["consumers"] += result["consumers"]
+                report["readings"] += result["readings"]
+                for name, count in result["flagged"].items():
+                    report["flagged"][name] += count
+                report["rows_written"] += len(result["rows"])
+                if result["rows"] and not dry_run:
+                    _write(session, result["rows"])
+    scored = time.perf_counter()
+
+    if not dry_run:
+        with Session(engine) as session:
+            for job, value in ((JOB, newest), (REVISION_JOB, revision)):
+                state = session.get(JobWatermark, job) or JobWatermark(job=job)
+                state.value = value
+                state.updated_at = datetime.utcnow()
+                session.add(state)
+            session.commit()
+    finished = time.perf_counter()
+    report["watermark"] = newest
+    report["revision"] = revision
+    report["score_seconds"] = round(scored - started, 2)
+    report["seconds"] = round(finished - started, 2)
+    report["readings_per_sec"] = round(report["readings"] / (scored - started)) if scored > started else None
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flag usage spikes, drops and zero-usage meters; flagged months show in the consumer alert history.")
+    parser.add_argument("--full", action="store_true", help="rescore every consumer, not just those with new or corrected readings")
+    parser.add_argument("--workers", type=int, help="worker processes (default: all cores)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="consumers per task")
+    parser.add_argument("--window", type=int, default=WINDOW, help="months of history per baseline")
+    parser.add_argument("--z", type=float, default=Z_THRESHOLD, help="z-score threshold for spikes and drops")
+    parser.add_argument("--dry-run", action="store_true", help="score and report without writing")
+    args = parser.parse_args(argv)
+
+    from database import engine
+    report = detect(engine, args.full, args.workers, args.chunk_size, args.window, args.z, args.dry_run)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
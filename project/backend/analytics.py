@@ -0,0 +1,358 @@
+import itertools
+import os
+import time
+from collections import OrderedDict
+from threading import Lock, Thread
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import Integer, cast, func
+from sqlmodel import Session, select
+
+from models import UserAnalytics, UsageReading
+from cache import table_versions
+
+# Usage analytics over an in-memory consumers x months matrix. Readings are
+# loaded once per data version into a dense NumPy array (0 where a month has no
+# reading, plus a 0/1 presence matrix). Rows are ordered by (region, segment,
+# phase) combination, so each combination is a contiguous block: its monthly
+# totals are precomputed with one reduceat, trends only add up a few of those,
+# and quantiles run over concatenated slices. Nothing here touches the database
+# after the load. 500k consumers x 24 months hold about 110 MB.
+
+# Seconds before a cube is rebuilt even if the data version looks unchanged, for
+# in-place updates made by other processes; 0 disables
+ANALYTICS_MAX_AGE = int(os.getenv("ANALYTICS_MAX_AGE", "0"))
+ANALYTICS_MAX_RESULTS = int(os.getenv("ANALYTICS_MAX_RESULTS", "256"))
+GROUP_COLUMNS = ("region", "segment", "phase")
+DEFAULT_QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+FETCH_SIZE = 200_000
+MONTH_BITS = 32768  # consumer and month packed into one integer while loading
+
+Combo = Tuple[str, str, str]
+
+
+class AnalyticsError(Exception):
+    pass
+
+
+def month_key(period: str) -> int:
+    try:
+        return int(period[:4]) * 12 + int(period[5:7]) - 1
+    except (TypeError, ValueError):
+        raise AnalyticsError(f"Invalid period {period!r}, expected YYYY-MM")
+
+
+def key_period(key: int) -> str:
+    return f"{key // 12}-{key % 12 + 1:02d}"
+
+
+# Executed through the connection so engine events (statement counts, metrics)
+# see it, then read straight off the DBAPI cursor into a flat array: millions of
+# rows through Row objects would cost several times the scan itself
+def fetch_array(session: Session, query, columns: int) -> np.ndarray:
+    result = session.connection().execute(query)
+    cursor = result.cursor
+    chunks = []
+    try:
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            chunks.append(np.fromiter(itertools.chain.from_iterable(rows), np.float64, count=columns * len(rows)))
+    finally:
+        result.close()
+    return np.concatenate(chunks).reshape(-1, columns) if chunks else np.empty((0, columns))
+
+
+class UsageCube:
+    def __init__(self, numbers: np.ndarray, combos: List[Combo], bounds: np.ndarray,
+                 first_key: int, usage: np.ndarray, present: np.ndarray):
+        self.numbers = numbers
+        self.combos = combos
+        self.bounds = bounds
+        self.first_key = first_key
+        self.usage = usage
+        self.present = present
+        if len(numbers) and usage.shape[1]:
+            self.combo_totals = np.add.reduceat(usage, bounds[:-1], axis=0)
+            self.combo_readings = np.add.reduceat(present, bounds[:-1], axis=0, dtype=np.int64)
+        else:
+            self.combo_totals = np.zeros((len(combos), usage.shape[1]))
+            self.combo_readings = np.zeros((len(combos), usage.shape[1]), dtype=np.int64)
+        self.combo_sizes = np.diff(bounds)
+
+    @property
+    def months(self) -> int:
+        return self.usage.shape[1]
+
+    @property
+    def periods(self) -> List[str]:
+        return [key_period(self.first_key + i) for i in range(self.months)]
+
+    def column(self, period: Optional[str]) -> int:
+        if period is None:
+            if not self.months:
+                raise AnalyticsError("No readings loaded")
+            return self.months - 1
+        index = month_key(period) - self.first_key
+        if not 0 <= index < self.months:
+            raise AnalyticsError(f"No readings for period {period}")
+        return index
+
+    def columns(self, period_from: Optional[str], period_to: Optional[str]) -> slice:
+        lo = 0 if period_from is None else min(max(month_key(period_from) - self.first_key, 0), self.months)
+        hi = self.months if period_to is None else min(max(month_key(period_to) - self.first_key + 1, 0), self.months)
+        return slice(lo, max(lo, hi))
+
+    # {group key: [combo indexes]} for the combos matching filters, keys sorted
+    def groups(self, group_by: Optional[str], filters: Optional[Dict[str, Optional[str]]]) -> Dict[str, List[int]]:
+        if group_by is not None and group_by not in GROUP_COLUMNS:
+            raise AnalyticsError(f"group_by must be one of {', '.join(GROUP_COLUMNS)}")
+        wanted = [(GROUP_COLUMNS.index(c), v) for c, v in (filters or {}).items() if v is not None]
+        position = GROUP_COLUMNS.index(group_by) if group_by else None
+        groups: Dict[str, List[int]] = {}
+        for i, combo in enumerate(self.combos):
+            if all(combo[p] == v for p, v in wanted):
+                groups.setdefault(combo[position] if position is not None else "all", []).append(i)
+        return dict(sorted(groups.items()))
+
+    def rows(self, combos: List[int], values: np.ndarray) -> np.ndarray:
+        return np.concatenate([values[self.bounds[c]:self.bounds[c + 1]] for c in combos])
+
+
+def load_cube(session: Session) -> UsageCube:
+    consumers = session.execute(
+        select(UserAnalytics.number, UserAnalytics.region, UserAnalytics.segment, UserAnalytics.phase)
+    ).all()
+    combo_of = lambda c: (c[1] or "", c[2] or "", c[3] or "")
+    consumers.sort(key=lambda c: combo_of(c) + (c[0],))
+    numbers = np.array([c[0] for c in consumers], dtype=np.int64)
+    combos: List[Combo] = []
+    bounds = [0]
+    for combo, members in itertools.groupby(consumers, key=combo_of):
+        combos.append(combo)
+        bounds.append(bounds[-1] + sum(1 for _ in members))
+    bounds = np.array(bounds, dtype=np.int64)
+
+    key = cast(func.substr(UsageReading.period, 1, 4), Integer) * 12 + cast(func.substr(UsageReading.period, 6, 2), Integer) - 1
+    readings = fetch_array(session, select(UsageReading.consumer_number * MONTH_BITS + key, UsageReading.usage), 2)
+    if len(readings) == 0 or len(numbers) == 0:
+        empty = np.zeros((len(numbers), 0))
+        return UsageCube(numbers, combos, bounds, 0, empty, empty.astype(np.uint8))
+    packed = readings[:, 0].astype(np.int64)
+    owners, keys = packed // MONTH_BITS, packed % MONTH_BITS
+    first_key = int(keys.min())
+    by_number = np.argsort(numbers)
+    rows = by_number[np.searchsorted(numbers, owners, sorter=by_number).clip(max=len(numbers) - 1)]
+    known = numbers[rows] == owners
+    rows, cols = rows[known], keys[known] - first_key
+    usage = np.zeros((len(numbers), int(keys.max()) - first_key + 1))
+    present = np.zeros(usage.shape, dtype=np.uint8)
+    usage[rows, cols] = readings[known, 1]
+    present[rows, cols] = 1
+    return UsageCube(numbers, combos, bounds, first_key, usage, present)
+
+
+def _ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denominator != 0, numerator / denominator, np.nan)
+
+
+def _rounded(values: np.ndarray, digits: int = 4) -> list:
+    # NaN (no data) serializes as null
+    return np.round(values, digits).tolist()
+
+
+def _quantiles(sample: np.ndarray, quantiles: Sequence[float], digits: int) -> dict:
+    if any(not 0 <= q <= 1 for q in quantiles):
+        raise AnalyticsError("quantiles must be between 0 and 1")
+    if not sample.size:
+        return {str(q): None for q in quantiles}
+    return dict(zip((str(q) for q in quantiles), _rounded(np.quantile(sample, quantiles), digits)))
+
+
+# Per group and month: total usage, readings, mean per reading, and growth
+# against the previous month and the same month a year earlier
+def trends(cube: UsageCube, group_by: Optional[str] = None, filters: Optional[Dict[str, Optional[str]]] = None,
+           period_from: Optional[str] = None, period_to: Optional[str] = None) -> dict:
+    cols = cube.columns(period_from, period_to)
+    result = []
+    for key, combos in cube.groups(group_by, filters).items():
+        totals = cube.combo_totals[combos].sum(axis=0)
+        readings = cube.combo_readings[combos].sum(axis=0)
+        mom = np.full(totals.shape, np.nan)
+        mom[1:] = _ratio(totals[1:], totals[:-1]) - 1
+        yoy = np.full(totals.shape, np.nan)
+        yoy[12:] = _ratio(totals[12:], totals[:-12]) - 1
+        result.append({
+            "key": key,
+            "consumers": int(cube.combo_sizes[combos].sum()),
+            "total": _rounded(totals[cols], 1),
+            "readings": readings[cols].tolist(),
+            "mean": _rounded(_ratio(totals[cols], readings[cols]), 2),
+            "mom": _rounded(mom[cols]),
+            "yoy": _rounded(yoy[cols]),
+        })
+    return {"group_by": group_by, "periods": cube.periods[cols], "groups": result}
+
+
+# Usage quantiles across consumers for one month (the latest by default)
+def distribution(cube: UsageCube, group_by: Optional[str] = None, filters: Optional[Dict[str, Optional[str]]] = None,
+                 period: Optional[str] = None, quantiles: Sequence[float] = DEFAULT_QUANTILES) -> dict:
+    col = cube.column(period)
+    values, present = cube.usage[:, col], cube.present[:, col]
+    result = []
+    for key, combos in cube.groups(group_by, filters).items():
+        sample = cube.rows(combos, values)[cube.rows(combos, present) == 1]
+        result.append({
+            "key": key,
+            "consumers": int(sample.size),
+            "mean": round(float(sample.mean()), 2) if sample.size else None,
+            "quantiles": _quantiles(sample, quantiles, 2),
+        })
+    return {"group_by": group_by, "period": key_period(cube.first_key + col), "groups": result}
+
+
+# Growth between two months per group: change in total usage, plus quantiles of
+# the per-consumer growth rate over consumers with usage in both months
+def growth(cube: UsageCube, group_by: Optional[str] = None, filters: Optional[Dict[str, Optional[str]]] = None,
+           start: Optional[str] = None, end: Optional[str] = None,
+           quantiles: Sequence[float] = DEFAULT_QUANTILES) -> dict:
+    end_col = cube.column(end)
+    start_col = cube.column(start) if start is not None else max(end_col - 12, 0)
+    before, after = cube.usage[:, start_col], cube.usage[:, end_col]
+    comparable = (cube.present[:, start_col] == 1) & (cube.present[:, end_col] == 1) & (before > 0)
+    result = []
+    for key, combos in cube.groups(group_by, filters).items():
+        total_before = cube.combo_totals[combos, start_col].sum()
+        total_after = cube.combo_totals[combos, end_col].sum()
+        keep = cube.rows(combos, comparable)
+        base = cube.rows(combos, before)[keep]
+        sample = (cube.rows(combos, after)[keep] - base) / base
+        result.append({
+            "key": key,
+            "total_start": round(float(total_before), 1),
+            "total_end": round(float(total_after), 1),
+            "growth": round(float(total_after / total_before - 1), 4) if total_before else None,
+            "consumers": int(sample.size),
+            "consumer_growth": _quantiles(sample, quantiles, 4),
+        })
+    return {
+        "group_by": group_by,
+        "start": key_period(cube.first_key + start_col),
+        "end": key_period(cube.first_key + end_col),
+        "groups": result,
+    }
+
+
+# Cube and memoized results for one data version: the in-process table versions
+# bumped by the write endpoints plus the newest reading and consumer ids (one
+# cheap query, which also notices rows added by other processes). The first load
+# blocks; after that a changed version is rebuilt in a background thread while
+# the previous cube keeps answering.
+class AnalyticsCache:
+    def __init__(self, max_results: int = ANALYTICS_MAX_RESULTS, max_age: int = ANALYTICS_MAX_AGE):
+        self.max_results = max_results
+        self.max_age = max_age
+        self._lock = Lock()
+        self._build_lock = Lock()
+        self._cube: Optional[UsageCube] = None
+        self._version = None
+        self._loaded_at = 0.0
+        self._building = False
+        self._results: "OrderedDict[tuple, dict]" = OrderedDict()
+        self.builds = 0
+        self.hits = 0
+        self.misses = 0
+        self.build_seconds = 0.0
+
+    def data_version(self, session: Session) -> tuple:
+        newest = session.execute(select(
+            select(func.max(UsageReading.id)).scalar_subquery(),
+            select(func.max(UserAnalytics.id)).scalar_subquery(),
+        )).one()
+        return table_versions.snapshot([UserAnalytics.__tablename__, UsageReading.__tablename__]) + tuple(newest)
+
+    def _stale(self, version) -> bool:
+        return self._version != version or bool(self.max_age and time.monotonic() - self._loaded_at >= self.max_age)
+
+    def _load(self, session: Session, version):
+        started = time.perf_counter()
+        cube = load_cube(session)
+        with self._lock:
+            self._cube, self._version = cube, version
+            self._loaded_at = time.monotonic()
+            self._results.clear()
+            self.builds += 1
+            self.build_seconds = time.perf_counter() - started
+
+    def _rebuild(self, bind, version):
+        try:
+            with self._build_lock, Session(bind) as session:
+                self._load(session, version)
+        finally:
+            self._building = False
+
+    def cube(self, session: Session):
+        version = self.data_version(session)
+        if self._cube is None:
+            with self._build_lock:
+                if self._cube is None:
+                    self._load(session, version)
+        elif self._stale(version) and not self._building:
+            with self._lock:
+                start = not self._building
+                self._building = True
+            if start:
+                Thread(target=self._rebuild, args=(session.get_bind(), version), daemon=True).start()
+        return self._cube, self._version
+
+    # Brings the cube up to date in the calling thread; used by the warmup job so
+    # neither the first request nor a stale one pays for the build
+    def warm(self, session: Session) -> bool:
+        version = self.data_version(session)
+        if self._cube is not None and not self._stale(version):
+            return False
+        with self._build_lock:
+            if self._cube is None or self._stale(version):
+                self._load(session, version)
+        return True
+
+    def run(self, session: Session, fn, **params) -> dict:
+        cube, version = self.cube(session)
+        key = (version, fn.__name__, tuple(sorted((k, str(v)) for k, v in params.items())))
+        result = self._results.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = fn(cube, **params)
+        with self._lock:
+            if version == self._version:
+                self._results[key] = result
+                while len(self._results) > self.max_results:
+                    self._results.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self._build_lock, self._lock:
+            self._cube, self._version = None, None
+            self._results.clear()
+
+    def stats(self) -> dict:
+        cube = self._cube
+        return {
+            "consumers": len(cube.numbers) if cube is not None else 0,
+            "months": cube.months if cube is not None else 0,
+            "bytes": cube.usage.nbytes + cube.present.nbytes if cube is not None else 0,
+            "builds": self.builds,
+            "build_seconds": round(self.build_seconds, 3),
+            "building": self._building,
+            "results": len(self._results),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+analytics_cache = AnalyticsCache()
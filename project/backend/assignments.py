@@ -0,0 +1,159 @@
+from typing import Dict, Iterable, List, Set, Tuple
+
+from sqlalchemy import delete, insert
+from sqlmodel import Session, select
+
+from admin_stats import track_admins
+from models import User, RolePermission, UserRole, UserRolePermission
+
+CHUNK = 500
+
+Pair = Tuple[int, int]
+# (user_id, role_id) -> {permission_id -> [(row id, granted)]}
+Overrides = Dict[Pair, Dict[int, List[Tuple[int, bool]]]]
+
+
+def missing_users(session: Session, user_ids: Iterable[int]) -> List[int]:
+    user_ids = sorted(set(user_ids))
+    found = set()
+    for i in range(0, len(user_ids), CHUNK):
+        found.update(session.exec(select(User.id).where(User.id.in_(user_ids[i:i + CHUNK]))).all())
+    return [uid for uid in user_ids if uid not in found]
+
+
+def role_templates(session: Session, role_ids: Iterable[int] = None) -> Dict[int, Set[int]]:
+    query = select(RolePermission.role_id, RolePermission.permission_id)
+    if role_ids is not None:
+        query = query.where(RolePermission.role_id.in_(list(set(role_ids))))
+    templates: Dict[int, Set[int]] = {}
+    for role_id, permission_id in session.exec(query).all():
+        templates.setdefault(role_id, set()).add(permission_id)
+    return templates
+
+
+# Memberships and override rows for the requested pairs only
+def current_grants(session: Session, pairs: Iterable[Pair]) -> Tuple[Set[Pair], Overrides]:
+    pairs = set(pairs)
+    user_ids = sorted({uid for uid, _ in pairs})
+    role_ids = sorted({rid for _, rid in pairs})
+    members: Set[Pair] = set()
+    overrides: Overrides = {}
+    for i in range(0, len(user_ids), CHUNK):
+        chunk = user_ids[i:i + CHUNK]
+        for pair in session.exec(
+            select(UserRole.user_id, UserRole.role_id).where(UserRole.user_id.in_(chunk), UserRole.role_id.in_(role_ids))
+        ).all():
+            if tuple(pair) in pairs:
+                members.add(tuple(pair))
+        rows = session.exec(
+            select(UserRolePermission.id, UserRolePermission.user_id, UserRolePermission.role_id,
+                   UserRolePermission.permission_id, UserRolePermission.granted)
+            .where(UserRolePermission.user_id.in_(chunk), UserRolePermission.role_id.in_(role_ids))
+        ).all()
+        for row_id, user_id, role_id, permission_id, granted in rows:
+            if (user_id, role_id) in pairs:
+                overrides.setdefault((user_id, role_id), {}).setdefault(permission_id, []).append((row_id, bool(granted)))
+    return members, overrides
+
+
+def effective(template: Set[int], rows: Dict[int, List[Tuple[int, bool]]]) -> Set[int]:
+    granted = {pid for pid, entries in rows.items() if any(g for _, g in entries)}
+    revoked = {pid for pid, entries in rows.items() if not any(g for _, g in entries)}
+    return (template | granted) - revoked
+
+
+class GrantDelta:
+    def __init__(self):
+        self.stale_ids: List[int] = []
+        self.new_rows: List[dict] = []
+        self.stale_members: List[Pair] = []
+        self.new_members: List[Pair] = []
+        self.changes: List[dict] = []
+
+    @property
+    def empty(self) -> bool:
+        return not (self.stale_ids or self.new_rows or self.stale_members or self.new_members)
+
+
+# What makes every pair in desired hold exactly its permission ids: membership
+# plus override rows for the differences from the role template. An empty set
+# removes the membership. Duplicate and redundant override rows are dropped.
+def diff_grants(desired: Dict[Pair, Set[int]], templates: Dict[int, Set[int]],
+                members: Set[Pair], overrides: Overrides) -> GrantDelta:
+    delta = GrantDelta()
+    for (user_id, role_id), wanted in desired.items():
+        template = templates.get(role_id, set())
+        rows = overrides.get((user_id, role_id), {})
+        member = (user_id, role_id) in members
+        before = effective(template, rows) if member else set()
+        target: Dict[int, bool] = {}
+        if wanted:
+            target = {pid: True for pid in wanted - template}
+            target.update({pid: False for pid in template - wanted})
+            if not member:
+                delta.new_members.append((user_id, role_id))
+        elif member:
+            delta.stale_members.append((user_id, role_id))
+        for permission_id, entries in rows.items():
+            keep = target.pop(permission_id, None)
+            for row_id, granted in entries:
+                if keep is not None and granted == keep:
+                    keep = None  # the first matching row stays
+                else:
+                    delta.stale_ids.append(row_id)
+            if keep is not None:
+                target[permission_id] = keep
+        delta.new_rows.extend(
+            {"user_id": user_id, "role_id": role_id, "permission_id": pid, "granted": granted}
+            for pid, granted in sorted(target.items())
+        )
+        added = sorted(wanted - before)
+        removed = sorted(before - wanted)
+        if added or removed:
+            delta.changes.append({"user_id": user_id, "role_id": role_id, "added": added, "removed": removed})
+    return delta
+
+
+# Membership changes also move the admin counters, by the difference for the
+# users whose memberships changed
+def write_delta(session: Session, delta: GrantDelta, batch_size: int = CHUNK):
+    # Up to a full catalog of override rows per pair, so batched like the inserts
+    for i in range(0, len(delta.stale_ids), batch_size * 10):
+        session.execute(delete(UserRolePermission).where(UserRolePermission.id.in_(delta.stale_ids[i:i + batch_size * 10])))
+    by_role: Dict[int, List[int]] = {}
+    for user_id, role_id in delta.stale_members:
+        by_role.setdefault(role_id, []).append(user_id)
+    with track_admins(session, [uid for uid, _ in delta.stale_members + delta.new_members]):
+        for role_id, user_ids in by_role.items():
+            for i in range(0, len(user_ids), batch_size):
+                session.execute(delete(UserRole).where(UserRole.role_id == role_id, UserRole.user_id.in_(user_ids[i:i + batch_size])))
+        rows = [{"user_id": uid, "role_id": rid} for uid, rid in delta.new_members]
+        for i in range(0, len(rows), batch_size * 10):
+            session.execute(insert(UserRole), rows[i:i + batch_size * 10])
+    for i in range(0, len(delta.new_rows), batch_size * 10):
+        session.execute(insert(UserRolePermission), delta.new_rows[i:i + batch_size * 10])
+
+
+# Everything a grant write owes the rest of the system, in the caller's
+# transaction: revoke the changed users' tokens and publish the event running
+# workers patch their caches from (write_delta has already moved the admin
+# counters). The API and the maintenance scripts both go through here; the
+# caller commits.
+def announce_grant_changes(session: Session, user_ids: Iterable[int], role_ids: Iterable[int] = ()):
+    from invalidation import invalidation_bus
+    from tokens import token_versions
+    user_ids, role_ids = set(user_ids), set(role_ids)
+    if user_ids:
+        token_versions.bump_many(session, user_ids)
+    tables = [UserRole.__tablename__, UserRolePermission.__tablename__] + ([RolePermission.__tablename__] if role_ids else [])
+    invalidation_bus.publish(session, tables=tables, users=user_ids, roles=role_ids)
+
+
+# Makes each (user, role) pair hold exactly the given permission ids, with
+# chunked DELETEs and multi-row INSERTs in the caller's transaction. Returns only
+# the pairs whose effective permissions changed.
+def apply_assignments(session: Session, desired: Dict[Pair, Set[int]]) -> List[dict]:
+    members, overrides = current_grants(session, desired)
+    delta = diff_grants(desired, role_templates(session, [rid for _, rid in desired]), members, overrides)
+    write_delta(session, delta)
+    return delta.changes
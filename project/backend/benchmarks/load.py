@@ -0,0 +1,264 @@
+# Throughput / latency benchmark for the hot API paths. Seeds a throwaway
+# database, drives the app in-process (httpx ASGI transport) or over uvicorn,
+# and reports per-endpoint throughput, p50/p95/p99 latency and SQL statements
+# per request as JSON. Needs httpx (and uvicorn for --mode uvicorn). Run from
+# the backend directory:
+#   python -m benchmarks.load --users 20000 --out bench.json
+#   python -m benchmarks.load --users 20000 --baseline bench.json   # exits 1 on regression
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextvars import ContextVar
+from datetime import datetime
+
+BENCH_PASSWORD = "bench-password"
+ADMIN_USERNAME = "bench_admin"
+
+_statements: ContextVar = ContextVar("bench_statements", default=None)
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    counter = _statements.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def seed(engine, users: int, consumers: int, months: int, seed_value: int):
+    from sqlalchemy import insert
+    from sqlmodel import Session, SQLModel, select
+    import init_roles_permissions
+    from auth import get_password_hash
+    from generate_data import generate
+    from models import User, Role, Permission, UserRole
+    from admin_stats import refresh_admin_metrics
+
+    rng = random.Random(seed_value)
+    SQLModel.metadata.create_all(engine)
+    init_roles_permissions.main()
+    password_hash = get_password_hash(BENCH_PASSWORD)
+    generate(engine, users=users, consumers=consumers, months=months, seed=seed_value, password_hash=password_hash)
+    with Session(engine) as session:
+        session.execute(insert(User.__table__), [{
+            "username": ADMIN_USERNAME, "email": f"{ADMIN_USERNAME}@example.com",
+            "password_hash": password_hash, "created_at": datetime.utcnow(), "status": "Active",
+        }])
+        roles = {r.name: r.id for r in session.exec(select(Role)).all()}
+        perms = {p.view_name: p.id for p in session.exec(select(Permission)).all()}
+        user_ids = dict(session.execute(select(User.username, User.id)).all())
+        role_names = list(init_roles_permissions.role_permissions)
+        memberships = []
+        for username, user_id in user_ids.items():
+            # The admin holds every role so it may assign any of them
+            held = role_names if username == ADMIN_USERNAME else [rng.choice(role_names[1:])]
+            memberships.extend({"user_id": user_id, "role_id": roles[role]} for role in held)
+        session.execute(insert(UserRole.__table__), memberships)
+        refresh_admin_metrics(session)
+        session.commit()
+        analyst_role = roles["Analyst"]
+        analyst_perms = [perms[p] for p in init_roles_permissions.role_permissions["Analyst"]]
+    return {"user_ids": [uid for name, uid in user_ids.items() if name != ADMIN_USERNAME],
+            "analyst_role": analyst_role, "analyst_perms": analyst_perms}
+
+
+def build_scenarios(ctx, consumers: int):
+    rng = random.Random(1)
+    auth = {"Authorization": f"Bearer {ctx['token']}"}
+    return {
+        "login": lambda: ("POST", "/auth/login", {"data": {"username": ADMIN_USERNAME, "password": BENCH_PASSWORD}}),
+        "users": lambda: ("GET", f"/users?limit=200&after_id={rng.choice(ctx['user_ids'][:2000] or [0])}", {}),
+        "user_detail": lambda: ("GET", f"/users/number/{rng.randint(1, consumers)}", {}),
+        "me_permissions": lambda: ("GET", "/me/permissions", {"headers": auth}),
+        "admin_list": lambda: ("GET", "/admin/", {"headers": auth}),
+        "admin_metrics": lambda: ("GET", "/admin/metrics", {}),
+        "assign_role": lambda: ("POST", "/user-role-permissions", {"headers": auth, "json": {
+            "user_id": rng.choice(ctx["user_ids"]), "role_id": ctx["analyst_role"], "permission_ids": ctx["analyst_perms"]}}),
+    }
+
+
+async def run_endpoint(client, make_request, requests: int, concurrency: int, count_sql: bool):
+    latencies, statements, errors = [], [], 0
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(make_request())
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            method, url, kwargs = queue.get_nowait()
+            counter = [0]
+            token = _statements.set(counter) if count_sql else None
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                if response.status_code >= 400:
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+            if token is not None:
+                _statements.reset(token)
+                statements.append(counter[0])
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(requests / wall, 1),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "sql_per_request": round(sum(statements) / len(statements), 2) if statements else None,
+    }
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def drive(args, ctx, base_url=None, app=None):
+    import httpx
+    if app is not None:
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+    else:
+        client = httpx.AsyncClient(base_url=base_url, timeout=60)
+    async with client:
+        response = await client.post("/auth/login", data={"username": ADMIN_USERNAME, "password": BENCH_PASSWORD})
+        response.raise_for_status()
+        ctx["token"] = response.json()["access_token"]
+        scenarios = build_scenarios(ctx, args.consumers)
+        selected = args.endpoints.split(",") if args.endpoints else list(scenarios)
+        results = {}
+        for name in selected:
+            requests = args.login_requests if name == "login" else args.requests
+            await run_endpoint(client, scenarios[name], min(requests, args.warmup), args.concurrency, False)
+            results[name] = await run_endpoint(client, scenarios[name], requests, args.concurrency, app is not None)
+            print(f"{name:16s} {json.dumps(results[name])}", file=sys.stderr)
+    if app is not None:
+        # aiosqlite connections hold non-daemon threads until the pool is disposed
+        import database
+        await database.async_engine.dispose()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, current in results["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if not previous:
+            continue
+        for metric in ("p95_ms", "p99_ms"):
+            if previous.get(metric) and current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{name}.{metric}: {previous[metric]} -> {current[metric]}")
+        if previous.get("sql_per_request") is not None and current.get("sql_per_request") is not None \
+                and current["sql_per_request"] > previous["sql_per_request"]:
+            regressions.append(f"{name}.sql_per_request: {previous['sql_per_request']} -> {current['sql_per_request']}")
+        if previous.get("throughput_rps") and current["throughput_rps"] < previous["throughput_rps"] / (1 + tolerance):
+            regressions.append(f"{name}.throughput_rps: {previous['throughput_rps']} -> {current['throughput_rps']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="API throughput/latency benchmark")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--consumers", type=int, default=5000)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--login-requests", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--endpoints", help="comma-separated subset")
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn"], default="inprocess")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--db", help="database file to seed (default: temp file)")
+    parser.add_argument("--out", help="write the JSON report here")
+    parser.add_argument("--baseline", help="compare against a saved report")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown vs baseline")
+    args = parser.parse_args(argv)
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.db")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    # Configure before the app modules create their engines
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    os.environ.setdefault("DB_ECHO", "0")
+    # The login scenario measures bcrypt throughput, not the throttle
+    os.environ.setdefault("LOGIN_THROTTLE", "off")
+
+    import database
+    from sqlalchemy import event
+    started = time.perf_counter()
+    ctx = seed(database.engine, args.users, args.consumers, args.months, args.seed)
+    seed_seconds = time.perf_counter() - started
+
+    if args.mode == "inprocess":
+        event.listen(database.engine, "before_cursor_execute", _count_statement)
+        event.listen(database.async_engine.sync_engine, "before_cursor_execute", _count_statement)
+        import main as app_module
+        app_module.on_startup()
+        endpoints = asyncio.run(drive(args, ctx, app=app_module.app))
+    else:
+        port = _free_port()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(args.workers), "--log-level", "warning"],
+            env=dict(os.environ),
+        )
+        try:
+            for _ in range(100):
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            endpoints = asyncio.run(drive(args, ctx, base_url=f"http://127.0.0.1:{port}"))
+        finally:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "meta": {
+            "mode": args.mode, "workers": args.workers, "users": args.users, "consumers": args.consumers,
+            "months": args.months, "concurrency": args.concurrency, "requests": args.requests,
+            "bcrypt_rounds": args.bcrypt_rounds, "seed_seconds": round(seed_seconds, 2),
+            "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "endpoints": endpoints,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
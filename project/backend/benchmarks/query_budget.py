@@ -0,0 +1,208 @@
+# SQL statement budgets per endpoint. Seeds a throwaway database, calls every
+# GET route plus the role, permission, admin and grant writes and counts
+# statements per request, with the response and analytics caches cold; then grows
+# the data and counts again. Fails when a request goes over its @budget() or when
+# its count grows with the data, the signature of an N+1 query. Needs httpx.
+# Run from the backend directory:
+#   python -m benchmarks.query_budget --users 500 --scale 4
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+
+# Routes whose statement count legitimately follows the data (paged streams)
+SCALES_WITH_DATA = {"GET /export/consumers"}
+# Routes that issue no SQL of their own or are not API endpoints
+SKIP = {"/metrics", "/openapi.json", "/docs", "/docs/oauth2-redirect", "/redoc"}
+
+
+def grow(engine, users: int, consumers: int, months: int, seed_value: int, roles):
+    from sqlalchemy import insert
+    from sqlmodel import Session, select
+    from auth import get_password_hash
+    from generate_data import generate
+    from models import User, UserRole
+    from admin_stats import refresh_admin_metrics
+    from benchmarks.load import BENCH_PASSWORD
+
+    generate(engine, users=users, consumers=consumers, months=months, seed=seed_value,
+             password_hash=get_password_hash(BENCH_PASSWORD))
+    rng = random.Random(seed_value)
+    with Session(engine) as session:
+        members = set(session.exec(select(UserRole.user_id)).all())
+        new_ids = [uid for uid in session.exec(select(User.id)).all() if uid not in members]
+        if new_ids:
+            session.execute(insert(UserRole.__table__), [{"user_id": uid, "role_id": rng.choice(roles)} for uid in new_ids])
+        refresh_admin_metrics(session)
+        session.commit()
+
+
+# Each entry is (method, path, kwargs, setup): setup runs first, uncounted. Reads
+# use themselves as setup so lazy loads are not charged. Writes target different
+# users and names in each run so they always change something instead of taking
+# the no-op path; the template edit is reset first so every run adds the same
+# permission.
+def build_requests(app, ctx, run: int):
+    from fastapi.routing import APIRoute
+    params = {"number": 1, "user_id": ctx["user_ids"][0], "role_id": ctx["analyst_role"]}
+    requests = {}
+    for route in app.routes:
+        if not isinstance(route, APIRoute) or "GET" not in route.methods or route.path in SKIP:
+            continue
+        try:
+            path = route.path.format(**params)
+        except KeyError as missing:
+            print(f"skipping GET {route.path}: no sample value for {missing}", file=sys.stderr)
+            continue
+        requests[f"GET {route.path}"] = ("GET", path, {}, ("GET", path, {}))
+    # Each run takes the next 51 users that were not Analysts, wrapping around
+    # when there are too few (main() warns)
+    ids = ctx["assignable"] or ctx["user_ids"]
+    start = run * 51 % len(ids)
+    users = (ids[start:] + ids[:start])[:51]
+    assignment = {"user_id": users[0], "role_id": ctx["analyst_role"], "permission_ids": ctx["analyst_perms"]}
+    requests["POST /user-role-permissions"] = ("POST", "/user-role-permissions", {"json": assignment}, None)
+    requests["POST /user-role-permissions/bulk"] = ("POST", "/user-role-permissions/bulk", {"json": {"assignments": [
+        {**assignment, "user_id": uid} for uid in users[1:51] or users
+    ]}}, None)
+    template_path = f"/roles/{ctx['analyst_role']}/permissions"
+    requests["PUT /roles/{role_id}/permissions"] = ("PUT", template_path, {"json": ctx["analyst_perms"]},
+                                                    ("PUT", template_path, {"json": ctx["analyst_perms"][:-1]}))
+    requests["POST /roles"] = ("POST", "/roles", {"json": {"name": f"Bench Role {run}"}}, None)
+    requests["POST /permissions"] = ("POST", "/permissions", {"json": {"view_name": f"bench_view_{run}"}}, None)
+    admin = {"username": f"bench_new_admin_{run}", "email": f"bench_new_admin_{run}@example.com",
+             "password": "bench-password", "status": "Analyst"}
+    requests["POST /admin/"] = ("POST", "/admin/", {"json": admin}, None)
+    return requests
+
+
+# Users the grant writes can make Analysts: the seed already gave some of them
+# the role with its template permissions, and assigning those changes nothing
+def assignable_users(engine, ctx) -> list:
+    from sqlmodel import Session, select
+    from models import UserRole
+    with Session(engine) as session:
+        members = set(session.exec(select(UserRole.user_id).where(UserRole.role_id == ctx["analyst_role"])).all())
+    return [uid for uid in ctx["user_ids"] if uid not in members]
+
+
+def measure(client, app, requests, token):
+    from analytics import analytics_cache
+    from cache import response_cache
+    from query_budget import endpoint_budget
+    endpoints = {}
+    for route in app.routes:
+        for method in getattr(route, "methods", ()):
+            endpoints[f"{method} {route.path}"] = route.endpoint
+    headers = {"Authorization": f"Bearer {token}"}
+    counts = {}
+    for key, (method, path, kwargs, setup) in requests.items():
+        if setup:
+            client.request(setup[0], setup[1], headers=headers, **setup[2])
+        # Measure with cold response and analytics caches
+        response_cache.clear()
+        analytics_cache.clear()
+        client.counter.count = None
+        response = client.request(method, path, headers=headers, **kwargs)
+        counts[key] = {"status": response.status_code, "statements": client.counter.count,
+                       "budget": endpoint_budget(endpoints.get(key)),
+                       "measured": getattr(endpoints.get(key), "query_measured", None)}
+    return counts
+
+
+class CountingApp:
+    def __init__(self, app):
+        self.app = app
+        self.count = None
+
+    async def __call__(self, scope, receive, send):
+        from query_budget import count_queries
+        with count_queries() as counter:
+            await self.app(scope, receive, send)
+        self.count = counter.count
+
+
+def check(small, large):
+    failures = []
+    for key, result in large.items():
+        before = small[key]["statements"]
+        if result["status"] >= 400:
+            failures.append(f"{key}: HTTP {result['status']}")
+        if result["budget"] is not None and max(before, result["statements"]) > result["budget"]:
+            failures.append(f"{key}: {max(before, result['statements'])} statements, budget {result['budget']}")
+        if result["statements"] > before and key not in SCALES_WITH_DATA:
+            failures.append(f"{key}: {before} -> {result['statements']} statements as the data grew")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-endpoint SQL statement budgets at two data scales")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--consumers", type=int, default=500)
+    parser.add_argument("--months", type=int, default=6)
+    parser.add_argument("--scale", type=int, default=4, help="the second run has this many times the data")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", help="write the JSON report here")
+    args = parser.parse_args(argv)
+    if args.users < 1:
+        parser.error("--users must be at least 1")
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="budget-"), "budget.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["BCRYPT_ROUNDS"] = "4"
+    os.environ.setdefault("DB_ECHO", "0")
+
+    import database
+    import query_budget
+    from fastapi.testclient import TestClient
+    from benchmarks.load import seed, ADMIN_USERNAME, BENCH_PASSWORD
+
+    ctx = seed(database.engine, args.users, args.consumers, args.months, args.seed)
+    ctx["assignable"] = assignable_users(database.engine, ctx)
+    if len(ctx["assignable"]) < 102:
+        print(f"only {len(ctx['assignable'])} users to assign: the second run's grant writes may "
+              "find nothing to change, use a larger --users", file=sys.stderr)
+    query_budget.instrument_engine(database.engine)
+    query_budget.instrument_engine(database.async_engine.sync_engine)
+    import main as app_module
+    from rbac import rbac_index
+    from sqlmodel import Session, select
+    from models import Role
+
+    app = CountingApp(app_module.app)
+    with TestClient(app) as client:
+        client.counter = app
+        token = client.post("/auth/login", data={"username": ADMIN_USERNAME, "password": BENCH_PASSWORD}).json()["access_token"]
+        small = measure(client, app_module.app, build_requests(app_module.app, ctx, 0), token)
+        with Session(database.engine) as session:
+            roles = session.exec(select(Role.id).where(Role.name != "Super-Admin")).all()
+        extra = args.scale - 1
+        grow(database.engine, args.users * extra, args.consumers * extra, args.months, args.seed + 1, roles)
+        with Session(database.engine) as session:
+            rbac_index.reload(session)
+        large = measure(client, app_module.app, build_requests(app_module.app, ctx, 1), token)
+
+    report = {
+        "meta": {"users": [args.users, args.users * args.scale], "consumers": [args.consumers, args.consumers * args.scale]},
+        "endpoints": {key: {"small": small[key]["statements"], "large": large[key]["statements"],
+                            "budget": large[key]["budget"], "measured": large[key]["measured"],
+                            "status": large[key]["status"]} for key in large},
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    for key, row in report["endpoints"].items():
+        margin = f" ({row['measured']} + {row['budget'] - row['measured']})" if row["budget"] != row["measured"] else ""
+        print(f"{key:45s} {row['small']:>4} -> {row['large']:<4} budget {row['budget']}{margin}", file=sys.stderr)
+    failures = check(small, large)
+    for line in failures:
+        print(f"FAIL {line}", file=sys.stderr)
+    print(json.dumps(report, indent=2))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# Per-response serialization CPU for the consumer detail and user list endpoints,
+# old code path vs the current one. Run from the backend directory:
+#   python -m benchmarks.serialization [--months 24] [--users 200] [--json]
+import argparse
+import json
+import random
+import timeit
+from datetime import datetime
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from schemas import UserRead
+from serialization import dumps, splice_object, orjson
+from timeseries import period_label
+
+PROFILE = {
+    "name": "User 1", "number": 1, "email": "user1@example.com", "status": "active", "region": "North",
+    "segment": "Residential", "phase": "1-phase", "createdAt": "2024-01-01",
+}
+
+
+def make_consumer(months: int):
+    periods = [f"{2024 + m // 12}-{m % 12 + 1:02d}" for m in range(months)]
+    usage = [(p, float(random.randint(150, 300))) for p in periods]
+    paid = [(p, random.choice([0, 1])) for p in periods]
+    alerts = [(p, random.randint(0, 2)) for p in periods]
+    activity = [f"2024-07-{d:02d}: Paid bill" for d in range(1, 11)]
+    blobs = {
+        "usage_history": json.dumps([{"month": period_label(p), "usage": v} for p, v in usage]),
+        "payment_history": json.dumps([{"month": period_label(p), "paid": v} for p, v in paid]),
+        "alert_history": json.dumps([{"month": period_label(p), "alerts": v} for p, v in alerts]),
+        "recent_activity": json.dumps(activity),
+    }
+    return (usage, paid, alerts, activity), blobs
+
+
+def detail_old(blobs):
+    content = dict(PROFILE)
+    for column, blob in blobs.items():
+        content[column] = json.loads(blob) if blob else []
+    return JSONResponse(content=content).body
+
+
+def detail_rows(rows):
+    usage, paid, alerts, activity = rows
+    return splice_object(PROFILE, {
+        "usage_history": dumps([{"month": period_label(p), "period": p, "usage": v} for p, v in usage]),
+        "payment_history": dumps([{"month": period_label(p), "period": p, "paid": v} for p, v in paid]),
+        "alert_history": dumps([{"month": period_label(p), "period": p, "alerts": v} for p, v in alerts]),
+        "recent_activity": dumps(activity),
+    })
+
+
+def detail_spliced(blobs):
+    return splice_object(PROFILE, {c: b.encode() for c, b in blobs.items()})
+
+
+def make_users(count: int):
+    return [{
+        "id": i, "username": f"user{i}", "email": f"user{i}@example.com", "full_name": f"User {i}", "bio": None,
+        "avatar": None, "created_at": datetime(2024, 1, 1, 12), "status": "Active", "last_login": None,
+        "region": "North", "segment": "Residential", "phase": "1-phase", "usage_history": None,
+        "payment_history": None, "alert_history": None, "recent_activity": None, "roles": ["Analyst"],
+    } for i in range(1, count + 1)]
+
+
+def users_old(users):
+    # response_model validation + jsonable_encoder + stdlib JSONResponse
+    return JSONResponse(content=jsonable_encoder([UserRead(**u) for u in users])).body
+
+
+def users_new(users):
+    return dumps(users)
+
+
+def measure(fn, arg, number):
+    best = min(timeit.repeat(lambda: fn(arg), number=number, repeat=5))
+    return best / number * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--months", type=int, default=24)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+    random.seed(0)
+    rows, blobs = make_consumer(args.months)
+    users = make_users(args.users)
+    assert json.loads(detail_spliced(blobs)) == json.loads(detail_old(blobs))
+    assert json.loads(users_new(users)) == json.loads(users_old(users))
+    results = {
+        "encoder": "orjson" if orjson else "json",
+        "consumer_detail_us": {
+            "old_json_loads_and_reencode": measure(detail_old, blobs, args.number),
+            "series_rows": measure(detail_rows, rows, args.number),
+            "spliced_stored_json": measure(detail_spliced, blobs, args.number),
+        },
+        "user_list_us": {
+            "old_pydantic_jsonable_encoder": measure(users_old, users, max(1, args.number // 50)),
+            "direct_encode": measure(users_new, users, max(1, args.number // 50)),
+        },
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"encoder: {results['encoder']}")
+    for section in ("consumer_detail_us", "user_list_us"):
+        baseline = next(iter(results[section].values()))
+        print(f"{section} (microseconds per response)")
+        for name, value in results[section].items():
+            print(f"  {name:32s} {value:10.1f}  x{baseline / value:.1f}")
+
+
+if __name__ == "__main__":
+    main()
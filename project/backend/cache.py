@@ -0,0 +1,137 @@
+import os
+from collections import OrderedDict
+from hashlib import blake2b
+from secrets import token_hex
+from threading import Lock
+from typing import Dict, Iterable, Optional
+
+from fastapi import Request, Response
+
+from serialization import dumps
+
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+
+# Per-table change counters. Write endpoints bump the tables they touched;
+# cached responses are only valid for the versions they were built from. The
+# counters restart at 0 with the process, so every snapshot starts with a random
+# epoch: ETags from an earlier process or another worker never match.
+class TableVersions:
+    def __init__(self):
+        self._lock = Lock()
+        self._versions: Dict[str, int] = {}
+        self.epoch = token_hex(8)
+
+    def bump(self, *tables: str):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    # Invalidates every table at once, e.g. after changes may have been missed
+    def reset(self):
+        self.epoch = token_hex(8)
+
+    def snapshot(self, tables: Iterable[str]) -> tuple:
+        return (self.epoch,) + tuple(self._versions.get(t, 0) for t in tables)
+
+
+# Weak comparison against a comma-separated If-None-Match list
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == opaque:
+            return True
+    return False
+
+
+class CacheLookup:
+    def __init__(self, key: str, etag: str, response: Optional[Response] = None):
+        self.key = key
+        self.etag = etag
+        self.response = response
+
+
+class CacheEntry:
+    def __init__(self, etag: str, body: bytes, headers: Dict[str, str]):
+        self.etag = etag
+        self.body = body
+        self.headers = headers
+
+
+# LRU of encoded JSON bodies keyed by route + query string, capped by total body size.
+# The ETag is derived from the key and table versions, so a matching If-None-Match
+# is answered with 304 before any query or serialization happens.
+class ResponseCache:
+    def __init__(self, versions: TableVersions, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.versions = versions
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def lookup(self, request: Request, tables: Iterable[str]) -> CacheLookup:
+        key = request.url.path + "?" + "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+        digest = blake2b(f"{key}|{self.versions.snapshot(tables)}".encode(), digest_size=12).hexdigest()
+        etag = f'W/"{digest}"'
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            self.not_modified += 1
+            return CacheLookup(key, etag, Response(status_code=304, headers=self._headers(etag)))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.etag == etag:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return CacheLookup(key, etag, self._response(entry))
+            self.misses += 1
+        return CacheLookup(key, etag)
+
+    def store(self, lookup: CacheLookup, content, headers: Optional[Dict[str, str]] = None) -> Response:
+        body = dumps(content)
+        entry = CacheEntry(lookup.etag, body, headers or {})
+        if len(body) <= self.max_bytes:
+            with self._lock:
+                old = self._entries.pop(lookup.key, None)
+                if old is not None:
+                    self.size -= len(old.body)
+                self._entries[lookup.key] = entry
+                self.size += len(body)
+                while self.size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.size -= len(evicted.body)
+                    self.evictions += 1
+        return self._response(entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.not_modified
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits + self.not_modified) / lookups if lookups else 0.0,
+        }
+
+    def _headers(self, etag: str) -> Dict[str, str]:
+        return {"ETag": etag, "Cache-Control": "no-cache"}
+
+    def _response(self, entry: CacheEntry) -> Response:
+        return Response(content=entry.body, media_type="application/json", headers={**self._headers(entry.etag), **entry.headers})
+
+
+table_versions = TableVersions()
+response_cache = ResponseCache(table_versions)
@@ -0,0 +1,122 @@
+import csv
+import io
+import json
+import zlib
+from typing import Iterator, List, Optional
+
+from sqlmodel import Session, select
+
+from models import UserAnalytics, UsageReading, PaymentRecord, AlertRecord, DetectedAlert
+
+EXPORT_FORMATS = ("csv", "ndjson")
+PAGE_SIZE = 1000  # consumers fetched from the cursor at a time
+FLUSH_BYTES = 64 * 1024
+PROFILE_COLUMNS = ["number", "name", "email", "status", "region", "segment", "phase", "createdAt"]
+CSV_COLUMNS = PROFILE_COLUMNS + ["period", "usage", "paid", "alerts", "detected"]
+
+
+class ExportFilters:
+    def __init__(self, region: Optional[str] = None, segment: Optional[str] = None,
+                 created_from: Optional[str] = None, created_to: Optional[str] = None,
+                 period_from: Optional[str] = None, period_to: Optional[str] = None):
+        self.region = region
+        self.segment = segment
+        self.created_from = created_from
+        self.created_to = created_to
+        self.period_from = period_from
+        self.period_to = period_to
+
+    def consumers(self):
+        query = select(*[getattr(UserAnalytics, c) for c in PROFILE_COLUMNS]).order_by(UserAnalytics.number)
+        if self.region:
+            query = query.where(UserAnalytics.region == self.region)
+        if self.segment:
+            query = query.where(UserAnalytics.segment == self.segment)
+        if self.created_from:
+            query = query.where(UserAnalytics.createdAt >= self.created_from)
+        if self.created_to:
+            query = query.where(UserAnalytics.createdAt <= self.created_to)
+        return query
+
+    def series(self, model, value_column, numbers: List[int]):
+        query = select(model.consumer_number, model.period, value_column).where(model.consumer_number.in_(numbers))
+        if self.period_from:
+            query = query.where(model.period >= self.period_from)
+        if self.period_to:
+            query = query.where(model.period <= self.period_to)
+        return query
+
+
+# Yields (profile row, {period: [usage, paid, alerts, detected]}) one consumer at
+# a time. As in the detail response, a detected anomaly adds one to the month's
+# ingested alert count.
+# Consumers come off a streaming cursor in pages; each page's histories are read
+# with one query per series, so memory is bounded by PAGE_SIZE.
+def iter_consumers(engine, filters: ExportFilters) -> Iterator[tuple]:
+    with Session(engine) as session:
+        result = session.execute(filters.consumers(), execution_options={"yield_per": PAGE_SIZE})
+        for page in result.partitions():
+            numbers = [row.number for row in page]
+            history = {n: {} for n in numbers}
+            for slot, (model, column) in enumerate((
+                (UsageReading, UsageReading.usage),
+                (PaymentRecord, PaymentRecord.paid),
+                (AlertRecord, AlertRecord.alerts),
+                (DetectedAlert, DetectedAlert.kind),
+            )):
+                for number, period, value in session.execute(filters.series(model, column, numbers)):
+                    history[number].setdefault(period, [None, None, None, None])[slot] = value
+            for periods in history.values():
+                for values in periods.values():
+                    if values[3] is not None:
+                        values[2] = (values[2] or 0) + 1
+            for row in page:
+                yield row, dict(sorted(history[row.number].items()))
+
+
+def _csv_chunks(rows: Iterator[tuple]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for profile, history in rows:
+        profile = list(profile)
+        if not history:
+            writer.writerow(profile + [None, None, None, None, None])
+        for period, values in history.items():
+            writer.writerow(profile + [period] + values)
+        if buffer.tell() >= FLUSH_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _ndjson_chunks(rows: Iterator[tuple]) -> Iterator[str]:
+    parts = []
+    size = 0
+    for profile, history in rows:
+        record = dict(zip(PROFILE_COLUMNS, profile))
+        record["usage_history"] = [{"period": p, "usage": v[0]} for p, v in history.items() if v[0] is not None]
+        record["payment_history"] = [{"period": p, "paid": v[1]} for p, v in history.items() if v[1] is not None]
+        record["alert_history"] = [{"period": p, "alerts": v[2], "detected": v[3]} for p, v in history.items() if v[2] is not None]
+        line = json.dumps(record) + "\n"
+        parts.append(line)
+        size += len(line)
+        if size >= FLUSH_BYTES:
+            yield "".join(parts)
+            parts = []
+            size = 0
+    yield "".join(parts)
+
+
+def export_stream(engine, fmt: str, filters: ExportFilters, compress: bool = False) -> Iterator[bytes]:
+    chunks = _csv_chunks if fmt == "csv" else _ndjson_chunks
+    gzip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    for chunk in chunks(iter_consumers(engine, filters)):
+        data = chunk.encode("utf-8")
+        if gzip:
+            data = gzip.compress(data)
+        if data:
+            yield data
+    if gzip:
+        yield gzip.flush()
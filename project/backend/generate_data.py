@@ -0,0 +1,223 @@
+import argparse
+import json
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+from sqlalchemy import func
+from sqlmodel import Session, SQLModel, select
+
+from models import User, UserAnalytics, UsageReading, PaymentRecord, AlertRecord, ActivityEvent
+from rollups import rebuild_rollups
+
+# Synthetic users, consumers and monthly histories at volume. Sampling is
+# vectorized with NumPy and rows go in through the driver's executemany, one
+# transaction per chunk. The same seed and chunk size always give the same data.
+#   python generate_data.py --users 100000 --consumers 1000000 --months 24
+
+REGIONS = np.array(["North", "South", "East", "West"])
+REGION_WEIGHTS = [0.3, 0.25, 0.25, 0.2]
+REGION_USAGE = np.array([1.0, 1.25, 0.95, 1.1])  # climate: South cools, West heats
+
+SEGMENTS = np.array(["Residential", "Commercial", "Industrial"])
+SEGMENT_WEIGHTS = [0.8, 0.15, 0.05]
+SEGMENT_USAGE = np.array([250.0, 1500.0, 9000.0])  # median kWh per month
+SEGMENT_ACTIVE = np.array([0.9, 0.94, 0.97])
+SEGMENT_PAID = np.array([0.92, 0.96, 0.98])
+SEGMENT_THREE_PHASE = np.array([0.08, 0.6, 0.98])
+
+PHASES = np.array(["1-phase", "3-phase"])
+PHASE_USAGE = np.array([1.0, 1.3])
+
+ACTIVITIES = np.array(["Paid bill", "Usage alert triggered", "Updated profile", "Meter read", "Plan changed"])
+ACTIVITY_WEIGHTS = [0.45, 0.15, 0.1, 0.25, 0.05]
+
+CHUNK_SIZE = 20_000
+
+
+def _placeholders(engine, count: int) -> str:
+    marker = "?" if engine.dialect.paramstyle == "qmark" else "%s"
+    return ", ".join([marker] * count)
+
+
+def insert_sql(engine, model, columns: List[str]) -> str:
+    quote = engine.dialect.identifier_preparer.quote
+    return (
+        f"INSERT INTO {quote(model.__tablename__)} ({', '.join(quote(c) for c in columns)}) "
+        f"VALUES ({_placeholders(engine, len(columns))})"
+    )
+
+
+def _periods(start: str, months: int) -> List[str]:
+    year, month = int(start[:4]), int(start[5:7]) - 1
+    return [f"{year + (month + m) // 12}-{(month + m) % 12 + 1:02d}" for m in range(months)]
+
+
+def _timestamps(rng, count: int, start: str, days: int) -> np.ndarray:
+    base = np.datetime64(f"{start}-01T00:00:00", "s")
+    offsets = rng.integers(0, days * 86400, count).astype("timedelta64[s]")
+    return np.char.replace(np.datetime_as_string(base + offsets, unit="s"), "T", " ")
+
+
+# Categorical attributes shared by users and consumers. Phase depends on the
+# segment: industrial sites are almost always 3-phase, homes rarely are.
+def _demographics(rng, count: int):
+    region = rng.choice(len(REGIONS), count, p=REGION_WEIGHTS)
+    segment = rng.choice(len(SEGMENTS), count, p=SEGMENT_WEIGHTS)
+    phase = (rng.random(count) < SEGMENT_THREE_PHASE[segment]).astype(np.int64)
+    active = rng.random(count) < SEGMENT_ACTIVE[segment]
+    return region, segment, phase, active
+
+
+def user_rows(rng, first_id: int, count: int, password_hash: str, start: str) -> List[Tuple]:
+    ids = np.arange(first_id, first_id + count)
+    region, segment, phase, active = _demographics(rng, count)
+    created = _timestamps(rng, count, start, 365)
+    names = [f"user{i}" for i in ids.tolist()]
+    return list(zip(
+        names,
+        [f"{n}@example.com" for n in names],
+        [password_hash] * count,
+        [f"User {i}" for i in ids.tolist()],
+        created.tolist(),
+        np.where(active, "Active", "Inactive").tolist(),
+        REGIONS[region].tolist(),
+        SEGMENTS[segment].tolist(),
+        PHASES[phase].tolist(),
+    ))
+
+
+USER_COLUMNS = ["username", "email", "password_hash", "full_name", "created_at", "status", "region", "segment", "phase"]
+
+
+def consumer_rows(rng, first_number: int, count: int, periods: List[str], activity: int, start: str) -> Dict[type, List[Tuple]]:
+    months = len(periods)
+    numbers = np.arange(first_number, first_number + count)
+    region, segment, phase, active = _demographics(rng, count)
+
+    # Monthly usage: lognormal per-consumer level around the segment median,
+    # scaled by region and phase, with a shared seasonal swing and noise
+    level = SEGMENT_USAGE[segment] * REGION_USAGE[region] * PHASE_USAGE[phase] * rng.lognormal(0.0, 0.35, count)
+    month_index = np.array([int(p[5:7]) - 1 for p in periods])
+    seasonal = 1.0 + 0.25 * np.cos((month_index - 0.5) * np.pi / 6)  # winter peak
+    usage = level[:, None] * seasonal[None, :] * rng.normal(1.0, 0.08, (count, months))
+    usage = np.round(np.clip(usage, 0.0, None) * ~(~active[:, None] & (rng.random((count, months)) < 0.7)), 1)
+
+    # Late payers stay late: each consumer gets their own payment propensity
+    propensity = np.clip(rng.beta(8, 1, count) * SEGMENT_PAID[segment] / 0.89, 0.0, 1.0)
+    paid = (rng.random((count, months)) < propensity[:, None]).astype(np.int64)
+
+    # Alerts become likely when a month runs well above the consumer's level
+    excess = np.clip(usage / level[:, None] - 1.0, 0.0, None)
+    alerts = rng.poisson(0.02 + 2.0 * excess ** 2)
+
+    number_list = numbers.tolist()
+    flat_numbers = np.repeat(numbers, months).tolist()
+    flat_periods = periods * count
+    rows = {
+        UserAnalytics: list(zip(
+            number_list,
+            [f"Consumer {n}" for n in number_list],
+            [f"consumer{n}@example.com" for n in number_list],
+            np.where(active, "active", "inactive").tolist(),
+            REGIONS[region].tolist(),
+            SEGMENTS[segment].tolist(),
+            PHASES[phase].tolist(),
+            [t[:10] for t in _timestamps(rng, count, start, 365).tolist()],
+            *([["[]"] * count] * 4),
+        )),
+        UsageReading: list(zip(flat_numbers, flat_periods, usage.ravel().tolist())),
+        PaymentRecord: list(zip(flat_numbers, flat_periods, paid.ravel().tolist())),
+        AlertRecord: list(zip(flat_numbers, flat_periods, alerts.ravel().tolist())),
+    }
+    if activity:
+        days = len(periods) * 30
+        rows[ActivityEvent] = list(zip(
+            np.repeat(numbers, activity).tolist(),
+            [t[:10] for t in _timestamps(rng, count * activity, start, days).tolist()],
+            ACTIVITIES[rng.choice(len(ACTIVITIES), count * activity, p=ACTIVITY_WEIGHTS)].tolist(),
+        ))
+    return rows
+
+
+CONSUMER_COLUMNS = {
+    UserAnalytics: ["number", "name", "email", "status", "region", "segment", "phase", "createdAt",
+                    "usage_history", "payment_history", "alert_history", "recent_activity"],
+    UsageReading: ["consumer_number", "period", "usage"],
+    PaymentRecord: ["consumer_number", "period", "paid"],
+    AlertRecord: ["consumer_number", "period", "alerts"],
+    ActivityEvent: ["consumer_number", "period", "description"],
+}
+
+
+def _executemany(engine, model, columns: List[str], rows: List[Tuple]):
+    with engine.begin() as conn:
+        conn.exec_driver_sql(insert_sql(engine, model, columns), rows)
+
+
+def generate(engine, users: int = 0, consumers: int = 0, months: int = 12, start: str = "2024-01",
+             seed: int = 42, chunk_size: int = CHUNK_SIZE, activity: int = 2, password_hash: str = "fakehash",
+             rollups: bool = True) -> dict:
+    started = time.perf_counter()
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        first_id = (session.exec(select(func.max(User.id))).one() or 0) + 1
+        first_number = (session.exec(select(func.max(UserAnalytics.number))).one() or 0) + 1
+    periods = _periods(start, months)
+    written = {"user": 0, "useranalytics": 0, "usagereading": 0, "paymentrecord": 0, "alertrecord": 0, "activityevent": 0}
+
+    # Each chunk draws from its own stream so chunks are independent of each other
+    for chunk, offset in enumerate(range(0, users, chunk_size)):
+        rng = np.random.default_rng([seed, 0, chunk])
+        rows = user_rows(rng, first_id + offset, min(chunk_size, users - offset), password_hash, start)
+        _executemany(engine, User, USER_COLUMNS, rows)
+        written["user"] += len(rows)
+
+    for chunk, offset in enumerate(range(0, consumers, chunk_size)):
+        rng = np.random.default_rng([seed, 1, chunk])
+        tables = consumer_rows(rng, first_number + offset, min(chunk_size, consumers - offset), periods, activity, start)
+        with engine.begin() as conn:
+            for model, rows in tables.items():
+                conn.exec_driver_sql(insert_sql(engine, model, CONSUMER_COLUMNS[model]), rows)
+                written[model.__tablename__] += len(rows)
+
+    if rollups and consumers:
+        with Session(engine) as session:
+            rebuild_rollups(session)
+    # Lets running API workers drop what they cached from these tables
+    tables = [name for name, count in written.items() if count]
+    if tables:
+        from invalidation import invalidation_bus
+        with Session(engine) as session:
+            invalidation_bus.publish(session, tables=tables)
+            session.commit()
+    seconds = time.perf_counter() - started
+    total = sum(written.values())
+    return {"rows": written, "seconds": round(seconds, 2), "rows_per_sec": round(total / seconds) if seconds else None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic users, consumers and monthly histories.")
+    parser.add_argument("--users", type=int, default=0)
+    parser.add_argument("--consumers", type=int, default=0)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--start", default="2024-01", help="first period, YYYY-MM")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="rows sampled and committed per transaction")
+    parser.add_argument("--activity", type=int, default=2, help="activity events per consumer")
+    parser.add_argument("--password", help="password for every generated user (hashed once)")
+    parser.add_argument("--no-rollups", action="store_true", help="skip the dashboard rollup rebuild")
+    args = parser.parse_args(argv)
+
+    from database import engine
+    password_hash = "fakehash"
+    if args.password:
+        from auth import get_password_hash
+        password_hash = get_password_hash(args.password)
+    report = generate(engine, args.users, args.consumers, args.months, args.start, args.seed,
+                      args.chunk_size, args.activity, password_hash, not args.no_rollups)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+import argparse
+import csv
+import json
+import re
+import sys
+import time
+from datetime import date
+from itertools import islice
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Tuple
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, func, select
+
+from models import UserAnalytics, UsageReading, PaymentRecord, AlertRecord
+from rollups import track_consumers, rebuild_rollups
+
+KINDS = ("consumers", "readings")
+# Running API workers key their analytics cube on these; see publish_ingest
+INGEST_TABLES = [UserAnalytics.__tablename__, UsageReading.__tablename__]
+FORMATS = ("csv", "ndjson")
+BATCH_SIZE = 5000
+COMMIT_EVERY = 20  # batches per transaction
+MAX_REJECTED_SAMPLES = 100
+PERIOD_RE = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+CONSUMER_FIELDS = ["name", "email", "status", "region", "segment", "phase"]
+
+
+class IngestError(Exception):
+    pass
+
+
+# (line number, raw record) pairs, decoded incrementally from a binary stream
+def iter_records(stream: BinaryIO, fmt: str) -> Iterator[Tuple[int, dict]]:
+    if fmt not in FORMATS:
+        raise IngestError(f"Unknown format {fmt!r}, expected one of {FORMATS}")
+    lines = _decode_lines(stream)
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        try:
+            for record in reader:
+                yield reader.line_num, record
+        except csv.Error as e:
+            # DictReader.line_num only moves on after a good row
+            raise IngestError(f"Line {reader.reader.line_num}: {e}")
+    elif fmt == "ndjson":
+        for line_num, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield line_num, record if isinstance(record, dict) else {"__invalid__": line[:200]}
+
+
+# Line by line so a bad byte is reported on its own line; spreadsheet exports
+# often start with a byte order mark, which would otherwise end up in the first header
+def _decode_lines(stream: BinaryIO) -> Iterator[str]:
+    for line_num, raw in enumerate(stream, 1):
+        try:
+            yield raw.decode("utf-8-sig" if line_num == 1 else "utf-8")
+        except UnicodeDecodeError as e:
+            raise IngestError(f"Line {line_num}: not valid UTF-8 (byte {raw[e.start]:#04x} at column {e.start + 1})")
+
+
+def _required(raw: dict, field: str) -> str:
+    value = raw.get(field)
+    if value is None or str(value).strip() == "":
+        raise ValueError(f"missing {field}")
+    return str(value).strip()
+
+
+def validate_consumer(raw: dict) -> dict:
+    row = {"number": int(_required(raw, "number"))}
+    for field in CONSUMER_FIELDS:
+        row[field] = _required(raw, field)
+    row["createdAt"] = str(raw.get("createdAt") or date.today().isoformat())
+    return row
+
+
+def validate_reading(raw: dict) -> dict:
+    period = _required(raw, "period")
+    if not PERIOD_RE.match(period):
+        raise ValueError(f"bad period {period!r}, expected YYYY-MM")
+    usage = float(_required(raw, "usage"))
+    if usage < 0:
+        raise ValueError("negative usage")
+    row = {"consumer_number": int(_required(raw, "number")), "period": period, "usage": usage}
+    for field in ("paid", "alerts"):
+        value = raw.get(field)
+        row[field] = int(value) if value not in (None, "") else None
+    return row
+
+
+VALIDATORS = {"consumers": validate_consumer, "readings": validate_reading}
+
+
+def upsert_statement(session: Session, table, keys: List[str], update_columns: List[str]):
+    insert_fn = pg_insert if session.get_bind().dialect.name == "postgresql" else sqlite_insert
+    stmt = insert_fn(table)
+    return stmt.on_conflict_do_update(index_elements=keys, set_={c: stmt.excluded[c] for c in update_columns})
+
+
+def _existing_numbers(session: Session, numbers: Iterable[int]) -> set:
+    numbers = list(numbers)
+    found = set()
+    for i in range(0, len(numbers), 500):
+        found.update(session.exec(select(UserAnalytics.number).where(UserAnalytics.number.in_(numbers[i:i + 500]))).all())
+    return found
+
+
+def _write_consumers(session: Session, rows: List[dict]):
+    # Keep existing history columns and creation dates; new consumers start with
+    # empty histories
+    table = UserAnalytics.__table__
+    stmt = upsert_statement(session, table, ["number"], CONSUMER_FIELDS)
+    empty = {c: "[]" for c in ("usage_history", "payment_history", "alert_history", "recent_activity")}
+    session.execute(stmt, [{**row, **empty} for row in rows])
+
+
+def _write_readings(session: Session, rows: List[dict]):
+    keys = ["consumer_number", "period"]
+    # Every batch gets the next revision, on new and corrected rows alike, so
+    # alert_detection.py can find both from its watermark
+    revision = (session.execute(select(func.max(UsageReading.revision))).scalar() or 0) + 1
+    session.execute(
+        upsert_statement(session, UsageReading.__table__, keys, ["usage", "revision"]),
+        [{"consumer_number": r["consumer_number"], "period": r["period"], "usage": r["usage"], "revision": revision} for r in rows],
+    )
+    for model, field in ((PaymentRecord, "paid"), (AlertRecord, "alerts")):
+        values = [{"consumer_number": r["consumer_number"], "period": r["period"], field: r[field]} for r in rows if r[field] is not None]
+        if values:
+            session.execute(upsert_statement(session, model.__table__, keys, [field]), values)
+
+
+def ingest(session: Session, stream: BinaryIO, kind: str, fmt: str, batch_size: int = BATCH_SIZE,
+           commit_every: int = COMMIT_EVERY, track_rollups: bool = True) -> dict:
+    if kind not in KINDS:
+        raise IngestError(f"Unknown kind {kind!r}, expected one of {KINDS}")
+    if fmt not in FORMATS:
+        raise IngestError(f"Unknown format {fmt!r}, expected one of {FORMATS}")
+    validate = VALIDATORS[kind]
+    key_of = (lambda r: r["number"]) if kind == "consumers" else (lambda r: (r["consumer_number"], r["period"]))
+    number_of = (lambda r: r["number"]) if kind == "consumers" else (lambda r: r["consumer_number"])
+    write = _write_consumers if kind == "consumers" else _write_readings
+    report = {"kind": kind, "format": fmt, "rows": 0, "written": 0, "rejected": 0, "rejected_samples": []}
+
+    def reject(line_num, reason):
+        report["rejected"] += 1
+        if len(report["rejected_samples"]) < MAX_REJECTED_SAMPLES:
+            report["rejected_samples"].append({"line": line_num, "error": reason})
+
+    start = time.perf_counter()
+    records = iter_records(stream, fmt)
+    batches = 0
+    while True:
+        chunk = list(islice(records, batch_size))
+        if not chunk:
+            break
+        report["rows"] += len(chunk)
+        valid: Dict[object, Tuple[int, dict]] = {}
+        for line_num, raw in chunk:
+            if "__invalid__" in raw:
+                reject(line_num, "invalid JSON record")
+                continue
+            try:
+                row = validate(raw)
+            except (ValueError, TypeError) as e:
+                reject(line_num, str(e))
+                continue
+            valid[key_of(row)] = (line_num, row)  # last occurrence wins
+        if kind == "readings":
+            known = _existing_numbers(session, {number_of(row) for _, row in valid.values()})
+            for key, (line_num, row) in list(valid.items()):
+                if number_of(row) not in known:
+                    reject(line_num, f"unknown consumer {number_of(row)}")
+                    del valid[key]
+        rows = [row for _, row in valid.values()]
+        if rows:
+            if track_rollups:
+                with track_consumers(session, {number_of(row) for row in rows}):
+                    write(session, rows)
+            else:
+                write(session, rows)
+            report["written"] += len(rows)
+        batches += 1
+        if batches % commit_every == 0:
+            session.commit()
+    session.commit()
+    if not track_rollups:
+        rebuild_rollups(session)
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    report["rows_per_sec"] = round(report["rows"] / report["seconds"]) if report["seconds"] else report["rows"]
+    return report
+
+
+# Corrected readings keep their ids, so other processes only notice an ingest
+# through its invalidation event; published after any outcome, since batches
+# committed before an error stay
+def publish_ingest(session: Session):
+    from invalidation import invalidation_bus
+    invalidation_bus.publish(session, tables=INGEST_TABLES)
+    session.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-load consumer records or monthly meter readings.")
+    parser.add_argument("kind", choices=KINDS)
+    parser.add_argument("path", help="CSV or NDJSON file, '-' for stdin")
+    parser.add_argument("--format", choices=FORMATS, help="defaults to the file extension")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--commit-every", type=int, default=COMMIT_EVERY)
+    parser.add_argument("--rebuild-rollups", action="store_true", help="skip per-batch rollup updates and rebuild once at the end")
+    args = parser.parse_args(argv)
+    fmt = args.format or ("ndjson" if args.path.endswith((".ndjson", ".jsonl")) else "csv")
+
+    from database import engine
+    from sqlmodel import SQLModel
+    SQLModel.metadata.create_all(engine)
+    stream = sys.stdin.buffer if args.path == "-" else open(args.path, "rb")
+    try:
+        with Session(engine) as session:
+            try:
+                report = ingest(session, stream, args.kind, fmt, args.batch_size, args.commit_every, not args.rebuild_rollups)
+            except IngestError:
+                session.rollback()
+                publish_ingest(session)
+                raise
+            publish_ingest(session)
+    except IngestError as e:
+        sys.exit(f"ingest stopped: {e}")
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
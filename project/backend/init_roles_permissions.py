@@ -1,6 +1,9 @@
 from sqlmodel import Session, select
 from database import engine
-from models import Role, Permission, UserRolePermission
+from models import Role, Permission, RolePermission
+from assignments import role_templates
+from role_templates import set_role_permissions
+from invalidation import invalidation_bus
 
 # Define roles and permissions
 roles = [
@@ -34,6 +37,7 @@ def main():
             if not db_role:
                 db_role = Role(**role)
                 session.add(db_role)
+                invalidation_bus.publish(session, tables=[Role.__tablename__], catalog=True)
                 session.commit()
                 session.refresh(db_role)
             role_objs[role["name"]] = db_role
@@ -44,60 +48,31 @@ def main():
             if not db_perm:
                 db_perm = Permission(**perm)
                 session.add(db_perm)
+                invalidation_bus.publish(session, tables=[Permission.__tablename__], catalog=True)
                 session.commit()
                 session.refresh(db_perm)
             perm_objs[perm["view_name"]] = db_perm
-        # Assign permissions to roles using a dummy user_id (e.g., 1)
-        dummy_user_id = 1
+        # Role templates; roles that already have one keep it (reconcile.py resets them)
+        templates = role_templates(session)
+        created = []
         for role_name, perm_names in role_permissions.items():
-            role = role_objs[role_name]
-            for perm_name in perm_names:
-                perm = perm_objs[perm_name]
-                # Check if mapping already exists
-                existing = session.exec(select(UserRolePermission).where(
-                    (UserRolePermission.user_id == dummy_user_id) &
-                    (UserRolePermission.role_id == role.id) &
-                    (UserRolePermission.permission_id == perm.id)
-                )).first()
-                if not existing:
-                    urp = UserRolePermission(user_id=dummy_user_id, role_id=role.id, permission_id=perm.id)
-                    session.add(urp)
+            role_id = role_objs[role_name].id
+            if role_id not in templates:
+                set_role_permissions(session, role_id, [perm_objs[p].id for p in perm_names])
+                created.append(role_id)
+        if created:
+            # A running API patches these roles from the event
+            invalidation_bus.publish(session, tables=[RolePermission.__tablename__], roles=created)
         session.commit()
         print("Roles and permissions initialized.")
 
+# Resets the role templates to role_permissions and drops per-user overrides on those roles
 def assign_permissions_to_all_users():
-    from models import User, UserRolePermission, Role, Permission
-    from sqlmodel import select
+    from reconcile import reconcile
     with Session(engine) as session:
-        # Get all roles and permissions
-        role_objs = {r.name: r for r in session.exec(select(Role)).all()}
-        perm_objs = {p.view_name: p for p in session.exec(select(Permission)).all()}
-        users = session.exec(select(User)).all()
-        for user in users:
-            # Get roles for user
-            urps = session.exec(select(UserRolePermission).where(UserRolePermission.user_id == user.id)).all()
-            user_role_ids = set([urp.role_id for urp in urps])
-            for role_name, perm_names in role_permissions.items():
-                role = role_objs.get(role_name)
-                if not role:
-                    continue
-                if role.id in user_role_ids:
-                    # Remove old permissions for this user/role
-                    old_urps = session.exec(
-                        select(UserRolePermission).where(
-                            (UserRolePermission.user_id == user.id) & (UserRolePermission.role_id == role.id)
-                        )
-                    ).all()
-                    for urp in old_urps:
-                        session.delete(urp)
-                    # Assign correct permissions
-                    for perm_name in perm_names:
-                        perm = perm_objs.get(perm_name)
-                        if perm:
-                            urp = UserRolePermission(user_id=user.id, role_id=role.id, permission_id=perm.id)
-                            session.add(urp)
-        session.commit()
-        print("Permissions assigned to all users with Inspector or Analyst roles.")
+        report = reconcile(session, role_permissions)
+    print(f"Permissions reconciled: {len(report['template_changes'])} role templates and {report['changed_pairs']} user/role grants changed "
+          f"(-{report['delete_rows']} +{report['insert_rows']} rows) in {report['plan_seconds'] + report['apply_seconds']:.2f}s.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,238 @@
+import json
+import logging
+import os
+import time
+import uuid
+from threading import Event, Thread
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import delete, func, select
+from sqlmodel import Session
+
+from cache import response_cache, table_versions
+from database import engine
+from models import CacheEvent
+from rbac import rbac_index
+from tokens import token_versions
+
+# Cross-worker invalidation for the in-process caches (RBAC index, token
+# versions, response cache table versions). A write adds a CacheEvent row to its
+# own transaction naming what changed; every worker polls the table and patches
+# only those entries, skipping the events it wrote itself. On SQLite the poll is
+# PRAGMA data_version on a dedicated connection, which only changes when another
+# connection commits, so an idle poll never touches the table. Elsewhere ids
+# come from a sequence handed out before commit, so each poll also re-reads the
+# last INVALIDATION_OVERLAP seconds for events that committed behind the cursor.
+#   INVALIDATION_BUS=1  INVALIDATION_POLL_MS=50  INVALIDATION_RETENTION=3600
+#   INVALIDATION_OVERLAP=10
+
+INVALIDATION_BUS = os.getenv("INVALIDATION_BUS", "1").lower() in ("1", "true", "yes")
+INVALIDATION_POLL_MS = int(os.getenv("INVALIDATION_POLL_MS", "50"))
+INVALIDATION_RETENTION = int(os.getenv("INVALIDATION_RETENTION", "3600"))
+INVALIDATION_OVERLAP = float(os.getenv("INVALIDATION_OVERLAP", "10"))
+POLL_BATCH = 500
+
+logger = logging.getLogger("invalidation")
+
+
+class InvalidationBus:
+    def __init__(self, engine, poll_ms: int = INVALIDATION_POLL_MS, enabled: bool = INVALIDATION_BUS):
+        self.engine = engine
+        self.interval = poll_ms / 1000
+        # In-memory SQLite is private to one process
+        self.enabled = enabled and ":memory:" not in str(engine.url) and str(engine.url) not in ("sqlite://", "sqlite:///")
+        self._token = uuid.uuid4().hex[:12]
+        self.last_id = 0
+        # SQLite serializes writers, so ids are assigned in commit order there
+        self.overlap = 0 if engine.dialect.name == "sqlite" else INVALIDATION_OVERLAP
+        self._seen: Dict[int, float] = {}
+        self._stop = Event()
+        self._thread: Optional[Thread] = None
+        self._conn = None
+        self._data_version = None
+        self._failed = False
+        self.polls = 0
+        self.events = 0
+        self.applied = 0
+        self.errors = 0
+        self.resets = 0
+        self.last_lag: Optional[float] = None
+        self.max_lag = 0.0
+
+    # Forked workers share the random part, so the pid goes in at use time
+    @property
+    def origin(self) -> str:
+        return f"{self._token}:{os.getpid()}"
+
+    # Adds the event to the caller's transaction; the caller commits
+    def publish(self, session: Session, tables: Iterable[str] = (), users: Iterable[int] = (),
+                roles: Iterable[int] = (), tokens: Iterable[int] = (), catalog: bool = False):
+        if not self.enabled:
+            return
+        payload = {key: sorted(set(values)) for key, values in
+                   (("tables", tables), ("users", users), ("roles", roles), ("tokens", tokens)) if values}
+        if catalog:
+            payload["catalog"] = True
+        session.add(CacheEvent(origin=self.origin, payload=json.dumps(payload, separators=(",", ":")), created=time.time()))
+
+    # Skips past existing events; called before the caches are first loaded so
+    # nothing committed after the load can be missed
+    def seek_end(self):
+        if not self.enabled:
+            return
+        with Session(self.engine) as session:
+            self.last_id = session.execute(select(func.max(CacheEvent.id))).scalar() or 0
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._run, name="invalidation-bus", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self._thread = None
+        self._close()
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+        self._data_version = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                self.errors += 1
+                self._failed = True
+                self._close()
+                logger.exception("invalidation poll failed")
+
+    def _changed(self) -> bool:
+        if self.engine.dialect.name != "sqlite":
+            return True
+        if self._conn is None:
+            self._conn = self.engine.raw_connection()
+        cursor = self._conn.cursor()
+        try:
+            version = cursor.execute("PRAGMA data_version").fetchone()[0]
+        finally:
+            cursor.close()
+        changed = version != self._data_version
+        self._data_version = version
+        return changed
+
+    def poll(self) -> int:
+        self.polls += 1
+        if not self._changed() and not self._failed:
+            return 0
+        with Session(self.engine) as session:
+            if self._failed:
+                # Events may have been missed while the database was unreachable
+                self._reset(session)
+                return 0
+            rows = session.execute(
+                select(CacheEvent.id, CacheEvent.origin, CacheEvent.payload, CacheEvent.created)
+                .where(CacheEvent.id > self.last_id).order_by(CacheEvent.id).limit(POLL_BATCH)
+            ).all()
+            late = self._late(session) if self.overlap else []
+            if not rows and not late:
+                return 0
+            if len(rows) == POLL_BATCH:
+                # Still more to read: look again on the next tick
+                self._data_version = None
+            merged = {"tables": set(), "users": set(), "roles": set(), "tokens": set(), "catalog": False}
+            now = time.time()
+            for event_id, origin, payload, created in late + rows:
+                if self.overlap:
+                    self._seen[event_id] = created
+                if origin == self.origin:
+                    continue
+                event = json.loads(payload)
+                for key in ("tables", "users", "roles", "tokens"):
+                    merged[key].update(event.get(key, ()))
+                merged["catalog"] |= event.get("catalog", False)
+                self.applied += 1
+                self.last_lag = now - created
+                self.max_lag = max(self.max_lag, self.last_lag)
+            self.events += len(late) + len(rows)
+            self.apply(session, merged)
+            if rows:
+                self.last_id = rows[-1][0]
+        return len(late) + len(rows)
+
+    # Events below the cursor that were not there when it passed them; created
+    # is set at publish time, so a transaction open longer than the overlap is
+    # still missed
+    def _late(self, session: Session) -> list:
+        cutoff = time.time() - self.overlap
+        self._seen = {event_id: created for event_id, created in self._seen.items() if created >= cutoff}
+        rows = session.execute(
+            select(CacheEvent.id, CacheEvent.origin, CacheEvent.payload, CacheEvent.created)
+            .where(CacheEvent.id <= self.last_id, CacheEvent.created >= cutoff).order_by(CacheEvent.id)
+        ).all()
+        return [row for row in rows if row[0] not in self._seen]
+
+    # Catalog and templates first so refreshed users are computed against them;
+    # table versions last so rebuilt responses see the patched index
+    def apply(self, session: Session, changes: dict):
+        if changes["catalog"]:
+            rbac_index.refresh_catalog(session)
+        for role_id in changes["roles"]:
+            rbac_index.refresh_role(session, role_id)
+        if changes["users"]:
+            rbac_index.refresh_users(session, changes["users"])
+        for user_id in changes["users"] | changes["tokens"]:
+            token_versions.forget(user_id)
+        if changes["tables"]:
+            table_versions.bump(*changes["tables"])
+
+    def _reset(self, session: Session):
+        self.last_id = session.execute(select(func.max(CacheEvent.id))).scalar() or 0
+        rbac_index.invalidate()
+        token_versions.clear()
+        # New epoch: cached bodies and every ETag handed out so far stop matching
+        table_versions.reset()
+        response_cache.clear()
+        self.resets += 1
+        self._failed = False
+
+    # Keeps the newest event however old: SQLite hands out max(id) + 1 without
+    # AUTOINCREMENT, so an emptied table would restart ids below every cursor
+    def prune(self, session: Session, retention: int = INVALIDATION_RETENTION) -> int:
+        newest = session.execute(select(func.max(CacheEvent.id))).scalar()
+        if newest is None:
+            return 0
+        pruned = session.execute(
+            delete(CacheEvent).where(CacheEvent.created < time.time() - retention, CacheEvent.id < newest)
+        ).rowcount
+        session.commit()
+        return pruned
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "running": self._thread is not None,
+            "origin": self.origin,
+            "last_id": self.last_id,
+            "poll_ms": self.interval * 1000,
+            "polls": self.polls,
+            "events": self.events,
+            "applied": self.applied,
+            "errors": self.errors,
+            "resets": self.resets,
+            "last_lag_ms": round(self.last_lag * 1000, 2) if self.last_lag is not None else None,
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+        }
+
+
+invalidation_bus = InvalidationBus(engine)
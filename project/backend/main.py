@@ -1,25 +1,63 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Request, Response, UploadFile, File
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlmodel import Session, select, col
+from sqlmodel import Session, select, col, func
+from sqlalchemy import distinct
 from typing import Optional, List
 from jose import JWTError, jwt
 from datetime import timedelta
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import json
 from fastapi import APIRouter
 
-from database import create_db_and_tables, get_session
-from models import User, UserAnalytics, Role, Permission, UserRolePermission
+from database import create_db_and_tables, get_session, get_async_session, engine, async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from models import User, UserAnalytics, UsageReading, Role, Permission, RolePermission, UserRole, UserRolePermission
 from schemas import (
     UserCreate, UserRead, UserLogin, Token,
     RoleBase, RoleRead, PermissionBase, PermissionRead,
-    UserRolePermissionBase, UserRolePermissionRead, AssignRolePermission
+    UserRolePermissionBase, UserRolePermissionRead, AssignRolePermission, Principal,
+    BulkAssignRolePermissions, BulkAssignResult
 )
-from auth import verify_password, get_password_hash, create_access_token, SECRET_KEY, ALGORITHM
+from auth import (
+    verify_password_async, get_password_hash_async, create_access_token, SECRET_KEY, ALGORITHM,
+    STATELESS_TOKENS, build_token_claims, is_stateless_payload, HashPoolBusy, hash_pool
+)
+from rbac import rbac_index, mask_to_ids
+from tokens import token_versions
+from admin_stats import count_new_admins, read_admin_metrics, refresh_admin_metrics, track_admins
+from timeseries import consumer_history_raw
+from serialization import FastJSONResponse, splice_object
+from rollups import dashboard_stats, dashboard_charts
+from ingest import ingest, IngestError, INGEST_TABLES, publish_ingest
+from export import export_stream, ExportFilters, EXPORT_FORMATS
+from cache import response_cache, table_versions
+from analytics import analytics_cache, trends, distribution, growth, AnalyticsError, DEFAULT_QUANTILES
+from assignments import announce_grant_changes, apply_assignments, missing_users
+from role_templates import set_role_permissions
+from metrics import METRICS_ENABLED, MetricsMiddleware, instrument_engine, render as render_metrics
+import query_budget
+from query_budget import QUERY_BUDGET, QueryBudgetMiddleware, budget
+from scheduler import SCHEDULER_ENABLED, build_scheduler
+from throttle import login_throttle, client_ip, retry_after
+from invalidation import invalidation_bus
+from metrics import LOGIN_ATTEMPTS
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
 
-app = FastAPI()
+scheduler = build_scheduler(engine)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    on_startup()
+    invalidation_bus.start()
+    if SCHEDULER_ENABLED:
+        await scheduler.start()
+    yield
+    await scheduler.stop()
+    invalidation_bus.stop()
+
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -28,39 +66,89 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Read by the browser clients: the /users cursor and cache validators
+    expose_headers=["X-Next-After-Id", "ETag"],
 )
 
-@app.on_event("startup")
+if QUERY_BUDGET in ("warn", "raise"):
+    app.add_middleware(QueryBudgetMiddleware)
+    query_budget.instrument_engine(engine)
+    query_budget.instrument_engine(async_engine.sync_engine)
+
+# Added last so it wraps everything else, CORS included
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    instrument_engine(engine)
+    instrument_engine(async_engine.sync_engine)
+
+@app.exception_handler(HashPoolBusy)
+def hash_pool_busy_handler(request, exc):
+    return JSONResponse(status_code=503, content={"detail": "Authentication service busy, retry shortly"}, headers={"Retry-After": "1"})
+
 def on_startup():
     create_db_and_tables()
+    invalidation_bus.seek_end()
+    with Session(engine) as session:
+        rbac_index.reload(session)
+        # Grants may have been changed by the maintenance scripts while we were down
+        refresh_admin_metrics(session)
+        session.commit()
+
+# Prometheus text exposition, scraped per worker process
+@app.get("/metrics", include_in_schema=False)
+def metrics_endpoint():
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
-# Utility to get current user from token
-def get_current_user(token: str = Depends(oauth2_scheme), session: Session = Depends(get_session)) -> User:
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+def decode_token(token: str) -> dict:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = session.exec(select(User).where(User.username == username)).first()
+    if payload.get("sub") is None:
+        raise credentials_exception
+    return payload
+
+# Utility to get current user from token
+def get_current_user(token: str = Depends(oauth2_scheme), session: Session = Depends(get_session)) -> User:
+    payload = decode_token(token)
+    user = session.exec(select(User).where(User.username == payload["sub"])).first()
     if user is None:
         raise credentials_exception
     return user
 
+# Identity and permissions only. Stateless tokens skip the user lookup: identity
+# comes from the claims plus a cached token-version check, roles and permissions
+# from the RBAC index so role template edits apply without reissuing tokens.
+# Older tokens fall back to a user lookup.
+async def get_current_principal(token: str = Depends(oauth2_scheme), session: AsyncSession = Depends(get_async_session)) -> Principal:
+    payload = decode_token(token)
+    await rbac_index.aensure_loaded(session)
+    if is_stateless_payload(payload):
+        if await token_versions.aget(session, payload["uid"]) != payload["ver"]:
+            raise credentials_exception
+        uid = payload["uid"]
+        return Principal(id=uid, username=payload["sub"], roles=rbac_index.roles_of(uid), permission_mask=rbac_index.mask_of(uid))
+    user = (await session.exec(select(User).where(User.username == payload["sub"]))).first()
+    if user is None:
+        raise credentials_exception
+    return Principal(id=user.id, username=user.username, roles=rbac_index.roles_of(user.id), permission_mask=rbac_index.mask_of(user.id))
+
 @app.post("/auth/register", response_model=UserRead)
-def register(user: UserCreate, session: Session = Depends(get_session)):
-    db_user = session.exec(select(User).where((User.username == user.username) | (User.email == user.email))).first()
+async def register(user: UserCreate, session: AsyncSession = Depends(get_async_session)):
+    db_user = (await session.exec(select(User).where((User.username == user.username) | (User.email == user.email)))).first()
     if db_user:
         raise HTTPException(status_code=400, detail="Username or email already registered")
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash_async(user.password)
     new_user = User(
         username=user.username,
         email=user.email,
@@ -70,19 +158,34 @@ def register(user: UserCreate, session: Session = Depends(get_session)):
         avatar=user.avatar
     )
     session.add(new_user)
-    session.commit()
-    session.refresh(new_user)
+    invalidation_bus.publish(session, tables=[User.__tablename__])
+    await session.commit()
+    await session.refresh(new_user)
+    table_versions.bump(User.__tablename__)
     return new_user
 
+# Throttled before the user lookup so rejected attempts cost neither SQL nor bcrypt
 @app.post("/auth/login", response_model=Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), session: Session = Depends(get_session)):
-    user = session.exec(select(User).where(User.username == form_data.username)).first()
-    if not user or not verify_password(form_data.password, user.password_hash):
+async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), session: AsyncSession = Depends(get_async_session)):
+    wait = await login_throttle.acheck(client_ip(request), form_data.username)
+    if wait:
+        LOGIN_ATTEMPTS.inc(("throttled",))
+        raise HTTPException(status_code=429, detail="Too many login attempts, retry later", headers={"Retry-After": retry_after(wait)})
+    user = (await session.exec(select(User).where(User.username == form_data.username))).first()
+    if not user or not await verify_password_async(form_data.password, user.password_hash):
+        LOGIN_ATTEMPTS.inc(("failure",))
         raise HTTPException(status_code=400, detail="Incorrect username or password")
-    access_token = create_access_token(data={"sub": user.username}, expires_delta=timedelta(minutes=60))
+    LOGIN_ATTEMPTS.inc(("success",))
+    await login_throttle.asucceeded(form_data.username)
+    data = {"sub": user.username}
+    if STATELESS_TOKENS:
+        token_versions.forget(user.id)
+        data = build_token_claims(user.id, user.username, await token_versions.aget(session, user.id))
+    access_token = create_access_token(data=data, expires_delta=timedelta(minutes=60))
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/users/me", response_model=UserRead)
+@budget(1)
 def read_users_me(current_user: User = Depends(get_current_user)):
     return current_user
 
@@ -92,23 +195,31 @@ def update_profile(update: UserCreate, current_user: User = Depends(get_current_
     current_user.bio = update.bio
     current_user.avatar = update.avatar
     session.add(current_user)
+    invalidation_bus.publish(session, tables=[User.__tablename__])
     session.commit()
     session.refresh(current_user)
+    table_versions.bump(User.__tablename__)
     return current_user
 
 @app.put("/users/me/password")
-def update_password(password: str, current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
-    current_user.password_hash = get_password_hash(password)
-    session.add(current_user)
-    session.commit()
+async def update_password(password: str, current_user: Principal = Depends(get_current_principal), session: AsyncSession = Depends(get_async_session)):
+    user = await session.get(User, current_user.id)
+    if user is None:
+        raise credentials_exception
+    user.password_hash = await get_password_hash_async(password)
+    session.add(user)
+    await token_versions.abump(session, user.id)
+    invalidation_bus.publish(session, tokens=[user.id])
+    await session.commit()
     return {"msg": "Password updated successfully"}
 
 @app.get("/users/number/{number}")
-def get_user_by_number(number: str, session: Session = Depends(get_session)):
-    analytics = session.exec(select(UserAnalytics).where(UserAnalytics.number == number)).first()
+@budget(6)
+async def get_user_by_number(number: str, months: Optional[int] = Query(None, ge=1), session: AsyncSession = Depends(get_async_session)):
+    analytics = (await session.exec(select(UserAnalytics).where(UserAnalytics.number == number))).first()
     if not analytics:
         raise HTTPException(status_code=404, detail="User not found")
-    return JSONResponse(content={
+    profile = {
         "name": analytics.name,
         "number": analytics.number,
         "email": analytics.email,
@@ -117,11 +228,136 @@ def get_user_by_number(number: str, session: Session = Depends(get_session)):
         "segment": analytics.segment,
         "phase": analytics.phase,
         "createdAt": analytics.createdAt,
-        "usage_history": json.loads(analytics.usage_history) if analytics.usage_history else [],
-        "payment_history": json.loads(analytics.payment_history) if analytics.payment_history else [],
-        "alert_history": json.loads(analytics.alert_history) if analytics.alert_history else [],
-        "recent_activity": json.loads(analytics.recent_activity) if analytics.recent_activity else [],
-    })
+    }
+    history = await session.run_sync(consumer_history_raw, analytics, months)
+    return Response(content=splice_object(profile, history), media_type="application/json")
+
+# Served from the rollup tables maintained by rollups.py
+@app.get("/dashboard/stats")
+@budget(1)
+def get_dashboard_stats(session: Session = Depends(get_session)):
+    return dashboard_stats(session)
+
+@app.get("/dashboard/charts")
+@budget(4)
+def get_dashboard_charts(session: Session = Depends(get_session)):
+    return dashboard_charts(session)
+
+# Usage analytics from the in-memory consumers x months cube (analytics.py);
+# results are memoized per data version
+def run_analytics(session: Session, current_user: Principal, fn, **params):
+    if not has_permission(current_user, "analytics_dashboard", session):
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    try:
+        return analytics_cache.run(session, fn, **params)
+    except AnalyticsError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def parse_quantiles(quantiles: Optional[str]):
+    if not quantiles:
+        return DEFAULT_QUANTILES
+    try:
+        return tuple(float(q) for q in quantiles.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="quantiles must be comma-separated numbers")
+
+# Two statements with the cube loaded; a request that finds it unloaded (the
+# first one after startup, before the warmup job) also loads it
+@app.get("/analytics/trends")
+@budget(4, margin=2)
+def analytics_trends(
+    group_by: Optional[str] = None,
+    region: Optional[str] = None,
+    segment: Optional[str] = None,
+    phase: Optional[str] = None,
+    period_from: Optional[str] = None,
+    period_to: Optional[str] = None,
+    current_user: Principal = Depends(get_current_principal),
+    session: Session = Depends(get_session),
+):
+    filters = {"region": region, "segment": segment, "phase": phase}
+    return run_analytics(session, current_user, trends, group_by=group_by, filters=filters,
+                         period_from=period_from, period_to=period_to)
+
+@app.get("/analytics/distribution")
+@budget(4, margin=2)
+def analytics_distribution(
+    group_by: Optional[str] = None,
+    region: Optional[str] = None,
+    segment: Optional[str] = None,
+    phase: Optional[str] = None,
+    period: Optional[str] = None,
+    quantiles: Optional[str] = Query(None, description="comma-separated, e.g. 0.5,0.9"),
+    current_user: Principal = Depends(get_current_principal),
+    session: Session = Depends(get_session),
+):
+    filters = {"region": region, "segment": segment, "phase": phase}
+    return run_analytics(session, current_user, distribution, group_by=group_by, filters=filters,
+                         period=period, quantiles=parse_quantiles(quantiles))
+
+@app.get("/analytics/growth")
+@budget(4, margin=2)
+def analytics_growth(
+    group_by: Optional[str] = None,
+    region: Optional[str] = None,
+    segment: Optional[str] = None,
+    phase: Optional[str] = None,
+    start: Optional[str] = Query(None, description="YYYY-MM, default 12 months before end"),
+    end: Optional[str] = Query(None, description="YYYY-MM, default latest"),
+    quantiles: Optional[str] = None,
+    current_user: Principal = Depends(get_current_principal),
+    session: Session = Depends(get_session),
+):
+    filters = {"region": region, "segment": segment, "phase": phase}
+    return run_analytics(session, current_user, growth, group_by=group_by, filters=filters,
+                         start=start, end=end, quantiles=parse_quantiles(quantiles))
+
+def _ingested(session: Session):
+    publish_ingest(session)
+    table_versions.bump(*INGEST_TABLES)
+
+# Bulk upsert of consumer records or monthly readings from a CSV/NDJSON upload
+@app.post("/ingest")
+def ingest_upload(kind: str, file: UploadFile = File(...), format: Optional[str] = None, current_user: Principal = Depends(get_current_principal), session: Session = Depends(get_session)):
+    if not has_permission(current_user, "admin_management", session):
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    fmt = format or ("ndjson" if (file.filename or "").endswith((".ndjson", ".jsonl")) else "csv")
+    try:
+        result = ingest(session, file.file, kind, fmt)
+    except IngestError as e:
+        # Batches committed before the bad line stay, so the caches must still drop them
+        session.rollback()
+        _ingested(session)
+        raise HTTPException(status_code=400, detail=str(e))
+    _ingested(session)
+    return result
+
+@app.get("/export/consumers")
+def export_consumers(
+    format: str = "csv",
+    region: Optional[str] = None,
+    segment: Optional[str] = None,
+    created_from: Optional[str] = None,
+    created_to: Optional[str] = None,
+    period_from: Optional[str] = None,
+    period_to: Optional[str] = None,
+    gzip: bool = False,
+    current_user: Principal = Depends(get_current_principal),
+    session: Session = Depends(get_session),
+):
+    if not has_permission(current_user, "analytics_dashboard", session):
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    filters = ExportFilters(region, segment, created_from, created_to, period_from, period_to)
+    # The generator opens its own session: request dependencies are closed before the body streams
+    filename = f"consumers.{format}" + (".gz" if gzip else "")
+    media_type = "application/gzip" if gzip else ("text/csv" if format == "csv" else "application/x-ndjson")
+    return StreamingResponse(
+        export_stream(engine, format, filters, compress=gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 admin_router = APIRouter(prefix="/admin", tags=["admin"])
 
@@ -139,80 +375,67 @@ class AdminUserOut(BaseModel):
         orm_mode = True
 
 @app.get("/me/permissions")
-def get_me_permissions(current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
-    urps = session.exec(select(UserRolePermission).where(UserRolePermission.user_id == current_user.id)).all()
-    role_ids = set([urp.role_id for urp in urps if urp.role_id])
-    permission_ids = set([urp.permission_id for urp in urps if urp.permission_id])
-    roles = []
-    if role_ids:
-        roles = [r.name for r in session.exec(select(Role).where(Role.id.in_(role_ids))).all()]
-    permissions = []
-    if permission_ids:
-        permissions = [p.view_name for p in session.exec(select(Permission).where(Permission.id.in_(permission_ids))).all()]
-    return {"roles": roles, "permissions": permissions}
+@budget(1)
+async def get_me_permissions(current_user: Principal = Depends(get_current_principal)):
+    return {"roles": current_user.roles, "permissions": rbac_index.mask_to_names(current_user.permission_mask)}
 
 # Utility to check if user has a permission
-from fastapi import Request
 
-def has_permission(user: User, permission: str, session: Session) -> bool:
-    urps = session.exec(select(UserRolePermission).where(UserRolePermission.user_id == user.id)).all()
-    permission_ids = [urp.permission_id for urp in urps if urp.permission_id]
-    if not permission_ids:
-        return False
-    permissions = session.exec(select(Permission).where(Permission.id.in_(permission_ids))).all()
-    return permission in [p.view_name for p in permissions]
+# get_current_principal has already loaded the RBAC index; pass a session to be sure
+def has_permission(user: Principal, permission: str, session: Optional[Session] = None) -> bool:
+    if session is not None:
+        rbac_index.ensure_loaded(session)
+    pid = rbac_index.permission_ids.get(permission)
+    return pid is not None and bool(user.permission_mask >> pid & 1)
 
 # Update admin endpoints to check for 'admin_access' permission
 @admin_router.get("/", response_model=List[AdminUserOut])
-def list_admins(request: Request, session: Session = Depends(get_session), current_user: User = Depends(get_current_user), role: Optional[str] = None, search: Optional[str] = None):
-    if not has_permission(current_user, "home_dashboard", session):
+@budget(4)
+async def list_admins(request: Request, session: AsyncSession = Depends(get_async_session), current_user: Principal = Depends(get_current_principal), role: Optional[str] = None, search: Optional[str] = None):
+    if not has_permission(current_user, "home_dashboard"):
         raise HTTPException(status_code=403, detail="Not enough permissions")
     # Get role ids for Admin, Sub-Admin, Analyst
     role_names = ["Admin", "Sub-Admin", "Analyst"]
     if role:
         role_names = [role]
-    role_objs = session.exec(select(Role).where(Role.name.in_(role_names))).all()
-    role_ids = [r.id for r in role_objs]
-    urps = session.exec(select(UserRolePermission).where(UserRolePermission.role_id.in_(role_ids))).all()
-    user_ids = list(set([urp.user_id for urp in urps]))
-    query = select(User).where(User.id.in_(user_ids))
-    if search:
-        query = query.where((User.username.contains(search)) | (User.email.contains(search)))
-    users = session.exec(query).all()
+    cached = response_cache.lookup(request, [User.__tablename__, UserRole.__tablename__, Role.__tablename__])
+    if cached.response:
+        return cached.response
+    role_objs = (await session.exec(select(Role).where(Role.name.in_(role_names)))).all()
+    role_id_to_name = {r.id: r.name for r in role_objs}
+    memberships = (await session.exec(select(UserRole.user_id, UserRole.role_id).where(UserRole.role_id.in_(list(role_id_to_name))))).all()
     # Map user_id to roles
     user_roles_map = {}
-    for urp in urps:
-        user_roles_map.setdefault(urp.user_id, set()).add(urp.role_id)
-    role_id_to_name = {r.id: r.name for r in role_objs}
+    for user_id, role_id in memberships:
+        user_roles_map.setdefault(user_id, []).append(role_id_to_name[role_id])
+    query = select(User.id, User.username, User.email, User.full_name, User.status, User.last_login, User.avatar).where(
+        User.id.in_(select(UserRole.user_id).where(UserRole.role_id.in_(list(role_id_to_name))))
+    )
+    if search:
+        query = query.where((User.username.contains(search)) | (User.email.contains(search)))
     result = []
-    for user in users:
-        roles = [role_id_to_name[rid] for rid in user_roles_map.get(user.id, []) if rid in role_id_to_name]
-        result.append(AdminUserOut(
-            id=user.id,
-            username=user.username,
-            email=user.email,
-            full_name=user.full_name,
-            status=user.status,
-            last_login=user.last_login.isoformat() if user.last_login else None,
-            avatar=user.avatar,
-            roles=roles
-        ))
-    return result
+    for row in (await session.execute(query)).mappings():
+        admin = dict(row)
+        admin["last_login"] = admin["last_login"].isoformat() if admin["last_login"] else None
+        admin["roles"] = user_roles_map.get(admin["id"], [])
+        result.append(admin)
+    return response_cache.store(cached, result)
 
 @admin_router.post("/", response_model=UserRead)
-def create_admin(user: UserCreate, session: Session = Depends(get_session), current_user: User = Depends(get_current_user)):
+@budget(10, margin=2)
+async def create_admin(user: UserCreate, session: AsyncSession = Depends(get_async_session), current_user: Principal = Depends(get_current_principal)):
     # Only Super-Admin can create Admins
-    urps = session.exec(select(UserRolePermission).where(UserRolePermission.user_id == current_user.id)).all()
-    role_ids = set([urp.role_id for urp in urps if urp.role_id])
-    roles = []
-    if role_ids:
-        roles = [r.name for r in session.exec(select(Role).where(Role.id.in_(role_ids))).all()]
-    if "Super-Admin" not in roles:
+    if "Super-Admin" not in current_user.roles:
         raise HTTPException(status_code=403, detail="Only Super-Admin can create Admins")
-    db_user = session.exec(select(User).where((User.username == user.username) | (User.email == user.email))).first()
+    # Role membership (default to Admin if not provided); permissions come from the role template
+    role_name = user.status if user.status in ["Admin", "Sub-Admin", "Analyst"] else "Admin"
+    role_id = rbac_index.role_ids.get(role_name)
+    if role_id is None:
+        raise HTTPException(status_code=400, detail="Role not found")
+    db_user = (await session.exec(select(User).where((User.username == user.username) | (User.email == user.email)))).first()
     if db_user:
         raise HTTPException(status_code=400, detail="Username or email already registered")
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash_async(user.password)
     new_user = User(
         username=user.username,
         email=user.email,
@@ -223,28 +446,17 @@ def create_admin(user: UserCreate, session: Session = Depends(get_session), curr
         status=user.status
     )
     session.add(new_user)
-    session.commit()
-    session.refresh(new_user)
-    # Assign role via UserRolePermission (default to Admin if not provided)
-    role_name = user.status if user.status in ["Admin", "Sub-Admin", "Analyst"] else "Admin"
-    if role_name == "Admin" and "Super-Admin" not in roles:
-        raise HTTPException(status_code=403, detail="Only Super-Admin can assign Admin role")
-    role = session.exec(select(Role).where(Role.name == role_name)).first()
-    if not role:
-        raise HTTPException(status_code=400, detail="Role not found")
-    # Assign all default permissions for Admin
-    from init_roles_permissions import role_permissions
-    perm_names = role_permissions[role_name]
-    for perm_name in perm_names:
-        perm = session.exec(select(Permission).where(Permission.view_name == perm_name)).first()
-        if perm:
-            urp = UserRolePermission(user_id=new_user.id, role_id=role.id, permission_id=perm.id)
-            session.add(urp)
-    session.commit()
+    await session.flush()
+    session.add(UserRole(user_id=new_user.id, role_id=role_id))
+    await session.run_sync(count_new_admins, [new_user.id])
+    invalidation_bus.publish(session, tables=[User.__tablename__, UserRole.__tablename__], users=[new_user.id])
+    await session.commit()
+    await session.run_sync(rbac_index.refresh_user, new_user.id)
+    table_versions.bump(User.__tablename__, UserRole.__tablename__)
     return new_user
 
 @admin_router.put("/{admin_id}", response_model=UserRead)
-def update_admin(admin_id: int, update: UserCreate, current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
+def update_admin(admin_id: int, update: UserCreate, current_user: Principal = Depends(get_current_principal), session: Session = Depends(get_session)):
     if not has_permission(current_user, "home_dashboard", session):
         raise HTTPException(status_code=403, detail="Not enough permissions")
     admin = session.get(User, admin_id)
@@ -253,149 +465,308 @@ def update_admin(admin_id: int, update: UserCreate, current_user: User = Depends
     admin.full_name = update.full_name
     admin.bio = update.bio
     admin.avatar = update.avatar
-    admin.role = update.role
-    admin.status = update.status
-    session.add(admin)
+    # Roles change through /user-role-permissions; status counts towards active admins
+    with track_admins(session, [admin.id]):
+        admin.status = update.status
+        session.add(admin)
+    token_versions.bump(session, admin.id)
+    invalidation_bus.publish(session, tables=[User.__tablename__], tokens=[admin.id])
     session.commit()
     session.refresh(admin)
+    table_versions.bump(User.__tablename__)
     return admin
 
 @admin_router.delete("/{admin_id}")
-def delete_admin(admin_id: str, current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
+def delete_admin(admin_id: str, current_user: Principal = Depends(get_current_principal), session: Session = Depends(get_session)):
     if not has_permission(current_user, "home_dashboard", session):
         raise HTTPException(status_code=403, detail="Not enough permissions")
     admin = session.get(User, admin_id)
     if not admin:
         raise HTTPException(status_code=404, detail="Admin not found")
-    session.delete(admin)
+    admin_user_id = admin.id
+    with track_admins(session, [admin_user_id]):
+        session.delete(admin)
+    token_versions.bump(session, admin_user_id)
+    invalidation_bus.publish(session, tables=[User.__tablename__, UserRole.__tablename__, UserRolePermission.__tablename__],
+                             users=[admin_user_id])
     session.commit()
+    rbac_index.drop_user(admin_user_id)
+    table_versions.bump(User.__tablename__, UserRole.__tablename__, UserRolePermission.__tablename__)
     return {"msg": "Admin deleted"}
 
 @admin_router.patch("/{admin_id}/status")
-def toggle_admin_status(admin_id: int, current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
+def toggle_admin_status(admin_id: int, current_user: Principal = Depends(get_current_principal), session: Session = Depends(get_session)):
     if not has_permission(current_user, "home_dashboard", session):
         raise HTTPException(status_code=403, detail="Not enough permissions")
     admin = session.get(User, admin_id)
     if not admin:
         raise HTTPException(status_code=404, detail="Admin not found")
-    admin.status = "Inactive" if admin.status == "Active" else "Active"
-    session.add(admin)
+    with track_admins(session, [admin.id]):
+        admin.status = "Inactive" if admin.status == "Active" else "Active"
+        session.add(admin)
+    token_versions.bump(session, admin.id)
+    invalidation_bus.publish(session, tables=[User.__tablename__], tokens=[admin.id])
     session.commit()
     session.refresh(admin)
+    table_versions.bump(User.__tablename__)
     return admin
 
+@admin_router.get("/hash-metrics")
+def hash_metrics(current_user: Principal = Depends(get_current_principal), session: Session = Depends(get_session)):
+    if not has_permission(current_user, "home_dashboard", session):
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return hash_pool.metrics()
+
 @admin_router.get("/metrics")
-def admin_metrics(session: Session = Depends(get_session)):
-    # Get all roles of interest
-    roles = session.exec(select(Role).where(Role.name.in_(["Admin", "Sub-Admin", "Analyst"]))).all()
-    role_map = {r.name: r.id for r in roles}
-    urps = session.exec(select(UserRolePermission).where(UserRolePermission.role_id.in_(list(role_map.values())))).all()
-    user_role_map = {}
-    for urp in urps:
-        user_role_map.setdefault(urp.role_id, set()).add(urp.user_id)
-    total = len(set([urp.user_id for urp in urps]))
-    active = len(set([urp.user_id for urp in urps if session.get(User, urp.user_id).status == "Active"]))
-    sub_admins = len(user_role_map.get(role_map.get("Sub-Admin"), set()))
-    analysts = len(user_role_map.get(role_map.get("Analyst"), set()))
-    return {"totalAdmins": total, "activeAdmins": active, "subAdmins": sub_admins, "analysts": analysts}
+@budget(1)
+async def admin_metrics(session: AsyncSession = Depends(get_async_session)):
+    # Counters are kept current by the admin write endpoints
+    return await session.run_sync(read_admin_metrics)
+
+@admin_router.get("/login-throttle")
+@budget(1)
+def login_throttle_stats(current_user: Principal = Depends(get_current_principal), session: Session = Depends(get_session)):
+    if not has_permission(current_user, "home_dashboard", session):
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return login_throttle.stats()
+
+@admin_router.get("/invalidation")
+@budget(1)
+def invalidation_stats(current_user: Principal = Depends(get_current_principal), session: Session = Depends(get_session)):
+    if not has_permission(current_user, "home_dashboard", session):
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return invalidation_bus.stats()
+
+# Background job status and run times for this worker; shared jobs may have
+# run in another worker, which shows up as skipped here
+@admin_router.get("/jobs")
+@budget(1)
+def list_jobs(current_user: Principal = Depends(get_current_principal), session: Session = Depends(get_session)):
+    if not has_permission(current_user, "home_dashboard", session):
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return scheduler.status()
+
+# Runs a job now, even if it is not due; wait=false returns 202 straight away
+@admin_router.post("/jobs/{name}/run")
+async def run_job(name: str, wait: bool = True, current_user: Principal = Depends(get_current_principal)):
+    if "Super-Admin" not in current_user.roles:
+        raise HTTPException(status_code=403, detail="Only Super-Admin can run jobs")
+    if name not in scheduler.jobs:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if not wait:
+        scheduler.trigger(name, force=True)
+        return JSONResponse(status_code=202, content={"name": name, "started": True})
+    return await scheduler.run(name, force=True)
 
 app.include_router(admin_router)
 
 @app.post("/roles", response_model=RoleRead)
+@budget(4)
 def create_role(role: RoleBase, session: Session = Depends(get_session)):
     db_role = session.exec(select(Role).where(Role.name == role.name)).first()
     if db_role:
         raise HTTPException(status_code=400, detail="Role already exists")
     new_role = Role(name=role.name)
     session.add(new_role)
+    invalidation_bus.publish(session, tables=[Role.__tablename__], catalog=True)
     session.commit()
     session.refresh(new_role)
+    rbac_index.add_role(new_role)
+    table_versions.bump(Role.__tablename__)
     return new_role
 
 @app.get("/roles", response_model=List[RoleRead])
-def list_roles(session: Session = Depends(get_session)):
-    return session.exec(select(Role)).all()
+@budget(1)
+def list_roles(request: Request, session: Session = Depends(get_session)):
+    cached = response_cache.lookup(request, [Role.__tablename__])
+    if cached.response:
+        return cached.response
+    return response_cache.store(cached, [RoleRead.from_orm(r) for r in session.exec(select(Role)).all()])
 
 @app.post("/permissions", response_model=PermissionRead)
+@budget(4)
 def create_permission(permission: PermissionBase, session: Session = Depends(get_session)):
     db_perm = session.exec(select(Permission).where(Permission.view_name == permission.view_name)).first()
     if db_perm:
         raise HTTPException(status_code=400, detail="Permission already exists")
     new_perm = Permission(view_name=permission.view_name)
     session.add(new_perm)
+    invalidation_bus.publish(session, tables=[Permission.__tablename__], catalog=True)
     session.commit()
     session.refresh(new_perm)
+    rbac_index.add_permission(new_perm)
+    table_versions.bump(Permission.__tablename__)
     return new_perm
 
 @app.get("/permissions", response_model=List[PermissionRead])
-def list_permissions(session: Session = Depends(get_session)):
-    return session.exec(select(Permission)).all()
+@budget(1)
+def list_permissions(request: Request, session: Session = Depends(get_session)):
+    cached = response_cache.lookup(request, [Permission.__tablename__])
+    if cached.response:
+        return cached.response
+    return response_cache.store(cached, [PermissionRead.from_orm(p) for p in session.exec(select(Permission)).all()])
 
 @app.get("/roles/{role_id}/permissions", response_model=List[PermissionRead])
-def get_permissions_for_role(role_id: int, session: Session = Depends(get_session)):
-    urps = session.exec(select(UserRolePermission).where(UserRolePermission.role_id == role_id)).all()
-    permission_ids = [urp.permission_id for urp in urps if urp.permission_id]
-    if not permission_ids:
-        return []
-    permissions = session.exec(select(Permission).where(Permission.id.in_(permission_ids))).all()
-    return permissions
+@budget(1)
+def get_permissions_for_role(role_id: int, request: Request, session: Session = Depends(get_session)):
+    cached = response_cache.lookup(request, [RolePermission.__tablename__, Permission.__tablename__])
+    if cached.response:
+        return cached.response
+    permissions = session.exec(
+        select(Permission).join(RolePermission, RolePermission.permission_id == Permission.id).where(RolePermission.role_id == role_id)
+    ).all()
+    return response_cache.store(cached, [PermissionRead.from_orm(p) for p in permissions])
+
+# Replaces a role's template. Only the template rows change; every holder picks
+# the new permissions up through the RBAC index.
+@app.put("/roles/{role_id}/permissions", response_model=List[PermissionRead])
+@budget(7, margin=2)
+def update_role_permissions(role_id: int, permission_ids: List[int], session: Session = Depends(get_session), current_user: Principal = Depends(get_current_principal)):
+    if "Super-Admin" not in current_user.roles:
+        raise HTTPException(status_code=403, detail="Only Super-Admin can edit roles")
+    if session.get(Role, role_id) is None:
+        raise HTTPException(status_code=404, detail="Role not found")
+    permissions = session.exec(select(Permission).where(Permission.id.in_(permission_ids))).all() if permission_ids else []
+    if len(permissions) != len(set(permission_ids)):
+        raise HTTPException(status_code=400, detail="Unknown permission id")
+    added, removed = set_role_permissions(session, role_id, permission_ids)
+    if added or removed:
+        invalidation_bus.publish(session, tables=[RolePermission.__tablename__], roles=[role_id])
+    # Read before the commit expires them, or each one is reloaded on its own
+    response = [PermissionRead.from_orm(p) for p in permissions]
+    names = [p.view_name for p in permissions]
+    session.commit()
+    if added or removed:
+        rbac_index.ensure_loaded(session)
+        rbac_index.set_role_mask(role_id, rbac_index.names_to_mask(names))
+        table_versions.bump(RolePermission.__tablename__)
+    return response
+
+# Callers may only grant roles they hold, and only permissions they hold through
+# that role. Checked once per request against the in-memory RBAC index.
+def check_grant_rights(current_user: Principal, assignments: List[AssignRolePermission]) -> dict:
+    held = set(rbac_index.role_ids_of(current_user.id))
+    desired = {}
+    for entry in assignments:
+        if entry.role_id not in held:
+            raise HTTPException(status_code=403, detail="You do not have permission to assign this role.")
+        role_mask = rbac_index.mask_of(current_user.id, entry.role_id)
+        if not all(pid > 0 and role_mask >> pid & 1 for pid in entry.permission_ids):
+            raise HTTPException(status_code=403, detail="You do not have permission to assign one or more of these permissions.")
+        key = (entry.user_id, entry.role_id)
+        if key in desired:
+            raise HTTPException(status_code=400, detail=f"Duplicate assignment for user {entry.user_id}, role {entry.role_id}")
+        desired[key] = set(entry.permission_ids)
+    return desired
+
+def save_assignments(session: Session, desired: dict) -> List[dict]:
+    missing = missing_users(session, [user_id for user_id, _ in desired])
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Users not found: {missing[:20]}")
+    changes = apply_assignments(session, desired)
+    changed_users = {c["user_id"] for c in changes}
+    if changed_users:
+        announce_grant_changes(session, changed_users)
+    session.commit()
+    if changed_users:
+        rbac_index.refresh_users(session, changed_users)
+        table_versions.bump(UserRole.__tablename__, UserRolePermission.__tablename__)
+    return changes
 
+# Depends on which of the membership and override writes a change needs
 @app.post("/user-role-permissions", response_model=List[UserRolePermissionRead])
-def assign_role_permissions(data: AssignRolePermission, session: Session = Depends(get_session), current_user: User = Depends(get_current_user)):
-    # Robust: Only allow users to assign roles they have
-    urps = session.exec(select(UserRolePermission).where(UserRolePermission.user_id == current_user.id)).all()
-    current_user_role_ids = set([urp.role_id for urp in urps if urp.role_id])
-    if data.role_id not in current_user_role_ids:
-        raise HTTPException(status_code=403, detail="You do not have permission to assign this role.")
-    # Only allow assigning permissions the current user has for this role
-    current_user_permission_ids = set([urp.permission_id for urp in urps if urp.role_id == data.role_id and urp.permission_id])
-    if not all(pid in current_user_permission_ids for pid in data.permission_ids):
-        raise HTTPException(status_code=403, detail="You do not have permission to assign one or more of these permissions.")
-    # Remove existing assignments for this user/role
-    session.exec(
-        select(UserRolePermission).where(
-            (UserRolePermission.user_id == data.user_id) &
-            (UserRolePermission.role_id == data.role_id)
-        )
-    ).delete()
-    # Assign new permissions
-    new_assignments = []
-    for perm_id in data.permission_ids:
-        urp = UserRolePermission(user_id=data.user_id, role_id=data.role_id, permission_id=perm_id)
-        session.add(urp)
-        new_assignments.append(urp)
-    session.commit()
-    for urp in new_assignments:
-        session.refresh(urp)
-    return new_assignments
+@budget(16, margin=2)
+def assign_role_permissions(data: AssignRolePermission, session: Session = Depends(get_session), current_user: Principal = Depends(get_current_principal)):
+    rbac_index.ensure_loaded(session)
+    save_assignments(session, check_grant_rights(current_user, [data]))
+    return effective_grants(data.user_id, data.role_id)
+
+# Many (user, role, permissions) entries applied in one transaction. Each pair ends
+# up with exactly the listed permissions; the response lists only what changed.
+# At most BULK_ASSIGN_MAX entries (422 past that), so every chunked step is one
+# statement and the budget holds for any valid request.
+@app.post("/user-role-permissions/bulk", response_model=BulkAssignResult)
+@budget(18, margin=2)
+def bulk_assign_role_permissions(data: BulkAssignRolePermissions, session: Session = Depends(get_session), current_user: Principal = Depends(get_current_principal)):
+    rbac_index.ensure_loaded(session)
+    desired = check_grant_rights(current_user, data.assignments)
+    changes = save_assignments(session, desired)
+    return BulkAssignResult(
+        entries=len(desired),
+        changed=len(changes),
+        added=sum(len(c["added"]) for c in changes),
+        removed=sum(len(c["removed"]) for c in changes),
+        changes=changes,
+    )
+
+# Role templates expanded with the user's overrides, one entry per permission
+def effective_grants(user_id: int, role_id: Optional[int] = None) -> List[dict]:
+    role_ids = [role_id] if role_id is not None else rbac_index.role_ids_of(user_id)
+    return [
+        {"user_id": user_id, "role_id": rid, "permission_id": pid}
+        for rid in role_ids for pid in mask_to_ids(rbac_index.mask_of(user_id, rid))
+    ]
 
 @app.get("/user-role-permissions/{user_id}", response_model=List[UserRolePermissionRead])
+@budget(1)
 def get_user_role_permissions(user_id: int, session: Session = Depends(get_session)):
-    return session.exec(select(UserRolePermission).where(UserRolePermission.user_id == user_id)).all()
+    rbac_index.ensure_loaded(session)
+    return effective_grants(user_id)
 
 @app.get("/user-permissions/{user_id}", response_model=List[str])
+@budget(1)
 def get_user_permissions(user_id: int, session: Session = Depends(get_session)):
-    urps = session.exec(select(UserRolePermission).where(UserRolePermission.user_id == user_id)).all()
-    permission_ids = [urp.permission_id for urp in urps]
-    if not permission_ids:
-        return []
-    permissions = session.exec(select(Permission).where(Permission.id.in_(permission_ids))).all()
-    return [perm.view_name for perm in permissions]
+    rbac_index.ensure_loaded(session)
+    return rbac_index.permissions_of(user_id)
+
+USER_LIST_COLUMNS = [c for c in User.__table__.c if c.name != "password_hash"]
+USERS_PAGE_DEFAULT = 200
+USERS_PAGE_MAX = 1000
 
+def distinct_names_agg(session: Session, column):
+    if session.get_bind().dialect.name == "postgresql":
+        return func.string_agg(distinct(column), ",")
+    return func.group_concat(distinct(column))
+
+# One query per page: user rows joined to their distinct role names, paged by id.
+# The id of the last row is returned in X-Next-After-Id when more rows may follow.
 @app.get("/users", response_model=List[UserRead])
-def list_users(session: Session = Depends(get_session)):
-    users = session.exec(select(User).where(User.status == "Active")).all()
+@budget(1)
+async def list_users(
+    request: Request,
+    session: AsyncSession = Depends(get_async_session),
+    after_id: int = 0,
+    limit: int = Query(USERS_PAGE_DEFAULT, ge=1, le=USERS_PAGE_MAX),
+    status_filter: Optional[str] = Query("Active", alias="status"),
+    region: Optional[str] = None,
+    segment: Optional[str] = None,
+    phase: Optional[str] = None,
+):
+    cached = response_cache.lookup(request, [User.__tablename__, UserRole.__tablename__, Role.__tablename__])
+    if cached.response:
+        return cached.response
+    query = (
+        select(*USER_LIST_COLUMNS, distinct_names_agg(session, Role.name).label("roles"))
+        .select_from(User)
+        .outerjoin(UserRole, UserRole.user_id == User.id)
+        .outerjoin(Role, Role.id == UserRole.role_id)
+        .where(User.id > after_id)
+    )
+    if status_filter:
+        query = query.where(User.status == status_filter)
+    if region:
+        query = query.where(User.region == region)
+    if segment:
+        query = query.where(User.segment == segment)
+    if phase:
+        query = query.where(User.phase == phase)
+    rows = (await session.execute(query.group_by(User.id).order_by(User.id).limit(limit))).mappings().all()
     user_list = []
-    for user in users:
-        try:
-            urps = session.exec(select(UserRolePermission).where(UserRolePermission.user_id == user.id)).all()
-            role_ids = [urp.role_id for urp in urps if urp.role_id]
-            roles = [r.name for r in session.exec(select(Role).where(Role.id.in_(role_ids))).all()]
-            user_dict = user.dict() if hasattr(user, 'dict') else dict(user)
-            user_dict['roles'] = roles if roles else []
-            user_list.append(user_dict)
-        except Exception as e:
-            user_dict = user.dict() if hasattr(user, 'dict') else dict(user)
-            user_dict['roles'] = []
-            user_list.append(user_dict)
-    return user_list 
\ No newline at end of file
+    for row in rows:
+        user_dict = dict(row)
+        user_dict["roles"] = row["roles"].split(",") if row["roles"] else []
+        user_list.append(user_dict)
+    headers = {}
+    if len(user_list) == limit:
+        headers["X-Next-After-Id"] = str(user_list[-1]["id"])
+    return response_cache.store(cached, user_list, headers) 
\ No newline at end of file
@@ -0,0 +1,234 @@
+import os
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+
+# Process-local request, SQL, bcrypt and cache metrics in Prometheus text format.
+# Counters and histogram buckets are plain ints bumped without locks: increments
+# happen under the GIL, and an occasional lost update under heavy contention is
+# an acceptable price for keeping the hot path free of locking. With several
+# workers each process reports its own series.
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1").lower() in ("1", "true", "yes")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 1000)
+BCRYPT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0)
+JOB_BUCKETS = (0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Labels = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(v)}" for labels, v in list(self.values.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, labels: Labels = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, value: float, labels: Labels = ()):
+        self.values[labels] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...], labelnames: Labels = ()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        # labels -> per-bucket counts (last slot is +Inf) followed by the sum
+        self.series: Dict[Labels, list] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, series in list(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-1]!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Request latency by route", LATENCY_BUCKETS, ("method", "route", "status"))
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests currently being served")
+REQUEST_STATEMENTS = Histogram("http_request_sql_statements", "SQL statements issued per request", STATEMENT_BUCKETS, ("route",))
+REQUEST_DB_SECONDS = Histogram("http_request_db_seconds", "Time spent executing SQL per request", LATENCY_BUCKETS, ("route",))
+SQL_STATEMENTS = Counter("db_statements_total", "SQL statements executed")
+SQL_SECONDS = Histogram("db_statement_duration_seconds", "SQL statement latency", SQL_LATENCY_BUCKETS)
+BCRYPT_SECONDS = Histogram("bcrypt_hash_seconds", "Time for one hash job through the pool, queue wait included", BCRYPT_BUCKETS)
+JOB_SECONDS = Histogram("scheduler_job_duration_seconds", "Background job run time by outcome", JOB_BUCKETS, ("job", "outcome"))
+LOGIN_ATTEMPTS = Counter("login_attempts_total", "Login attempts by outcome", ("outcome",))
+LOGIN_THROTTLED = Counter("login_throttled_total", "Login attempts rejected by the throttle, by bucket", ("scope",))
+
+METRICS = [REQUEST_SECONDS, REQUESTS_IN_FLIGHT, REQUEST_STATEMENTS, REQUEST_DB_SECONDS, SQL_STATEMENTS, SQL_SECONDS, BCRYPT_SECONDS, JOB_SECONDS,
+           LOGIN_ATTEMPTS, LOGIN_THROTTLED]
+
+# Callables returning (name, type, help, value) samples, evaluated at scrape time
+_collectors: List[Callable[[], Iterable[Tuple[str, str, str, float]]]] = []
+
+
+def register_collector(fn: Callable[[], Iterable[Tuple[str, str, str, float]]]):
+    _collectors.append(fn)
+
+
+def render() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    for collector in _collectors:
+        for name, kind, help, value in collector():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# [statements, seconds] for the request being served; sync endpoints run in the
+# threadpool with a copy of the context, so they update the same list
+_request_sql: ContextVar[Optional[list]] = ContextVar("request_sql", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_metrics_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    SQL_STATEMENTS.inc()
+    SQL_SECONDS.observe(elapsed)
+    stats = _request_sql.get()
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += elapsed
+
+
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+# Plain ASGI middleware: no per-request task or body buffering. Routes are
+# labelled by their template (/users/number/{number}), not the raw path.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = [0, 0.0]
+        token = _request_sql.set(stats)
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS_IN_FLIGHT.dec()
+            _request_sql.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_SECONDS.observe(elapsed, (scope["method"], route, str(status[0])))
+            REQUEST_STATEMENTS.observe(stats[0], (route,))
+            REQUEST_DB_SECONDS.observe(stats[1], (route,))
+
+
+def _hash_pool_samples():
+    from auth import hash_pool
+    pool = hash_pool.metrics()
+    return [
+        ("bcrypt_pool_pending", "gauge", "Hash jobs queued or running", pool["pending"]),
+        ("bcrypt_pool_completed_total", "counter", "Hash jobs completed", pool["completed"]),
+        ("bcrypt_pool_rejected_total", "counter", "Hash jobs rejected because the queue was full", pool["rejected"]),
+        ("bcrypt_pool_workers", "gauge", "Hash pool worker threads", pool["workers"]),
+    ]
+
+
+def _cache_samples():
+    from cache import response_cache
+    stats = response_cache.stats()
+    return [
+        ("response_cache_hits_total", "counter", "Responses served from the cache", stats["hits"]),
+        ("response_cache_not_modified_total", "counter", "304 responses from a matching ETag", stats["not_modified"]),
+        ("response_cache_misses_total", "counter", "Cache lookups that had to build the response", stats["misses"]),
+        ("response_cache_evictions_total", "counter", "Entries evicted to stay under the size limit", stats["evictions"]),
+        ("response_cache_hit_ratio", "gauge", "Hits and 304s over all lookups", stats["hit_ratio"]),
+        ("response_cache_bytes", "gauge", "Bytes held by cached bodies", stats["bytes"]),
+    ]
+
+
+def _invalidation_samples():
+    from invalidation import invalidation_bus
+    stats = invalidation_bus.stats()
+    return [
+        ("invalidation_events_total", "counter", "Invalidation events read from the bus", stats["events"]),
+        ("invalidation_applied_total", "counter", "Events from other workers applied to local caches", stats["applied"]),
+        ("invalidation_poll_errors_total", "counter", "Failed polls of the invalidation bus", stats["errors"]),
+        ("invalidation_lag_seconds", "gauge", "Commit-to-apply delay of the last applied event", (stats["last_lag_ms"] or 0) / 1000),
+    ]
+
+
+register_collector(_hash_pool_samples)
+register_collector(_cache_samples)
+register_collector(_invalidation_samples)
@@ -1,4 +1,5 @@
 from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Index, true
 from typing import Optional, List
 from datetime import datetime
 
@@ -11,17 +12,18 @@ class User(SQLModel, table=True):
     bio: Optional[str] = None
     avatar: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
-    status: Optional[str] = "Active"  # 'Active' or 'Inactive'
+    status: Optional[str] = Field(default="Active", index=True)  # 'Active' or 'Inactive'
     last_login: Optional[datetime] = None
-    region: Optional[str] = None
-    segment: Optional[str] = None
-    phase: Optional[str] = None
+    region: Optional[str] = Field(default=None, index=True)
+    segment: Optional[str] = Field(default=None, index=True)
+    phase: Optional[str] = Field(default=None, index=True)
     usage_history: Optional[str] = None  # JSON string
     payment_history: Optional[str] = None  # JSON string
     alert_history: Optional[str] = None  # JSON string
     recent_activity: Optional[str] = None  # JSON string
     # Relationships
     user_role_permissions: List["UserRolePermission"] = Relationship(back_populates="user", sa_relationship_kwargs={"cascade": "all, delete"})
+    user_roles: List["UserRole"] = Relationship(sa_relationship_kwargs={"cascade": "all, delete"})
 
 class Role(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -35,11 +37,23 @@ class Permission(SQLModel, table=True):
     # Relationships
     user_role_permissions: List["UserRolePermission"] = Relationship(back_populates="permission")
 
+# Role -> permission templates. A user gets a role's permissions through a
+# UserRole membership row; UserRolePermission only holds per-user overrides.
+class RolePermission(SQLModel, table=True):
+    role_id: int = Field(foreign_key="role.id", primary_key=True)
+    permission_id: int = Field(foreign_key="permission.id", primary_key=True)
+
+class UserRole(SQLModel, table=True):
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    role_id: int = Field(foreign_key="role.id", primary_key=True, index=True)
+
 class UserRolePermission(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    user_id: int = Field(foreign_key="user.id")
-    role_id: int = Field(foreign_key="role.id")
+    user_id: int = Field(foreign_key="user.id", index=True)
+    role_id: int = Field(foreign_key="role.id", index=True)
     permission_id: int = Field(foreign_key="permission.id")
+    # False revokes a template permission for this user instead of adding one
+    granted: bool = Field(default=True, sa_column_kwargs={"server_default": true()})
     # Relationships
     user: Optional[User] = Relationship(back_populates="user_role_permissions")
     role: Optional[Role] = Relationship(back_populates="user_role_permissions")
@@ -58,4 +72,107 @@ class UserAnalytics(SQLModel, table=True):
     usage_history: str  # JSON string
     payment_history: str  # JSON string
     alert_history: str  # JSON string
-    recent_activity: str  # JSON string 
\ No newline at end of file
+    recent_activity: str  # JSON string
+
+class UserTokenVersion(SQLModel, table=True):
+    # No foreign key: the row outlives a deleted user so old tokens stay revoked
+    user_id: int = Field(primary_key=True)
+    version: int = 0
+
+class AdminMetrics(SQLModel, table=True):
+    # Single-row counters maintained by the admin write endpoints
+    id: Optional[int] = Field(default=1, primary_key=True)
+    total_admins: int = 0
+    active_admins: int = 0
+    sub_admins: int = 0
+    analysts: int = 0
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+# Per-consumer time series normalized out of the UserAnalytics JSON columns.
+# period is "YYYY-MM" for monthly series and "YYYY-MM-DD" for activity events.
+class UsageReading(SQLModel, table=True):
+    __table_args__ = (Index("ix_usagereading_consumer_period", "consumer_number", "period", unique=True),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    consumer_number: int = Field(foreign_key="useranalytics.number")
+    period: str
+    usage: float
+    # Ingest batch that last wrote the row; bumped on upsert so corrections are seen
+    revision: Optional[int] = Field(default=None, index=True)
+
+class PaymentRecord(SQLModel, table=True):
+    __table_args__ = (Index("ix_paymentrecord_consumer_period", "consumer_number", "period", unique=True),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    consumer_number: int = Field(foreign_key="useranalytics.number")
+    period: str
+    paid: int
+
+class AlertRecord(SQLModel, table=True):
+    __table_args__ = (Index("ix_alertrecord_consumer_period", "consumer_number", "period", unique=True),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    consumer_number: int = Field(foreign_key="useranalytics.number")
+    period: str
+    alerts: int
+
+class DetectedAlert(SQLModel, table=True):
+    # Written only by alert_detection.py; ingested AlertRecord counts stay as loaded
+    __table_args__ = (Index("ix_detectedalert_consumer_period", "consumer_number", "period", unique=True),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    consumer_number: int = Field(foreign_key="useranalytics.number")
+    period: str
+    kind: str  # spike, drop or zero
+
+class ActivityEvent(SQLModel, table=True):
+    __table_args__ = (Index("ix_activityevent_consumer_period", "consumer_number", "period"),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    consumer_number: int = Field(foreign_key="useranalytics.number")
+    period: str
+    description: str
+
+# Dashboard aggregates per region x segment x phase, maintained by rollups.py
+class DashboardRollup(SQLModel, table=True):
+    region: str = Field(primary_key=True)
+    segment: str = Field(primary_key=True)
+    phase: str = Field(primary_key=True)
+    total: int = 0
+    active: int = 0
+    inactive: int = 0
+    alert_cases: int = 0
+
+class JobWatermark(SQLModel, table=True):
+    # Progress of incremental batch jobs, e.g. the last UsageReading id or revision scored
+    job: str = Field(primary_key=True)
+    value: int = 0
+    updated_at: Optional[datetime] = None
+
+class JobLease(SQLModel, table=True):
+    # Cross-worker single flight for scheduled jobs: a worker runs a job only
+    # after claiming its row, and next_run keeps the others from repeating it
+    name: str = Field(primary_key=True)
+    owner: Optional[str] = None
+    locked_until: datetime = Field(default_factory=datetime.utcnow)
+    next_run: datetime = Field(default_factory=datetime.utcnow)
+    last_duration: Optional[float] = None
+
+class CacheEvent(SQLModel, table=True):
+    # Invalidation log read by every worker; payload is JSON naming the changed
+    # tables, users, roles and token versions, created a Unix timestamp
+    __table_args__ = {"sqlite_autoincrement": True}
+    id: Optional[int] = Field(default=None, primary_key=True)
+    origin: str
+    payload: str
+    created: float = Field(index=True)
+
+class ThrottleBucket(SQLModel, table=True):
+    # Login token buckets shared by all workers when LOGIN_THROTTLE=db; key is
+    # "ip:<address>" or "user:<name>", updated is a Unix timestamp
+    key: str = Field(primary_key=True)
+    tokens: float
+    updated: float = Field(index=True)
+
+class UsageRollup(SQLModel, table=True):
+    region: str = Field(primary_key=True)
+    segment: str = Field(primary_key=True)
+    phase: str = Field(primary_key=True)
+    period: str = Field(primary_key=True)
+    usage_total: float = 0
+    readings: int = 0
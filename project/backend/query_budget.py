@@ -0,0 +1,127 @@
+import logging
+import os
+import warnings
+from contextlib import ContextDecorator
+from contextvars import ContextVar
+from typing import List, Optional
+
+from sqlalchemy import event
+
+# Statement budgets for dev and test runs. Endpoints declare how many SQL
+# statements one request may issue with @budget(n); with QUERY_BUDGET=warn or
+# raise the middleware checks every request against it, and query_budget()
+# checks any block of code. benchmarks/query_budget.py runs every endpoint at two
+# data scales and also fails when a count grows with the data (N+1 patterns).
+#   QUERY_BUDGET=off | warn | raise   (default off)
+
+QUERY_BUDGET = os.getenv("QUERY_BUDGET", "off").lower()
+
+logger = logging.getLogger("query_budget")
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryCount:
+    def __init__(self):
+        self.count = 0
+        self.statements: List[str] = []
+
+
+# Counters of the enclosing count_queries() blocks, innermost last. Sync
+# endpoints run in the threadpool with a copy of the context, so they see and
+# bump the same counter objects.
+_active: ContextVar[tuple] = ContextVar("query_counters", default=())
+_instrumented = set()
+
+
+def _count(conn, cursor, statement, parameters, context, executemany):
+    for counter in _active.get():
+        counter.count += 1
+        counter.statements.append(statement)
+
+
+def instrument_engine(engine):
+    if id(engine) not in _instrumented:
+        _instrumented.add(id(engine))
+        event.listen(engine, "before_cursor_execute", _count)
+
+
+class count_queries:
+    def __init__(self):
+        self.counter = QueryCount()
+
+    def __enter__(self) -> QueryCount:
+        self._token = _active.set(_active.get() + (self.counter,))
+        return self.counter
+
+    def __exit__(self, *exc):
+        _active.reset(self._token)
+        return False
+
+
+def _report(label: str, counter: QueryCount, limit: int, strict: bool):
+    message = f"{label} issued {counter.count} SQL statements, budget is {limit}"
+    if strict:
+        raise QueryBudgetExceeded(message + "\n  " + "\n  ".join(s.split("\n")[0] for s in counter.statements))
+    warnings.warn(message, stacklevel=3)
+    logger.warning(message)
+
+
+# Context manager / decorator: fails (or warns) when the block issues more than
+# limit statements
+class query_budget(ContextDecorator):
+    def __init__(self, limit: int, label: str = "block", strict: bool = True):
+        self.limit = limit
+        self.label = label
+        self.strict = strict
+        self._counting: Optional[count_queries] = None
+
+    def __enter__(self) -> QueryCount:
+        self._counting = count_queries()
+        return self._counting.__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        self._counting.__exit__(exc_type, exc, tb)
+        counter = self._counting.counter
+        if exc_type is None and counter.count > self.limit:
+            _report(self.label, counter, self.limit, self.strict)
+        return False
+
+
+# Declares an endpoint's budget; applied under the route decorator. Dependencies
+# (session, current user) count towards it. `measured` is the worst case seen by
+# benchmarks/query_budget.py with the RBAC index loaded (it is loaded at startup);
+# routes whose count depends on what the request changes or on a cold cache add
+# a margin on top, so the allowance is measured + margin.
+def budget(measured: int, margin: int = 0):
+    def mark(fn):
+        fn.query_budget = measured + margin
+        fn.query_measured = measured
+        return fn
+    return mark
+
+
+def endpoint_budget(endpoint) -> Optional[int]:
+    return getattr(endpoint, "query_budget", None)
+
+
+# Counts each request and checks it against the matched endpoint's budget once
+# the response has been sent. In raise mode the exception surfaces in
+# TestClient/httpx-driven tests; under a server it is logged.
+class QueryBudgetMiddleware:
+    def __init__(self, app, strict: bool = QUERY_BUDGET == "raise"):
+        self.app = app
+        self.strict = strict
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        with count_queries() as counter:
+            await self.app(scope, receive, send)
+        limit = endpoint_budget(scope.get("endpoint"))
+        if limit is not None and counter.count > limit:
+            route = getattr(scope.get("route"), "path", scope.get("path"))
+            _report(f"{scope['method']} {route}", counter, limit, self.strict)
@@ -0,0 +1,215 @@
+import sys
+from threading import RLock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlmodel import Session, select
+
+from models import Role, Permission, RolePermission, UserRole, UserRolePermission
+
+
+# Process-wide, compiled view of roles, role templates, memberships and overrides.
+# Permissions are stored as bitmasks where bit N is the permission with id N, so
+# a mask means the same thing in every worker process.
+class RBACIndex:
+    def __init__(self):
+        self._lock = RLock()
+        self.loaded = False
+        self.role_names: Dict[int, str] = {}
+        self.role_ids: Dict[str, int] = {}
+        self.permission_names: Dict[int, str] = {}
+        self.permission_ids: Dict[str, int] = {}
+        self.role_masks: Dict[int, int] = {}
+        # user_id -> {role_id -> (granted mask, revoked mask)} for each membership
+        self.user_links: Dict[int, Dict[int, Tuple[int, int]]] = {}
+        # user_id -> {role_id -> effective permission mask through that role}
+        self.user_grants: Dict[int, Dict[int, int]] = {}
+        self.user_masks: Dict[int, int] = {}
+
+    def ensure_loaded(self, session: Session):
+        if not self.loaded:
+            self.reload(session)
+
+    async def aensure_loaded(self, session):
+        if not self.loaded:
+            await session.run_sync(self.reload)
+
+    def reload(self, session: Session):
+        roles = session.exec(select(Role.id, Role.name)).all()
+        perms = session.exec(select(Permission.id, Permission.view_name)).all()
+        role_masks: Dict[int, int] = {}
+        for role_id, permission_id in session.exec(select(RolePermission.role_id, RolePermission.permission_id)).all():
+            role_masks[role_id] = role_masks.get(role_id, 0) | 1 << permission_id
+        links = _links(
+            session.exec(select(UserRole.user_id, UserRole.role_id)).all(),
+            session.exec(select(UserRolePermission.user_id, UserRolePermission.role_id, UserRolePermission.permission_id, UserRolePermission.granted)).all(),
+        )
+        with self._lock:
+            self.role_names = {rid: sys.intern(name) for rid, name in roles}
+            self.role_ids = {name: rid for rid, name in self.role_names.items()}
+            self.permission_names = {pid: sys.intern(name) for pid, name in perms}
+            self.permission_ids = {name: pid for pid, name in self.permission_names.items()}
+            self.role_masks = role_masks
+            self.user_links = {}
+            self.user_grants = {}
+            self.user_masks = {}
+            for user_id, user_links in links.items():
+                self._set_user(user_id, user_links)
+            self.loaded = True
+
+    def invalidate(self):
+        with self._lock:
+            self.loaded = False
+
+    # Incremental patches for the write paths
+    def refresh_user(self, session: Session, user_id: int):
+        self.refresh_users(session, [user_id])
+
+    def refresh_users(self, session: Session, user_ids: Iterable[int]):
+        if not self.loaded:
+            return
+        user_ids = list(set(user_ids))
+        links = {uid: {} for uid in user_ids}
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            links.update(_links(
+                session.exec(select(UserRole.user_id, UserRole.role_id).where(UserRole.user_id.in_(chunk))).all(),
+                session.exec(
+                    select(UserRolePermission.user_id, UserRolePermission.role_id, UserRolePermission.permission_id, UserRolePermission.granted)
+                    .where(UserRolePermission.user_id.in_(chunk))
+                ).all(),
+            ))
+        with self._lock:
+            for user_id, user_links in links.items():
+                self._set_user(user_id, user_links)
+
+    # A template edit only recomputes the masks of the role's holders, in memory
+    def set_role_mask(self, role_id: int, mask: int):
+        with self._lock:
+            self.role_masks[role_id] = mask
+            for user_id, user_links in self.user_links.items():
+                if role_id in user_links:
+                    self._set_user(user_id, user_links)
+
+    # Re-reads one role's template, e.g. after another worker edited it
+    def refresh_role(self, session: Session, role_id: int):
+        if not self.loaded:
+            return
+        mask = 0
+        for permission_id in session.exec(select(RolePermission.permission_id).where(RolePermission.role_id == role_id)).all():
+            mask |= 1 << permission_id
+        self.set_role_mask(role_id, mask)
+
+    # Re-reads role and permission names after another worker added some
+    def refresh_catalog(self, session: Session):
+        if not self.loaded:
+            return
+        roles = session.exec(select(Role.id, Role.name)).all()
+        perms = session.exec(select(Permission.id, Permission.view_name)).all()
+        with self._lock:
+            self.role_names = {rid: sys.intern(name) for rid, name in roles}
+            self.role_ids = {name: rid for rid, name in self.role_names.items()}
+            self.permission_names = {pid: sys.intern(name) for pid, name in perms}
+            self.permission_ids = {name: pid for pid, name in self.permission_names.items()}
+
+    def _set_user(self, user_id: int, user_links: Dict[int, Tuple[int, int]]):
+        if not user_links:
+            self.user_links.pop(user_id, None)
+            self.user_grants.pop(user_id, None)
+            self.user_masks.pop(user_id, None)
+            return
+        grants = {rid: (self.role_masks.get(rid, 0) | granted) & ~revoked for rid, (granted, revoked) in user_links.items()}
+        self.user_links[user_id] = user_links
+        self.user_grants[user_id] = grants
+        self.user_masks[user_id] = _combine(grants)
+
+    def drop_user(self, user_id: int):
+        with self._lock:
+            self._set_user(user_id, {})
+
+    def add_role(self, role: Role):
+        with self._lock:
+            name = sys.intern(role.name)
+            self.role_names[role.id] = name
+            self.role_ids[name] = role.id
+
+    def add_permission(self, permission: Permission):
+        with self._lock:
+            name = sys.intern(permission.view_name)
+            self.permission_names[permission.id] = name
+            self.permission_ids[name] = permission.id
+
+    # Lookups
+    def has_permission(self, user_id: int, permission: str) -> bool:
+        pid = self.permission_ids.get(permission)
+        if pid is None:
+            return False
+        return bool(self.user_masks.get(user_id, 0) >> pid & 1)
+
+    def has_role(self, user_id: int, role: str) -> bool:
+        rid = self.role_ids.get(role)
+        return rid is not None and rid in self.user_grants.get(user_id, {})
+
+    def role_ids_of(self, user_id: int) -> List[int]:
+        return list(self.user_grants.get(user_id, {}))
+
+    def roles_of(self, user_id: int) -> List[str]:
+        return [self.role_names[rid] for rid in self.user_grants.get(user_id, {}) if rid in self.role_names]
+
+    def mask_of(self, user_id: int, role_id: Optional[int] = None) -> int:
+        if role_id is None:
+            return self.user_masks.get(user_id, 0)
+        return self.user_grants.get(user_id, {}).get(role_id, 0)
+
+    def permissions_of(self, user_id: int) -> List[str]:
+        return self.mask_to_names(self.mask_of(user_id))
+
+    def mask_to_names(self, mask: int) -> List[str]:
+        return [name for pid, name in self.permission_names.items() if mask >> pid & 1]
+
+    def names_to_mask(self, names: Iterable[str]) -> int:
+        mask = 0
+        for name in names:
+            pid = self.permission_ids.get(name)
+            if pid is not None:
+                mask |= 1 << pid
+        return mask
+
+
+# {user_id: {role_id: (granted mask, revoked mask)}}; overrides without a
+# membership row are ignored
+def _links(memberships, overrides) -> Dict[int, Dict[int, Tuple[int, int]]]:
+    links: Dict[int, Dict[int, Tuple[int, int]]] = {}
+    for user_id, role_id in memberships:
+        links.setdefault(user_id, {})[role_id] = (0, 0)
+    for user_id, role_id, permission_id, granted in overrides:
+        user_links = links.get(user_id)
+        if not permission_id or user_links is None or role_id not in user_links:
+            continue
+        grant, revoke = user_links[role_id]
+        if granted:
+            grant |= 1 << permission_id
+        else:
+            revoke |= 1 << permission_id
+        user_links[role_id] = (grant, revoke)
+    return links
+
+
+def _combine(grants: Dict[int, int]) -> int:
+    mask = 0
+    for m in grants.values():
+        mask |= m
+    return mask
+
+
+def mask_to_ids(mask: int) -> List[int]:
+    ids = []
+    pid = 0
+    while mask:
+        if mask & 1:
+            ids.append(pid)
+        mask >>= 1
+        pid += 1
+    return ids
+
+
+rbac_index = RBACIndex()
@@ -0,0 +1,108 @@
+import argparse
+import json
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from sqlmodel import Session, select, func
+
+from admin_stats import refresh_admin_metrics
+from models import Role, Permission, UserRole, UserRolePermission
+from assignments import CHUNK, announce_grant_changes, diff_grants, role_templates, write_delta
+from role_templates import set_role_permissions
+
+# Brings roles and grants in line with a role -> permissions mapping (by default
+# init_roles_permissions.role_permissions): the templates of mapped roles are set
+# to the mapping and per-user overrides on those roles are dropped, so every
+# holder ends up with exactly the mapped permissions. Unmapped roles are left
+# alone. Template edits cost one row per changed permission regardless of how
+# many users hold the role; only the delta is written, in one transaction.
+#   python reconcile.py --dry-run
+
+
+def _override_scan(session: Session, role_ids: List[int]):
+    members = set()
+    overrides: Dict = {}
+    rows = session.exec(
+        select(UserRolePermission.id, UserRolePermission.user_id, UserRolePermission.role_id,
+               UserRolePermission.permission_id, UserRolePermission.granted, UserRole.user_id)
+        .outerjoin(UserRole, (UserRole.user_id == UserRolePermission.user_id) & (UserRole.role_id == UserRolePermission.role_id))
+        .where(UserRolePermission.role_id.in_(role_ids))
+    )
+    for row_id, user_id, role_id, permission_id, granted, member in rows:
+        overrides.setdefault((user_id, role_id), {}).setdefault(permission_id, []).append((row_id, bool(granted)))
+        if member is not None:
+            members.add((user_id, role_id))
+    return members, overrides
+
+
+def reconcile(session: Session, mapping: Optional[Dict[str, List[str]]] = None, dry_run: bool = False,
+              batch_size: int = CHUNK, samples: int = 10) -> dict:
+    if mapping is None:
+        from init_roles_permissions import role_permissions as mapping
+    started = time.perf_counter()
+    role_ids = dict(session.exec(select(Role.name, Role.id)).all())
+    permission_ids = dict(session.exec(select(Permission.view_name, Permission.id)).all())
+    targets = {
+        role_ids[name]: {permission_ids[p] for p in perms if p in permission_ids}
+        for name, perms in mapping.items() if name in role_ids
+    }
+    current = role_templates(session, list(targets))
+    template_changes = {}
+    for role_id, wanted in targets.items():
+        have = current.get(role_id, set())
+        if wanted != have:
+            template_changes[role_id] = {"added": sorted(wanted - have), "removed": sorted(have - wanted)}
+    holders = {}
+    if template_changes:
+        holders = dict(session.exec(
+            select(UserRole.role_id, func.count()).where(UserRole.role_id.in_(list(template_changes))).group_by(UserRole.role_id)
+        ).all())
+
+    members, overrides = _override_scan(session, list(targets))
+    desired = {pair: targets[pair[1]] if pair in members else set() for pair in overrides}
+    delta = diff_grants(desired, targets, members, overrides)
+    planned = time.perf_counter()
+    changed_users = {c["user_id"] for c in delta.changes}
+    if not dry_run and (template_changes or not delta.empty):
+        for role_id in template_changes:
+            set_role_permissions(session, role_id, targets[role_id])
+        write_delta(session, delta, batch_size)
+        announce_grant_changes(session, changed_users, template_changes)
+        # Also repairs any drift in the incrementally kept counters
+        refresh_admin_metrics(session)
+        session.commit()
+    finished = time.perf_counter()
+    role_names = {rid: name for name, rid in role_ids.items()}
+    return {
+        "dry_run": dry_run,
+        "template_changes": {
+            role_names[rid]: {**change, "holders": holders.get(rid, 0)} for rid, change in template_changes.items()
+        },
+        "override_pairs": len(overrides),
+        "changed_pairs": len(delta.changes),
+        "changed_users": len(changed_users),
+        "delete_rows": len(delta.stale_ids),
+        "insert_rows": len(delta.new_rows),
+        "changed_by_role": dict(Counter(role_names.get(c["role_id"], c["role_id"]) for c in delta.changes)),
+        "samples": delta.changes[:samples],
+        "plan_seconds": round(planned - started, 3),
+        "apply_seconds": round(finished - planned, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reconcile role templates and user overrides with the role -> permission mapping.")
+    parser.add_argument("--dry-run", action="store_true", help="print the diff without writing")
+    parser.add_argument("--batch-size", type=int, default=CHUNK)
+    parser.add_argument("--samples", type=int, default=10, help="changed pairs to include in the report")
+    args = parser.parse_args(argv)
+
+    from database import engine
+    with Session(engine) as session:
+        report = reconcile(session, dry_run=args.dry_run, batch_size=args.batch_size, samples=args.samples)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
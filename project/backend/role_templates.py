@@ -0,0 +1,91 @@
+from typing import Dict, Iterable, List, Set, Tuple
+
+from sqlalchemy import delete, insert
+from sqlmodel import Session, select
+
+from models import Role, Permission, RolePermission, UserRole, UserRolePermission
+from assignments import CHUNK, diff_grants, role_templates, write_delta
+
+# Role -> permission templates. Editing a role touches only its template rows;
+# holders pick the change up through their UserRole membership.
+
+
+# Replaces one role's template in the caller's transaction; returns (added, removed)
+def set_role_permissions(session: Session, role_id: int, permission_ids: Iterable[int]) -> Tuple[List[int], List[int]]:
+    current = role_templates(session, [role_id]).get(role_id, set())
+    wanted = set(permission_ids)
+    added = sorted(wanted - current)
+    removed = sorted(current - wanted)
+    if removed:
+        session.execute(delete(RolePermission).where(RolePermission.role_id == role_id, RolePermission.permission_id.in_(removed)))
+    if added:
+        session.execute(insert(RolePermission), [{"role_id": role_id, "permission_id": pid} for pid in added])
+    return added, removed
+
+
+# Makes the templates of the mapped roles match a {role name: [permission names]}
+# mapping; roles that are not in the mapping are left alone
+def sync_templates(session: Session, mapping: Dict[str, List[str]]) -> Dict[str, dict]:
+    role_ids = dict(session.exec(select(Role.name, Role.id)).all())
+    permission_ids = dict(session.exec(select(Permission.view_name, Permission.id)).all())
+    changes = {}
+    for name, perms in mapping.items():
+        if name not in role_ids:
+            continue
+        added, removed = set_role_permissions(session, role_ids[name], [permission_ids[p] for p in perms if p in permission_ids])
+        if added or removed:
+            changes[name] = {"added": added, "removed": removed}
+    return changes
+
+
+# The old init script stored each role's permissions as grants to this user id
+PLACEHOLDER_USER_ID = 1
+
+
+# One-shot conversion of the old one-row-per-permission grants. The placeholder
+# rows only ever described role permissions, so they seed the templates of roles
+# that have none and are dropped; they never become memberships. Every other
+# (user, role) pair without a membership row becomes a membership plus overrides
+# for whatever differs from the role template, so effective permissions are
+# unchanged.
+def migrate_grants(session: Session) -> int:
+    legacy = session.exec(
+        select(UserRolePermission.id, UserRolePermission.user_id, UserRolePermission.role_id, UserRolePermission.permission_id)
+        .outerjoin(UserRole, (UserRole.user_id == UserRolePermission.user_id) & (UserRole.role_id == UserRolePermission.role_id))
+        .where(UserRole.user_id.is_(None))
+    ).all()
+    if not legacy:
+        return 0
+    placeholder = [row for row in legacy if row[1] == PLACEHOLDER_USER_ID]
+    legacy = [row for row in legacy if row[1] != PLACEHOLDER_USER_ID]
+    templates = role_templates(session)
+    seeds: Dict[int, Set[int]] = {}
+    for _, _, role_id, permission_id in placeholder:
+        if role_id not in templates and permission_id:
+            seeds.setdefault(role_id, set()).add(permission_id)
+    for role_id, permission_ids in seeds.items():
+        set_role_permissions(session, role_id, permission_ids)
+    ids = [row[0] for row in placeholder]
+    for i in range(0, len(ids), CHUNK):
+        session.execute(delete(UserRolePermission).where(UserRolePermission.id.in_(ids[i:i + CHUNK])))
+    templates = role_templates(session)
+    if not templates:
+        from init_roles_permissions import role_permissions
+        sync_templates(session, role_permissions)
+        templates = role_templates(session)
+    overrides: Dict = {}
+    desired: Dict[Tuple[int, int], Set[int]] = {}
+    for row_id, user_id, role_id, permission_id in legacy:
+        overrides.setdefault((user_id, role_id), {}).setdefault(permission_id, []).append((row_id, True))
+        desired.setdefault((user_id, role_id), set())
+        if permission_id:
+            desired[(user_id, role_id)].add(permission_id)
+    write_delta(session, diff_grants(desired, templates, set(), overrides))
+    session.commit()
+    return len(desired)
+
+
+if __name__ == "__main__":
+    from database import engine
+    with Session(engine) as session:
+        print(f"Migrated {migrate_grants(session)} user/role grants to role templates")
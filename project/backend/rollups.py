@@ -0,0 +1,188 @@
+import sys
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterable, List
+
+from sqlalchemy import case, delete, insert, literal, union
+from sqlmodel import Session, select, func
+
+from models import UserAnalytics, UsageReading, AlertRecord, DetectedAlert, DashboardRollup, UsageRollup
+
+CHUNK = 500
+
+
+def _is_active(status: str) -> bool:
+    return (status or "").lower() == "active"
+
+
+# Full recomputation from UserAnalytics and the series tables
+def rebuild_rollups(session: Session):
+    # A consumer is an alert case with any ingested alert or detected anomaly
+    alerted = union(
+        select(AlertRecord.consumer_number).where(AlertRecord.alerts > 0),
+        select(DetectedAlert.consumer_number),
+    ).subquery()
+    has_alert = select(alerted.c.consumer_number, literal(1).label("flag")).subquery()
+    active = func.lower(UserAnalytics.status) == "active"
+    groups = session.execute(
+        select(
+            UserAnalytics.region,
+            UserAnalytics.segment,
+            UserAnalytics.phase,
+            func.count(),
+            func.sum(case((active, 1), else_=0)),
+            func.sum(case((active, 0), else_=1)),
+            func.coalesce(func.sum(has_alert.c.flag), 0),
+        )
+        .outerjoin(has_alert, has_alert.c.consumer_number == UserAnalytics.number)
+        .group_by(UserAnalytics.region, UserAnalytics.segment, UserAnalytics.phase)
+    ).all()
+    usage = session.execute(
+        select(
+            UserAnalytics.region,
+            UserAnalytics.segment,
+            UserAnalytics.phase,
+            UsageReading.period,
+            func.sum(UsageReading.usage),
+            func.count(),
+        )
+        .join(UsageReading, UsageReading.consumer_number == UserAnalytics.number)
+        .group_by(UserAnalytics.region, UserAnalytics.segment, UserAnalytics.phase, UsageReading.period)
+    ).all()
+    session.execute(delete(DashboardRollup))
+    session.execute(delete(UsageRollup))
+    if groups:
+        session.execute(insert(DashboardRollup), [
+            {"region": r, "segment": s, "phase": p, "total": t, "active": a, "inactive": i, "alert_cases": al}
+            for r, s, p, t, a, i, al in groups
+        ])
+    if usage:
+        session.execute(insert(UsageRollup), [
+            {"region": r, "segment": s, "phase": p, "period": period, "usage_total": u, "readings": n}
+            for r, s, p, period, u, n in usage
+        ])
+    session.commit()
+
+
+def _chunks(items: List[int]) -> Iterable[List[int]]:
+    for i in range(0, len(items), CHUNK):
+        yield items[i:i + CHUNK]
+
+
+# What each consumer currently adds to the rollups
+def contributions(session: Session, numbers: Iterable[int]) -> Dict[int, dict]:
+    numbers = list(numbers)
+    result: Dict[int, dict] = {}
+    for chunk in _chunks(numbers):
+        for number, region, segment, phase, status in session.execute(
+            select(UserAnalytics.number, UserAnalytics.region, UserAnalytics.segment, UserAnalytics.phase, UserAnalytics.status)
+            .where(UserAnalytics.number.in_(chunk))
+        ):
+            result[number] = {"key": (region, segment, phase), "active": _is_active(status), "alert": False, "usage": {}}
+        for (number,) in session.execute(union(
+            select(AlertRecord.consumer_number).where(AlertRecord.consumer_number.in_(chunk), AlertRecord.alerts > 0),
+            select(DetectedAlert.consumer_number).where(DetectedAlert.consumer_number.in_(chunk)),
+        )):
+            if number in result:
+                result[number]["alert"] = True
+        for number, period, value in session.execute(
+            select(UsageReading.consumer_number, UsageReading.period, UsageReading.usage).where(UsageReading.consumer_number.in_(chunk))
+        ):
+            if number in result:
+                result[number]["usage"][period] = value
+    return result
+
+
+def apply_delta(session: Session, before: Dict[int, dict], after: Dict[int, dict]):
+    counts = defaultdict(lambda: [0, 0, 0, 0])
+    usage = defaultdict(lambda: [0.0, 0])
+    for sign, contribs in ((-1, before), (1, after)):
+        for c in contribs.values():
+            row = counts[c["key"]]
+            row[0] += sign
+            row[1 if c["active"] else 2] += sign
+            row[3] += sign if c["alert"] else 0
+            for period, value in c["usage"].items():
+                u = usage[c["key"] + (period,)]
+                u[0] += sign * value
+                u[1] += sign
+    for (region, segment, phase), (total, active, inactive, alerts) in counts.items():
+        if not (total or active or inactive or alerts):
+            continue
+        row = session.get(DashboardRollup, (region, segment, phase)) or DashboardRollup(region=region, segment=segment, phase=phase)
+        row.total += total
+        row.active += active
+        row.inactive += inactive
+        row.alert_cases += alerts
+        if row.total > 0:
+            session.add(row)
+        elif row in session:
+            session.delete(row)
+    for (region, segment, phase, period), (value, readings) in usage.items():
+        if not (value or readings):
+            continue
+        row = session.get(UsageRollup, (region, segment, phase, period)) or UsageRollup(region=region, segment=segment, phase=phase, period=period)
+        row.usage_total += value
+        row.readings += readings
+        if row.readings > 0:
+            session.add(row)
+        elif row in session:
+            session.delete(row)
+
+
+# Wrap writes to UserAnalytics or its series tables; the rollups are adjusted in
+# the same transaction by the difference between the consumers' old and new rows.
+@contextmanager
+def track_consumers(session: Session, numbers: Iterable[int]):
+    numbers = list(numbers)
+    before = contributions(session, numbers)
+    yield
+    session.flush()
+    apply_delta(session, before, contributions(session, numbers))
+
+
+def dashboard_stats(session: Session) -> dict:
+    total, active, inactive, alerts = session.execute(
+        select(
+            func.coalesce(func.sum(DashboardRollup.total), 0),
+            func.coalesce(func.sum(DashboardRollup.active), 0),
+            func.coalesce(func.sum(DashboardRollup.inactive), 0),
+            func.coalesce(func.sum(DashboardRollup.alert_cases), 0),
+        )
+    ).one()
+    return {"totalUsers": total, "activeUsers": active, "inactiveUsers": inactive, "alertCases": alerts}
+
+
+def _breakdown(session: Session, column) -> List[dict]:
+    rows = session.execute(select(column, func.sum(DashboardRollup.total)).group_by(column).order_by(column)).all()
+    total = sum(v for _, v in rows) or 1
+    return [{"name": name, "value": value, "percentage": round(100 * value / total, 1)} for name, value in rows]
+
+
+def dashboard_charts(session: Session) -> dict:
+    monthly = session.execute(
+        select(UsageRollup.period, func.sum(UsageRollup.usage_total), func.sum(UsageRollup.readings))
+        .group_by(UsageRollup.period)
+        .order_by(UsageRollup.period)
+    ).all()
+    return {
+        "regionalData": _breakdown(session, DashboardRollup.region),
+        "segmentData": _breakdown(session, DashboardRollup.segment),
+        "phaseData": _breakdown(session, DashboardRollup.phase),
+        "monthlyUsage": [{"period": p, "usage": u, "readings": n} for p, u, n in monthly],
+    }
+
+
+if __name__ == "__main__":
+    from database import engine
+    from sqlmodel import SQLModel
+    if "--rebuild" not in sys.argv:
+        print("usage: python rollups.py --rebuild")
+        sys.exit(1)
+    from invalidation import invalidation_bus
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        rebuild_rollups(session)
+        invalidation_bus.publish(session, tables=[DashboardRollup.__tablename__, UsageRollup.__tablename__])
+        session.commit()
+        print("Dashboard rollups rebuilt:", dashboard_stats(session))
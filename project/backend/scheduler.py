@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import text, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+from metrics import JOB_SECONDS
+from models import JobLease
+
+# In-process scheduler for maintenance work that should stay off the request
+# path. Jobs are plain sync functions run in the default executor; each one runs
+# on an interval with jitter and can be triggered from the admin API. Shared jobs
+# (rollups, ANALYZE, checkpoints) claim a JobLease row first, so with several
+# uvicorn workers only one of them does the work per interval; per-process jobs
+# (cache warmup, token cache and login throttle pruning) run in every worker.
+# Intervals are in seconds, 0 disables a job:
+#   SCHEDULER_ENABLED=1  JOB_JITTER=0.1
+#   JOB_ROLLUPS_INTERVAL=86400  JOB_CACHE_WARMUP_INTERVAL=300
+#   JOB_WAL_CHECKPOINT_INTERVAL=600  JOB_ANALYZE_INTERVAL=86400
+#   JOB_VACUUM_INTERVAL=0  JOB_TOKEN_CLEANUP_INTERVAL=60
+#   JOB_THROTTLE_CLEANUP_INTERVAL=60  JOB_EVENT_CLEANUP_INTERVAL=600
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "1").lower() in ("1", "true", "yes")
+JOB_JITTER = float(os.getenv("JOB_JITTER", "0.1"))
+
+logger = logging.getLogger("scheduler")
+
+
+def _interval(name: str, default: int) -> int:
+    return int(os.getenv(f"JOB_{name.upper()}_INTERVAL", str(default)))
+
+
+class Job:
+    def __init__(self, name: str, fn: Callable[[Session], Optional[dict]], interval: int, shared: bool = True,
+                 run_at_start: bool = False, lease_seconds: int = 3600):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.shared = shared
+        self.run_at_start = run_at_start
+        # A worker that dies mid-run holds the lease at most this long
+        self.lease_seconds = lease_seconds
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.total_seconds = 0.0
+        self.last_seconds: Optional[float] = None
+        self.last_started: Optional[datetime] = None
+        self.last_finished: Optional[datetime] = None
+        self.last_result: Optional[dict] = None
+        self.last_error: Optional[str] = None
+        self.next_run: Optional[datetime] = None
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "interval": self.interval,
+            "shared": self.shared,
+            "running": self.running,
+            "runs": self.runs,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "last_started": self.last_started,
+            "last_finished": self.last_finished,
+            "last_seconds": round(self.last_seconds, 3) if self.last_seconds is not None else None,
+            "mean_seconds": round(self.total_seconds / self.runs, 3) if self.runs else None,
+            "last_result": self.last_result,
+            "last_error": self.last_error,
+            "next_run": self.next_run,
+        }
+
+
+# Claims the job for this worker: the row must not be locked by a live run and,
+# unless forced, the job must be due. Returns False when another worker has it.
+def acquire_lease(session: Session, job: Job, owner: str, force: bool = False) -> bool:
+    now = datetime.utcnow()
+    conditions = [JobLease.name == job.name, JobLease.locked_until <= now]
+    if not force:
+        conditions.append(JobLease.next_run <= now)
+    claimed = session.execute(
+        update(JobLease).where(*conditions).values(owner=owner, locked_until=now + timedelta(seconds=job.lease_seconds))
+    ).rowcount
+    if not claimed:
+        if session.get(JobLease, job.name) is not None:
+            session.rollback()
+            return False
+        session.add(JobLease(name=job.name, owner=owner, locked_until=now + timedelta(seconds=job.lease_seconds), next_run=now))
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            return False
+        return True
+    session.commit()
+    return True
+
+
+# Unlocks the row; after a success the job is not due again anywhere until the
+# next interval, after a failure any worker may retry at its next tick
+def release_lease(session: Session, job: Job, owner: str, seconds: Optional[float]):
+    now = datetime.utcnow()
+    values = {"owner": None, "locked_until": now}
+    if seconds is not None:
+        values["last_duration"] = seconds
+        values["next_run"] = now + timedelta(seconds=job.interval * (1 - JOB_JITTER))
+    session.execute(update(JobLease).where(JobLease.name == job.name, JobLease.owner == owner).values(**values))
+    session.commit()
+
+
+class Scheduler:
+    def __init__(self, engine, jitter: float = JOB_JITTER):
+        self.engine = engine
+        self.jitter = jitter
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.jobs: Dict[str, Job] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._triggered = set()
+
+    def add(self, job: Job) -> Job:
+        self.jobs[job.name] = job
+        return job
+
+    def _delay(self, job: Job) -> float:
+        return job.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    async def start(self):
+        for job in self.jobs.values():
+            if job.interval > 0:
+                self._tasks.append(asyncio.create_task(self._loop(job), name=f"job:{job.name}"))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _loop(self, job: Job):
+        # Jittered delays keep workers started together from firing in lockstep
+        delay = random.uniform(0, 1) if job.run_at_start else self._delay(job)
+        while True:
+            job.next_run = datetime.utcnow() + timedelta(seconds=delay)
+            await asyncio.sleep(delay)
+            await self.run(job.name)
+            delay = self._delay(job)
+
+    # Runs a job now unless it is already running in this process or, for shared
+    # jobs, in another worker. Returns the job's status and whether it ran.
+    async def run(self, name: str, force: bool = False) -> dict:
+        job = self.jobs[name]
+        if job.running:
+            job.skipped += 1
+            return {**job.status(), "ran": False}
+        job.running = True
+        try:
+            ran = await asyncio.get_running_loop().run_in_executor(None, self._execute, job, force)
+        finally:
+            job.running = False
+        return {**job.status(), "ran": ran}
+
+    # Starts a run without waiting for it; the task is kept referenced until done
+    def trigger(self, name: str, force: bool = False):
+        task = asyncio.create_task(self.run(name, force))
+        self._triggered.add(task)
+        task.add_done_callback(self._triggered.discard)
+
+    def _execute(self, job: Job, force: bool) -> bool:
+        with Session(self.engine) as session:
+            if job.shared and not acquire_lease(session, job, self.owner, force):
+                job.skipped += 1
+                return False
+            job.last_started = datetime.utcnow()
+            started = time.perf_counter()
+            ok = False
+            try:
+                job.last_result = job.fn(session)
+                job.last_error = None
+                ok = True
+            except Exception as exc:
+                session.rollback()
+                job.failures += 1
+                job.last_error = f"{type(exc).__name__}: {exc}"
+                logger.exception("job %s failed", job.name)
+            finally:
+                elapsed = time.perf_counter() - started
+                job.runs += 1
+                job.total_seconds += elapsed
+                job.last_seconds = elapsed
+                job.last_finished = datetime.utcnow()
+                JOB_SECONDS.observe(elapsed, (job.name, "ok" if ok else "error"))
+                if job.shared:
+                    release_lease(session, job, self.owner, elapsed if ok else None)
+        return True
+
+    def status(self) -> List[dict]:
+        return [job.status() for job in self.jobs.values()]
+
+
+def _refresh_rollups(session: Session) -> dict:
+    from rollups import rebuild_rollups
+    from admin_stats import refresh_admin_metrics
+    # Repairs any drift in the incrementally maintained rollups and counters
+    rebuild_rollups(session)
+    refresh_admin_metrics(session)
+    session.commit()
+    return {}
+
+
+def _warm_caches(session: Session) -> dict:
+    from rbac import rbac_index
+    from analytics import analytics_cache
+    rbac_index.ensure_loaded(session)
+    return {"analytics_rebuilt": analytics_cache.warm(session)}
+
+
+def _wal_checkpoint(session: Session) -> dict:
+    busy, log_pages, checkpointed = session.execute(text("PRAGMA wal_checkpoint(TRUNCATE)")).one()
+    return {"busy": bool(busy), "log_pages": log_pages, "checkpointed": checkpointed}
+
+
+def _analyze(session: Session) -> dict:
+    if session.get_bind().dialect.name == "sqlite":
+        # Sampled statistics keep ANALYZE to seconds on large tables
+        session.execute(text("PRAGMA analysis_limit=1000"))
+    session.execute(text("ANALYZE"))
+    session.commit()
+    return {}
+
+
+def _vacuum(session: Session) -> dict:
+    # VACUUM cannot run inside a transaction
+    with session.get_bind().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM"))
+    return {}
+
+
+def _token_cleanup(session: Session) -> dict:
+    from tokens import token_versions
+    return {"pruned": token_versions.prune()}
+
+
+def _throttle_cleanup(session: Session) -> dict:
+    from throttle import login_throttle
+    return {"pruned": login_throttle.prune()}
+
+
+def _event_cleanup(session: Session) -> dict:
+    from invalidation import invalidation_bus
+    return {"pruned": invalidation_bus.prune(session)}
+
+
+def build_scheduler(engine) -> Scheduler:
+    scheduler = Scheduler(engine)
+    sqlite = engine.dialect.name == "sqlite"
+    scheduler.add(Job("rollups", _refresh_rollups, _interval("rollups", 86400)))
+    scheduler.add(Job("cache_warmup", _warm_caches, _interval("cache_warmup", 300), shared=False, run_at_start=True))
+    scheduler.add(Job("wal_checkpoint", _wal_checkpoint, _interval("wal_checkpoint", 600) if sqlite else 0, lease_seconds=300))
+    scheduler.add(Job("analyze", _analyze, _interval("analyze", 86400)))
+    scheduler.add(Job("vacuum", _vacuum, _interval("vacuum", 0)))
+    scheduler.add(Job("token_cleanup", _token_cleanup, _interval("token_cleanup", 60), shared=False))
+    scheduler.add(Job("throttle_cleanup", _throttle_cleanup, _interval("throttle_cleanup", 60), shared=False))
+    scheduler.add(Job("event_cleanup", _event_cleanup, _interval("event_cleanup", 600)))
+    return scheduler
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, conlist
 from typing import Optional, List
 from datetime import datetime
 
@@ -54,7 +54,8 @@ class UserRolePermissionBase(BaseModel):
     permission_id: int
 
 class UserRolePermissionRead(UserRolePermissionBase):
-    id: int
+    # Effective grants expanded from role templates have no row id
+    id: Optional[int] = None
     class Config:
         orm_mode = True
 
@@ -63,10 +64,36 @@ class AssignRolePermission(BaseModel):
     role_id: int
     permission_ids: List[int]
 
+# One chunk of the chunked reads and writes in assignments.py, which is what the
+# endpoint's query budget covers; larger batches go in several requests
+BULK_ASSIGN_MAX = 500
+
+class BulkAssignRolePermissions(BaseModel):
+    assignments: conlist(AssignRolePermission, min_items=1, max_items=BULK_ASSIGN_MAX)
+
+class AssignmentChange(BaseModel):
+    user_id: int
+    role_id: int
+    added: List[int]
+    removed: List[int]
+
+class BulkAssignResult(BaseModel):
+    entries: int
+    changed: int
+    added: int
+    removed: int
+    changes: List[AssignmentChange]
+
 class UserLogin(BaseModel):
     username: str
     password: str
 
 class Token(BaseModel):
     access_token: str
-    token_type: str 
\ No newline at end of file
+    token_type: str
+
+class Principal(BaseModel):
+    id: int
+    username: str
+    roles: List[str] = []
+    permission_mask: int = 0
@@ -0,0 +1,41 @@
+import json
+from typing import Dict
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # stdlib fallback keeps the app working without orjson
+    orjson = None
+
+
+def _default(obj):
+    if hasattr(obj, "dict"):
+        return obj.dict()
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+# Encode obj, then append fields whose values are already-encoded JSON, without
+# decoding them: {"a": 1} + {"b": b"[1,2]"} -> b'{"a":1,"b":[1,2]}'
+def splice_object(obj: dict, raw_fields: Dict[str, bytes]) -> bytes:
+    head = dumps(obj)
+    parts = [head[:-1]]
+    sep = b"," if len(head) > 2 else b""
+    for key, raw in raw_fields.items():
+        parts.append(sep + dumps(key) + b":" + raw)
+        sep = b","
+    parts.append(b"}")
+    return b"".join(parts)
@@ -0,0 +1,41 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The app modules read their configuration at import time, so the environment
+# is set up before any of them is imported: a throwaway SQLite file, cheap
+# bcrypt, no background scheduler and no login throttle unless a test asks.
+# Every request is held to its endpoint's @budget().
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="backend-tests-"), "test.db")
+os.environ["BCRYPT_ROUNDS"] = "4"
+os.environ["SCHEDULER_ENABLED"] = "0"
+os.environ["LOGIN_THROTTLE"] = "off"
+os.environ["DB_ECHO"] = "0"
+os.environ["QUERY_BUDGET"] = "raise"
+
+
+@pytest.fixture(scope="session")
+def seeded():
+    import database
+    from benchmarks.load import seed
+    return seed(database.engine, 60, 60, 6, 7)
+
+
+@pytest.fixture(scope="session")
+def client(seeded):
+    from fastapi.testclient import TestClient
+    import main
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(scope="session")
+def admin_headers(client):
+    from benchmarks.load import ADMIN_USERNAME, BENCH_PASSWORD
+    response = client.post("/auth/login", data={"username": ADMIN_USERNAME, "password": BENCH_PASSWORD})
+    assert response.status_code == 200
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
@@ -0,0 +1,36 @@
+from sqlmodel import Session
+
+import admin_stats
+import database
+
+
+def test_writes_move_the_counters_without_a_recompute(client, admin_headers, seeded, monkeypatch):
+    compute = admin_stats.compute_admin_metrics
+
+    def recompute():
+        with Session(database.engine) as session:
+            return compute(session)
+
+    def forbidden(session):
+        raise AssertionError("full recompute on the write path")
+
+    monkeypatch.setattr(admin_stats, "compute_admin_metrics", forbidden)
+    assert client.get("/admin/metrics").json() == recompute()
+
+    body = {"username": "counted_admin", "email": "counted_admin@example.com", "password": "pw", "status": "Admin"}
+    admin_id = client.post("/admin/", json=body, headers=admin_headers).json()["id"]
+    assert client.get("/admin/metrics").json() == recompute()
+
+    assert client.patch(f"/admin/{admin_id}/status", headers=admin_headers).status_code == 200
+    assert client.get("/admin/metrics").json() == recompute()
+    assert client.put(f"/admin/{admin_id}", json={**body, "status": "Active"}, headers=admin_headers).status_code == 200
+    assert client.get("/admin/metrics").json() == recompute()
+
+    # Joining and leaving a second admin role through the bulk endpoint
+    for perms in (seeded["analyst_perms"], []):
+        entry = {"user_id": admin_id, "role_id": seeded["analyst_role"], "permission_ids": perms}
+        assert client.post("/user-role-permissions/bulk", json={"assignments": [entry]}, headers=admin_headers).status_code == 200
+        assert client.get("/admin/metrics").json() == recompute()
+
+    assert client.delete(f"/admin/{admin_id}", headers=admin_headers).status_code == 200
+    assert client.get("/admin/metrics").json() == recompute()
@@ -0,0 +1,73 @@
+import io
+
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+import database
+from alert_detection import detect
+from ingest import ingest
+from models import AlertRecord, DetectedAlert, UsageReading
+from rollups import dashboard_stats, rebuild_rollups
+
+
+def _alerts(session):
+    return session.exec(select(AlertRecord.consumer_number, AlertRecord.period, AlertRecord.alerts)
+                        .order_by(AlertRecord.consumer_number, AlertRecord.period)).all()
+
+
+def _ingest_reading(session, number, period, usage):
+    stream = io.BytesIO(f"number,period,usage\n{number},{period},{usage}\n".encode())
+    assert ingest(session, stream, "readings", "csv")["written"] == 1
+
+
+def test_detection_keeps_ingested_alerts_and_rescores_corrections(client, seeded):
+    engine = database.engine
+    with Session(engine) as session:
+        before = _alerts(session)
+    assert any(alerts > 1 for _, _, alerts in before)
+
+    first = detect(engine, full=True, workers=1)
+    assert first["mode"] == "full"
+    with Session(engine) as session:
+        assert _alerts(session) == before
+
+    # Nothing changed since: an incremental run finds no consumers to rescore
+    again = detect(engine, workers=1)
+    assert again["mode"] == "incremental"
+    assert again["consumers"] == 0 and again["rows_written"] == 0
+
+    # A correction keeps the reading's id but must still be rescored
+    with Session(engine) as session:
+        number, period, reading_id = session.exec(
+            select(UsageReading.consumer_number, UsageReading.period, UsageReading.id)
+            .order_by(UsageReading.consumer_number, UsageReading.period.desc())
+        ).first()
+        typical = session.exec(select(func.avg(UsageReading.usage)).where(UsageReading.consumer_number == number)).one()
+        _ingest_reading(session, number, period, typical * 50)
+        assert session.exec(select(UsageReading.id).where(UsageReading.consumer_number == number,
+                                                          UsageReading.period == period)).one() == reading_id
+    spiked = detect(engine, workers=1)
+    assert spiked["mode"] == "incremental" and spiked["consumers"] == 1
+    with Session(engine) as session:
+        assert session.exec(select(DetectedAlert.kind).where(DetectedAlert.consumer_number == number,
+                                                             DetectedAlert.period == period)).one() == "spike"
+        assert _alerts(session) == before
+        ingested = dict((p, a) for n, p, a in before if n == number).get(period, 0)
+
+    # Shown in the consumer's alert history on top of the ingested count
+    history = client.get(f"/users/number/{number}").json()["alert_history"]
+    [entry] = [e for e in history if e["period"] == period]
+    assert entry["detected"] == "spike" and entry["alerts"] == ingested + 1
+    # The incrementally adjusted dashboard matches a full rebuild
+    with Session(engine) as session:
+        stats = dashboard_stats(session)
+        rebuild_rollups(session)
+        assert dashboard_stats(session) == stats
+
+        _ingest_reading(session, number, period, typical)
+    detect(engine, workers=1)
+    with Session(engine) as session:
+        assert session.exec(select(DetectedAlert).where(DetectedAlert.consumer_number == number,
+                                                        DetectedAlert.period == period)).first() is None
+    history = client.get(f"/users/number/{number}").json()["alert_history"]
+    assert all(e["detected"] is None for e in history if e["period"] == period)
@@ -0,0 +1,78 @@
+from jose import jwt
+from sqlmodel import Session
+
+import database
+import main
+from models import UserTokenVersion
+
+
+def test_register_login_and_change_password(client):
+    body = {"username": "auth_user", "email": "auth_user@example.com", "password": "first-pass"}
+    assert client.post("/auth/register", json=body).status_code == 200
+    assert client.post("/auth/register", json=body).status_code == 400
+
+    login = client.post("/auth/login", data={"username": "auth_user", "password": "first-pass"})
+    assert login.status_code == 200
+    headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+    assert client.put("/users/me/password", params={"password": "second-pass"}, headers=headers).status_code == 200
+
+    assert client.post("/auth/login", data={"username": "auth_user", "password": "first-pass"}).status_code == 400
+    assert client.post("/auth/login", data={"username": "auth_user", "password": "second-pass"}).status_code == 200
+
+
+def test_create_admin_adds_membership_and_counters(client, admin_headers):
+    before = client.get("/admin/metrics").json()
+    body = {"username": "new_analyst", "email": "new_analyst@example.com", "password": "pw", "status": "Analyst"}
+    response = client.post("/admin/", json=body, headers=admin_headers)
+    assert response.status_code == 200
+    user_id = response.json()["id"]
+    assert client.get(f"/user-permissions/{user_id}", headers=admin_headers).json()
+    assert client.get("/admin/metrics").json()["analysts"] == before["analysts"] + 1
+
+
+def test_create_admin_requires_super_admin(client):
+    body = {"username": "plain_user", "email": "plain_user@example.com", "password": "pw"}
+    client.post("/auth/register", json=body)
+    token = client.post("/auth/login", data={"username": "plain_user", "password": "pw"}).json()["access_token"]
+    response = client.post("/admin/", json={**body, "username": "x", "email": "x@example.com"}, headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 403
+
+
+def test_stateless_tokens_follow_role_template_edits(client, admin_headers, seeded, monkeypatch):
+    monkeypatch.setattr(main, "STATELESS_TOKENS", True)
+    role, perms = seeded["analyst_role"], seeded["analyst_perms"]
+    body = {"username": "stateless_user", "email": "stateless_user@example.com", "password": "pw"}
+    user_id = client.post("/auth/register", json=body).json()["id"]
+    grant = {"user_id": user_id, "role_id": role, "permission_ids": perms}
+    assert client.post("/user-role-permissions", json=grant, headers=admin_headers).status_code == 200
+
+    token = client.post("/auth/login", data={"username": "stateless_user", "password": "pw"}).json()["access_token"]
+    claims = jwt.get_unverified_claims(token)
+    assert claims["uid"] == user_id and "ver" in claims
+    assert "perms" not in claims and "roles" not in claims
+
+    # A template edit does not bump token versions, so the same token must see it
+    headers = {"Authorization": f"Bearer {token}"}
+    before = client.get("/me/permissions", headers=headers).json()
+    assert before["roles"] == ["Analyst"] and before["permissions"]
+    original = [p["id"] for p in client.get(f"/roles/{role}/permissions", headers=admin_headers).json()]
+    assert client.put(f"/roles/{role}/permissions", json=[], headers=admin_headers).status_code == 200
+    try:
+        after = client.get("/me/permissions", headers=headers)
+        assert after.status_code == 200 and after.json()["permissions"] == []
+    finally:
+        assert client.put(f"/roles/{role}/permissions", json=original, headers=admin_headers).status_code == 200
+
+
+def test_update_admin_saves_and_revokes_tokens(client, admin_headers):
+    body = {"username": "edited_admin", "email": "edited_admin@example.com", "password": "pw", "status": "Admin"}
+    admin_id = client.post("/admin/", json=body, headers=admin_headers).json()["id"]
+    with Session(database.engine) as session:
+        before = session.get(UserTokenVersion, admin_id)
+        before = before.version if before else 0
+
+    response = client.put(f"/admin/{admin_id}", json={**body, "full_name": "Edited Admin", "status": "Inactive"}, headers=admin_headers)
+    assert response.status_code == 200
+    assert response.json()["full_name"] == "Edited Admin" and response.json()["status"] == "Inactive"
+    with Session(database.engine) as session:
+        assert session.get(UserTokenVersion, admin_id).version == before + 1
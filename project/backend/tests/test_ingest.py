@@ -0,0 +1,52 @@
+import codecs
+import io
+
+import pytest
+from sqlmodel import Session, select
+
+import database
+from ingest import IngestError, ingest, iter_records
+from models import UserAnalytics
+
+HEADER = "number,name,email,status,region,segment,phase,createdAt\n"
+
+
+def _consumer(number, created="2020-01-15", status="Active"):
+    return f"{number},Consumer {number},c{number}@example.com,{status},North,Residential,Single,{created}\n"
+
+
+def test_byte_order_mark_does_not_break_the_header():
+    data = codecs.BOM_UTF8 + (HEADER + _consumer(1)).encode()
+    [(line_num, record)] = list(iter_records(io.BytesIO(data), "csv"))
+    assert line_num == 2 and record["number"] == "1"
+
+
+def test_invalid_bytes_report_their_line():
+    data = (HEADER + _consumer(1) + _consumer(2)).encode() + b"3,Bad \xff name,x@example.com,Active,North,Residential,Single,2020-01-01\n"
+    with pytest.raises(IngestError, match="Line 4"):
+        list(iter_records(io.BytesIO(data), "csv"))
+    with pytest.raises(IngestError, match="Line 2"):
+        list(iter_records(io.BytesIO(b'{"number": 1}\n{"name": "\xe9"}\n'), "ndjson"))
+
+
+def test_malformed_csv_is_an_ingest_error():
+    # Past the csv module's field size limit
+    with pytest.raises(IngestError, match="Line 3"):
+        list(iter_records(io.BytesIO((HEADER + _consumer(1) + "2," + "x" * 200_000 + "\n").encode()), "csv"))
+
+
+def test_reingest_keeps_creation_date(seeded):
+    with Session(database.engine) as session:
+        ingest(session, io.BytesIO((HEADER + _consumer(900001)).encode()), "consumers", "csv")
+        ingest(session, io.BytesIO((HEADER + _consumer(900001, "2024-06-01", "Inactive")).encode()), "consumers", "csv")
+        session.expire_all()
+        record = session.exec(select(UserAnalytics).where(UserAnalytics.number == 900001)).one()
+        assert record.status == "Inactive"
+        assert record.createdAt == "2020-01-15"
+
+
+def test_upload_with_invalid_bytes_is_rejected(client, admin_headers):
+    data = (HEADER + _consumer(900002)).encode() + b"\xff\xfe\n"
+    response = client.post("/ingest", params={"kind": "consumers"}, files={"file": ("bad.csv", data)}, headers=admin_headers)
+    assert response.status_code == 400
+    assert "Line 3" in response.json()["detail"]
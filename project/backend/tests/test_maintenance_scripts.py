@@ -0,0 +1,69 @@
+import json
+import os
+import runpy
+
+from sqlmodel import Session, select
+
+import database
+from analytics import analytics_cache
+from generate_data import generate
+from ingest import main as ingest_main
+from invalidation import InvalidationBus
+from models import CacheEvent, UsageReading, User, UserTokenVersion
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _events_since(session, last_id):
+    return [json.loads(payload) for payload in
+            session.exec(select(CacheEvent.payload).where(CacheEvent.id > last_id).order_by(CacheEvent.id)).all()]
+
+
+def _token_version(session, user_id):
+    row = session.get(UserTokenVersion, user_id)
+    return row.version if row else 0
+
+
+def test_grant_scripts_publish_and_revoke_tokens(seeded):
+    with Session(database.engine) as session:
+        last_id = session.exec(select(CacheEvent.id).order_by(CacheEvent.id.desc())).first() or 0
+
+    runpy.run_path(os.path.join(BACKEND, "add_admin.py"))
+    with Session(database.engine) as session:
+        abhi = session.exec(select(User.id).where(User.username == "abhi")).one()
+        events = _events_since(session, last_id)
+        assert any(abhi in e.get("users", ()) and "user" in e["tables"] and "userrole" not in e["tables"] for e in events)
+        assert any(abhi in e.get("users", ()) and "userrole" in e["tables"] for e in events)
+        version = _token_version(session, abhi)
+        last_id = session.exec(select(CacheEvent.id).order_by(CacheEvent.id.desc())).first()
+    assert version >= 1
+
+    runpy.run_path(os.path.join(BACKEND, "print_user_permissions.py"))
+    with Session(database.engine) as session:
+        assert any(abhi in e.get("users", ()) for e in _events_since(session, last_id))
+        assert _token_version(session, abhi) == version + 1
+
+
+def test_ingest_cli_correction_reaches_other_workers(seeded, tmp_path):
+    worker = InvalidationBus(database.engine, enabled=True)
+    worker.seek_end()
+    with Session(database.engine) as session:
+        number, period = session.exec(select(UsageReading.consumer_number, UsageReading.period)).first()
+        before = analytics_cache.data_version(session)
+    path = tmp_path / "correction.csv"
+    path.write_text(f"number,period,usage\n{number},{period},12345\n")
+
+    ingest_main(["readings", str(path)])
+    # Same reading id, so only the event tells the worker its cube is stale
+    assert worker.poll() >= 1
+    with Session(database.engine) as session:
+        assert analytics_cache.data_version(session) != before
+
+
+def test_generated_rows_are_published(seeded):
+    with Session(database.engine) as session:
+        last_id = session.exec(select(CacheEvent.id).order_by(CacheEvent.id.desc())).first() or 0
+    generate(database.engine, users=2, consumers=2, months=3)
+    with Session(database.engine) as session:
+        tables = {t for e in _events_since(session, last_id) for t in e.get("tables", ())}
+    assert {"user", "useranalytics", "usagereading"} <= tables
@@ -0,0 +1,87 @@
+import random
+
+import pytest
+from sqlmodel import Session, func, select
+
+import database
+from analytics import analytics_cache, fetch_array
+from generate_data import generate
+from models import Permission, Role, UsageReading, User
+from query_budget import count_queries, instrument_engine, query_budget, QueryBudgetExceeded
+from schemas import BULK_ASSIGN_MAX
+
+# The suite runs with QUERY_BUDGET=raise, so each request below fails the test if
+# it goes over its endpoint's budget. These are the paths with the most writes.
+
+# The app instruments the engine at startup; these also run without it
+instrument_engine(database.engine)
+
+
+def test_fetch_array_is_counted(seeded):
+    with Session(database.engine) as session, count_queries() as counter:
+        rows = fetch_array(session, select(UsageReading.consumer_number, UsageReading.usage), 2)
+    assert len(rows) and counter.count == 1
+
+
+def test_query_budget_raises():
+    with Session(database.engine) as session:
+        with pytest.raises(QueryBudgetExceeded):
+            with query_budget(1):
+                session.exec(select(Role)).all()
+                session.exec(select(Permission)).all()
+
+
+def test_analytics_with_a_cold_cube(client, admin_headers):
+    for path in ("/analytics/trends", "/analytics/distribution", "/analytics/growth"):
+        analytics_cache.clear()
+        assert client.get(path, headers=admin_headers).status_code == 200
+
+
+def test_role_template_edits(client, admin_headers, seeded):
+    role = seeded["analyst_role"]
+    with Session(database.engine) as session:
+        permission_ids = session.exec(select(Permission.id)).all()
+    original = client.get(f"/roles/{role}/permissions", headers=admin_headers).json()
+    # Adds and removes in one request, over lists of every length
+    for size in (len(permission_ids), 1, 3, 0):
+        response = client.put(f"/roles/{role}/permissions", json=permission_ids[:size], headers=admin_headers)
+        assert response.status_code == 200
+    restore = [p["id"] for p in original]
+    assert client.put(f"/roles/{role}/permissions", json=restore, headers=admin_headers).status_code == 200
+
+
+def test_assignments(client, admin_headers, seeded):
+    rng = random.Random(3)
+    role, perms = seeded["analyst_role"], seeded["analyst_perms"]
+    users = seeded["user_ids"][-40:]
+    for user_id in users[:20]:
+        body = {"user_id": user_id, "role_id": role, "permission_ids": rng.sample(perms, rng.randint(0, len(perms)))}
+        assert client.post("/user-role-permissions", json=body, headers=admin_headers).status_code == 200
+    for _ in range(3):
+        body = {"assignments": [{"user_id": user_id, "role_id": role, "permission_ids": rng.sample(perms, rng.randint(0, len(perms)))}
+                                for user_id in users]}
+        assert client.post("/user-role-permissions/bulk", json=body, headers=admin_headers).status_code == 200
+
+
+def test_catalog_writes(client, admin_headers):
+    assert client.post("/roles", json={"name": "Budget Role"}, headers=admin_headers).status_code == 200
+    assert client.post("/permissions", json={"view_name": "budget_view"}, headers=admin_headers).status_code == 200
+
+
+def test_bulk_assignments_at_the_size_limit(client, admin_headers, seeded):
+    with Session(database.engine) as session:
+        first = session.exec(select(func.max(User.id))).one() + 1
+    generate(database.engine, users=BULK_ASSIGN_MAX)
+    with Session(database.engine) as session:
+        users = session.exec(select(User.id).where(User.id >= first).order_by(User.id)).all()
+        role = session.exec(select(Role.id).where(Role.name == "Admin")).one()
+    template = [p["id"] for p in client.get(f"/roles/{role}/permissions", headers=admin_headers).json()]
+    # Keeping one template permission writes a revocation for each of the others;
+    # leaving the role then deletes all of them again
+    for perms in (template[:1], []):
+        body = {"assignments": [{"user_id": user_id, "role_id": role, "permission_ids": perms} for user_id in users]}
+        response = client.post("/user-role-permissions/bulk", json=body, headers=admin_headers)
+        assert response.status_code == 200 and response.json()["changed"] == BULK_ASSIGN_MAX
+
+    body["assignments"].append({**body["assignments"][0], "role_id": seeded["analyst_role"]})
+    assert client.post("/user-role-permissions/bulk", json=body, headers=admin_headers).status_code == 422
@@ -0,0 +1,51 @@
+from starlette.requests import Request
+
+from cache import ResponseCache, TableVersions, etag_matches
+
+
+def make_request(path="/roles", if_none_match=None):
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": path, "query_string": b"", "headers": headers})
+
+
+def test_etag_differs_across_restarts():
+    # A restarted process starts its counters at 0 again, like a fresh instance
+    before = ResponseCache(TableVersions()).lookup(make_request(), ["role"])
+    after = ResponseCache(TableVersions()).lookup(make_request(), ["role"])
+    assert before.etag != after.etag
+
+
+def test_restarted_process_does_not_answer_old_etag_with_304():
+    old = ResponseCache(TableVersions()).lookup(make_request(), ["role"])
+    fresh = ResponseCache(TableVersions())
+    lookup = fresh.lookup(make_request(if_none_match=old.etag), ["role"])
+    assert lookup.response is None
+
+
+def test_reset_invalidates_existing_etags():
+    versions = TableVersions()
+    cache = ResponseCache(versions)
+    first = cache.lookup(make_request(), ["role"])
+    cache.store(first, [])
+    versions.reset()
+    lookup = cache.lookup(make_request(if_none_match=first.etag), ["role"])
+    assert lookup.response is None
+    assert lookup.etag != first.etag
+
+
+def test_if_none_match_compares_whole_tags():
+    etag = 'W/"abc123"'
+    assert etag_matches('W/"abc123"', etag)
+    assert etag_matches('"other", W/"abc123"', etag)
+    assert etag_matches('"abc123"', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('W/"abc1234"', etag)
+    assert not etag_matches('W/"xabc123"', etag)
+    assert not etag_matches(None, etag)
+
+
+def test_matching_etag_returns_304(client, admin_headers):
+    first = client.get("/roles", headers=admin_headers)
+    assert first.status_code == 200
+    again = client.get("/roles", headers={**admin_headers, "If-None-Match": first.headers["etag"]})
+    assert again.status_code == 304
@@ -0,0 +1,31 @@
+from sqlmodel import Session, select
+
+import database
+from models import Permission, Role, RolePermission, UserRole, UserRolePermission
+from role_templates import PLACEHOLDER_USER_ID, migrate_grants
+
+
+def test_placeholder_grants_become_templates_not_memberships(seeded):
+    user_id = seeded["user_ids"][-1]
+    with Session(database.engine) as session:
+        role = Role(name="Legacy-Role")
+        session.add(role)
+        session.commit()
+        first, second = session.exec(select(Permission.id).order_by(Permission.id)).all()[:2]
+        # As written by the old init script, plus one real user's grant
+        session.add_all([
+            UserRolePermission(user_id=PLACEHOLDER_USER_ID, role_id=role.id, permission_id=first),
+            UserRolePermission(user_id=PLACEHOLDER_USER_ID, role_id=role.id, permission_id=second),
+            UserRolePermission(user_id=user_id, role_id=role.id, permission_id=first),
+        ])
+        session.commit()
+
+        assert migrate_grants(session) == 1
+        members = session.exec(select(UserRole.user_id).where(UserRole.role_id == role.id)).all()
+        assert members == [user_id]
+        template = session.exec(select(RolePermission.permission_id).where(RolePermission.role_id == role.id)).all()
+        assert sorted(template) == sorted([first, second])
+        # The real user keeps exactly what they had: the template less a revocation
+        rows = session.exec(select(UserRolePermission.user_id, UserRolePermission.permission_id, UserRolePermission.granted)
+                            .where(UserRolePermission.role_id == role.id)).all()
+        assert rows == [(user_id, second, False)]
@@ -0,0 +1,50 @@
+import asyncio
+import threading
+
+import pytest
+
+import database
+import main
+from throttle import LOGIN_USER_BURST, LoginThrottle, SharedTokenBuckets, TokenBuckets
+
+
+def test_eviction_keeps_recently_used_keys():
+    buckets = TokenBuckets(burst=1, per_minute=1, max_keys=4)
+    for key in "abcd":
+        assert buckets.take(key, 0.0) == 0
+    # "a" is the oldest entry but was just used, so "b" and "c" go first
+    assert buckets.take("a", 1.0) > 0
+    assert buckets.take("e", 1.0) == 0
+    assert len(buckets) == 3
+    assert buckets.take("a", 1.0) > 0
+    assert buckets.take("b", 1.0) == 0
+
+
+@pytest.mark.parametrize("mode", ["memory", "db"])
+def test_login_is_throttled_per_username(client, monkeypatch, mode):
+    monkeypatch.setattr(main, "login_throttle", LoginThrottle(mode, engine=database.engine))
+    form = {"username": f"throttled_{mode}", "password": "wrong"}
+    for _ in range(LOGIN_USER_BURST):
+        assert client.post("/auth/login", data=form).status_code == 400
+    response = client.post("/auth/login", data=form)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_shared_buckets_stay_off_the_event_loop(seeded, monkeypatch):
+    threads = []
+    take = SharedTokenBuckets.take
+
+    def recording_take(self, key, now):
+        threads.append(threading.current_thread())
+        return take(self, key, now)
+
+    monkeypatch.setattr(SharedTokenBuckets, "take", recording_take)
+    throttle = LoginThrottle("db", engine=database.engine)
+
+    async def attempt():
+        return await throttle.acheck("10.0.0.1", "off_loop_user"), threading.current_thread()
+
+    wait, loop_thread = asyncio.run(attempt())
+    assert wait is None
+    assert threads and all(thread is not loop_thread for thread in threads)
@@ -0,0 +1,12 @@
+def test_users_pages_follow_the_cursor(client):
+    origin = {"Origin": "http://localhost:5173"}
+    everyone = client.get("/users", params={"limit": 1000}).json()
+    seen, after_id = [], 0
+    while after_id is not None:
+        response = client.get("/users", params={"limit": 7, "after_id": after_id}, headers=origin)
+        assert response.status_code == 200
+        exposed = response.headers["access-control-expose-headers"]
+        assert "X-Next-After-Id" in exposed and "ETag" in exposed
+        seen.extend(user["id"] for user in response.json())
+        after_id = response.headers.get("x-next-after-id")
+    assert seen == [user["id"] for user in everyone]
@@ -0,0 +1,239 @@
+import math
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional, Tuple
+
+from sqlalchemy import case, delete, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from starlette.concurrency import run_in_threadpool
+
+from metrics import LOGIN_THROTTLED
+from models import ThrottleBucket
+
+# Login throttling: token buckets per client IP and per username, checked before
+# the user lookup and bcrypt so a credential-stuffing burst costs a dict lookup
+# per attempt. A bucket holds up to BURST attempts and refills at PER_MINUTE;
+# a successful login refills the username's bucket. With LOGIN_THROTTLE=db a
+# ThrottleBucket row enforces each limit across workers (in the app database or
+# LOGIN_THROTTLE_DB_URL); the in-process IP buckets still reject first, which is
+# safe because a worker's own bucket never holds fewer tokens than the shared one.
+#   LOGIN_THROTTLE=off | memory | db   (default memory)
+#   LOGIN_IP_BURST=20  LOGIN_IP_PER_MINUTE=10
+#   LOGIN_USER_BURST=5  LOGIN_USER_PER_MINUTE=1
+#   LOGIN_THROTTLE_MAX_KEYS=100000  LOGIN_TRUST_FORWARDED=0
+
+LOGIN_THROTTLE = os.getenv("LOGIN_THROTTLE", "memory").lower()
+LOGIN_IP_BURST = int(os.getenv("LOGIN_IP_BURST", "20"))
+LOGIN_IP_PER_MINUTE = float(os.getenv("LOGIN_IP_PER_MINUTE", "10"))
+LOGIN_USER_BURST = int(os.getenv("LOGIN_USER_BURST", "5"))
+LOGIN_USER_PER_MINUTE = float(os.getenv("LOGIN_USER_PER_MINUTE", "1"))
+LOGIN_THROTTLE_MAX_KEYS = int(os.getenv("LOGIN_THROTTLE_MAX_KEYS", "100000"))
+LOGIN_THROTTLE_DB_URL = os.getenv("LOGIN_THROTTLE_DB_URL")
+# Only behind a proxy that sets X-Forwarded-For; otherwise clients choose their key
+LOGIN_TRUST_FORWARDED = os.getenv("LOGIN_TRUST_FORWARDED", "0").lower() in ("1", "true", "yes")
+MAX_KEY_LENGTH = 128
+
+
+class TokenBuckets:
+    def __init__(self, burst: int, per_minute: float, max_keys: int = LOGIN_THROTTLE_MAX_KEYS):
+        self.burst = float(burst)
+        self.rate = per_minute / 60
+        # An untouched bucket is full again after this long, the same as no entry
+        self.ttl = self.burst / self.rate
+        self.max_keys = max_keys
+        self._lock = Lock()
+        # key -> (tokens, time of last update), least recently used first
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def _level(self, entry: Tuple[float, float], now: float) -> float:
+        return min(self.burst, entry[0] + (now - entry[1]) * self.rate)
+
+    # Takes one token; returns 0 when allowed, otherwise seconds until the next one
+    def take(self, key: str, now: float) -> float:
+        with self._lock:
+            entry = self._buckets.get(key)
+            if entry:
+                # Rejected attempts count as use too: a key under attack stays tracked
+                self._buckets.move_to_end(key)
+            tokens = self._level(entry, now) if entry else self.burst
+            if tokens < 1:
+                return (1 - tokens) / self.rate
+            self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self.max_keys:
+                self._evict(now)
+        return 0.0
+
+    def reset(self, key: str):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def prune(self, now: float) -> int:
+        with self._lock:
+            full = [key for key, entry in self._buckets.items() if self._level(entry, now) >= self.burst]
+            for key in full:
+                del self._buckets[key]
+        return len(full)
+
+    # Over the key limit (e.g. a spray from many addresses): drop full buckets,
+    # then the least recently used half if that was not enough
+    def _evict(self, now: float):
+        for key in [key for key, entry in self._buckets.items() if self._level(entry, now) >= self.burst]:
+            del self._buckets[key]
+        if len(self._buckets) > self.max_keys:
+            for _ in range(len(self._buckets) // 2):
+                self._buckets.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+# The same buckets as ThrottleBucket rows. Creating, refilling and taking happen
+# in one conditional upsert, so concurrent workers cannot both spend the last token.
+class SharedTokenBuckets:
+    def __init__(self, engine, burst: int, per_minute: float, prefix: str):
+        self.engine = engine
+        self.burst = float(burst)
+        self.rate = per_minute / 60
+        self.ttl = self.burst / self.rate
+        self.prefix = prefix
+
+    def _level(self, now: float):
+        refilled = ThrottleBucket.tokens + (now - ThrottleBucket.updated) * self.rate
+        return case((refilled > self.burst, self.burst), else_=refilled)
+
+    def take(self, key: str, now: float) -> float:
+        key = self.prefix + key
+        level = self._level(now)
+        insert_fn = pg_insert if self.engine.dialect.name == "postgresql" else sqlite_insert
+        stmt = insert_fn(ThrottleBucket).values(key=key, tokens=self.burst - 1, updated=now).on_conflict_do_update(
+            index_elements=["key"], set_={"tokens": level - 1, "updated": now}, where=level >= 1
+        )
+        with self.engine.begin() as conn:
+            if conn.execute(stmt).rowcount:
+                return 0.0
+            tokens = conn.execute(select(level).where(ThrottleBucket.key == key)).scalar()
+        return (1 - (tokens or 0)) / self.rate
+
+    def reset(self, key: str):
+        with self.engine.begin() as conn:
+            conn.execute(delete(ThrottleBucket).where(ThrottleBucket.key == self.prefix + key))
+
+    def prune(self, now: float) -> int:
+        with self.engine.begin() as conn:
+            return conn.execute(
+                delete(ThrottleBucket).where(ThrottleBucket.key.startswith(self.prefix), ThrottleBucket.updated < now - self.ttl)
+            ).rowcount
+
+
+def client_ip(request) -> str:
+    if LOGIN_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+def _user_key(username: str) -> str:
+    return username.strip().lower()[:MAX_KEY_LENGTH]
+
+
+class LoginThrottle:
+    def __init__(self, mode: str = LOGIN_THROTTLE, engine=None):
+        self.mode = mode
+        self.ip = TokenBuckets(LOGIN_IP_BURST, LOGIN_IP_PER_MINUTE)
+        self.user = TokenBuckets(LOGIN_USER_BURST, LOGIN_USER_PER_MINUTE)
+        self.shared_ip: Optional[SharedTokenBuckets] = None
+        self.shared_user: Optional[SharedTokenBuckets] = None
+        if mode == "db":
+            engine = engine or _shared_engine()
+            self.shared_ip = SharedTokenBuckets(engine, LOGIN_IP_BURST, LOGIN_IP_PER_MINUTE, "ip:")
+            self.shared_user = SharedTokenBuckets(engine, LOGIN_USER_BURST, LOGIN_USER_PER_MINUTE, "user:")
+        self.allowed = 0
+        self.rejected = {"ip": 0, "user": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ("memory", "db")
+
+    def _reject(self, scope: str, wait: float) -> float:
+        self.rejected[scope] += 1
+        LOGIN_THROTTLED.inc((scope,))
+        return max(wait, 1.0)
+
+    # Returns None when the attempt may proceed, otherwise the seconds to wait.
+    # A rejected IP does not spend the username's tokens.
+    def check(self, ip: str, username: str) -> Optional[float]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        user = _user_key(username)
+        wait = self.ip.take(ip, now) or (self.shared_ip and self.shared_ip.take(ip, now))
+        if wait:
+            return self._reject("ip", wait)
+        # Shared username buckets are not mirrored locally: a success in another
+        # worker resets the row, and a stale local bucket would still reject
+        wait = self.shared_user.take(user, now) if self.shared_user else self.user.take(user, now)
+        if wait:
+            return self._reject("user", wait)
+        self.allowed += 1
+        return None
+
+    def succeeded(self, username: str):
+        if not self.enabled:
+            return
+        user = _user_key(username)
+        if self.shared_user:
+            self.shared_user.reset(user)
+        else:
+            self.user.reset(user)
+
+    # For async handlers: the shared buckets are a database round trip, so they
+    # run in the threadpool instead of blocking the event loop
+    async def acheck(self, ip: str, username: str) -> Optional[float]:
+        if self.shared_user is None:
+            return self.check(ip, username)
+        return await run_in_threadpool(self.check, ip, username)
+
+    async def asucceeded(self, username: str):
+        if self.shared_user is None:
+            self.succeeded(username)
+        else:
+            await run_in_threadpool(self.succeeded, username)
+
+    def prune(self) -> int:
+        now = time.time()
+        pruned = self.ip.prune(now) + self.user.prune(now)
+        if self.shared_ip:
+            pruned += self.shared_ip.prune(now) + self.shared_user.prune(now)
+        return pruned
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "allowed": self.allowed,
+            "rejected_ip": self.rejected["ip"],
+            "rejected_user": self.rejected["user"],
+            "tracked_ips": len(self.ip),
+            "tracked_users": len(self.user),
+            "ip_limit": {"burst": LOGIN_IP_BURST, "per_minute": LOGIN_IP_PER_MINUTE},
+            "user_limit": {"burst": LOGIN_USER_BURST, "per_minute": LOGIN_USER_PER_MINUTE},
+        }
+
+
+def retry_after(wait: float) -> str:
+    return str(math.ceil(wait))
+
+
+def _shared_engine():
+    from database import engine, make_engine
+    if not LOGIN_THROTTLE_DB_URL:
+        return engine
+    shared = make_engine(LOGIN_THROTTLE_DB_URL)
+    ThrottleBucket.__table__.create(shared, checkfirst=True)
+    return shared
+
+
+login_throttle = LoginThrottle()
@@ -0,0 +1,141 @@
+import calendar
+import json
+from typing import Dict, List, Optional
+
+from sqlalchemy import delete, insert, or_
+from sqlmodel import Session, select
+
+from models import UserAnalytics, UsageReading, PaymentRecord, AlertRecord, DetectedAlert, ActivityEvent
+from serialization import dumps
+
+MONTH_NUMBERS = {calendar.month_abbr[i].lower(): i for i in range(1, 13)}
+SERIES_MODELS = [UsageReading, PaymentRecord, AlertRecord, ActivityEvent]
+BLOB_COLUMNS = ["usage_history", "payment_history", "alert_history", "recent_activity"]
+
+
+# "Jan" -> "2024-01"; values that already look like "YYYY-MM..." keep their month
+def to_period(month, year: str) -> str:
+    month = str(month)
+    if len(month) >= 7 and month[4] == "-":
+        return month[:7]
+    number = MONTH_NUMBERS.get(month[:3].lower())
+    if number is None:
+        return month
+    return f"{year}-{number:02d}"
+
+
+MONTH_LABELS = {f"{i:02d}": calendar.month_abbr[i] for i in range(1, 13)}
+
+
+def period_label(period: str) -> str:
+    return MONTH_LABELS.get(period[5:7], period)
+
+
+def _load(blob: Optional[str]) -> list:
+    return json.loads(blob) if blob else []
+
+
+# Rows for each series table from one UserAnalytics record's JSON columns
+def explode_analytics(analytics: UserAnalytics) -> Dict[type, List[dict]]:
+    number = analytics.number
+    year = (analytics.createdAt or "")[:4] or "1970"
+    usage = {to_period(e["month"], year): float(e["usage"]) for e in _load(analytics.usage_history)}
+    payments = {to_period(e["month"], year): int(e["paid"]) for e in _load(analytics.payment_history)}
+    alerts = {to_period(e["month"], year): int(e["alerts"]) for e in _load(analytics.alert_history)}
+    activity = []
+    for entry in _load(analytics.recent_activity):
+        period, _, description = str(entry).partition(": ")
+        activity.append({"consumer_number": number, "period": period, "description": description})
+    return {
+        UsageReading: [{"consumer_number": number, "period": p, "usage": v} for p, v in usage.items()],
+        PaymentRecord: [{"consumer_number": number, "period": p, "paid": v} for p, v in payments.items()],
+        AlertRecord: [{"consumer_number": number, "period": p, "alerts": v} for p, v in alerts.items()],
+        ActivityEvent: activity,
+    }
+
+
+# One-shot move of the JSON columns into the series tables. Migrated records keep
+# "[]" in their JSON columns, so re-running only picks up records written since.
+def migrate_blobs(session: Session, batch_size: int = 1000) -> int:
+    pending = or_(*[getattr(UserAnalytics, c).notin_(["", "[]"]) for c in BLOB_COLUMNS])
+    migrated = 0
+    while True:
+        batch = session.exec(select(UserAnalytics).where(pending).limit(batch_size)).all()
+        if not batch:
+            break
+        numbers = [a.number for a in batch]
+        rows: Dict[type, List[dict]] = {model: [] for model in SERIES_MODELS}
+        for analytics in batch:
+            for model, model_rows in explode_analytics(analytics).items():
+                rows[model].extend(model_rows)
+            for column in BLOB_COLUMNS:
+                setattr(analytics, column, "[]")
+            session.add(analytics)
+        for model in SERIES_MODELS:
+            session.execute(delete(model).where(model.consumer_number.in_(numbers)))
+            if rows[model]:
+                session.execute(insert(model), rows[model])
+        session.commit()
+        migrated += len(batch)
+    return migrated
+
+
+def _monthly(session: Session, model, value_column, number: int, months: Optional[int]) -> list:
+    query = select(model.period, value_column).where(model.consumer_number == number).order_by(model.period.desc())
+    if months:
+        query = query.limit(months)
+    return list(reversed(session.execute(query).all()))
+
+
+# Ingested alert counts plus one for each month alert_detection.py flagged,
+# whose kind is reported as "detected"
+def _alerts(session: Session, number: int, months: Optional[int]) -> list:
+    ingested = dict(_monthly(session, AlertRecord, AlertRecord.alerts, number, months))
+    detected = dict(_monthly(session, DetectedAlert, DetectedAlert.kind, number, months))
+    periods = sorted(ingested.keys() | detected.keys())
+    if months:
+        periods = periods[-months:]
+    return [(p, ingested.get(p, 0) + (p in detected), detected.get(p)) for p in periods]
+
+
+# History section of the consumer detail response. With months set, only the
+# latest N monthly rows (and activity since the first of them) are read.
+def consumer_history(session: Session, number: int, months: Optional[int] = None) -> dict:
+    usage = _monthly(session, UsageReading, UsageReading.usage, number, months)
+    payments = _monthly(session, PaymentRecord, PaymentRecord.paid, number, months)
+    alerts = _alerts(session, number, months)
+    activity_query = (
+        select(ActivityEvent.period, ActivityEvent.description)
+        .where(ActivityEvent.consumer_number == number)
+        .order_by(ActivityEvent.period.desc(), ActivityEvent.id)
+    )
+    if months and usage:
+        activity_query = activity_query.where(ActivityEvent.period >= usage[0][0])
+    return {
+        "usage_history": [{"month": period_label(p), "period": p, "usage": v} for p, v in usage],
+        "payment_history": [{"month": period_label(p), "period": p, "paid": v} for p, v in payments],
+        "alert_history": [{"month": period_label(p), "period": p, "alerts": v, "detected": k} for p, v, k in alerts],
+        "recent_activity": [f"{period}: {description}" for period, description in session.execute(activity_query).all()],
+    }
+
+
+# Encoded history arrays for the consumer detail response. Records whose JSON
+# columns were never migrated are passed through as stored, without decoding.
+def consumer_history_raw(session: Session, analytics: UserAnalytics, months: Optional[int] = None) -> Dict[str, bytes]:
+    blobs = {c: getattr(analytics, c) for c in BLOB_COLUMNS}
+    if not months and all(blob and blob != "[]" for blob in blobs.values()):
+        return {c: blob.encode() for c, blob in blobs.items()}
+    return {c: dumps(v) for c, v in consumer_history(session, analytics.number, months).items()}
+
+
+if __name__ == "__main__":
+    from database import engine
+    from sqlmodel import SQLModel
+    SQLModel.metadata.create_all(engine)
+    from invalidation import invalidation_bus
+    with Session(engine) as session:
+        migrated = migrate_blobs(session)
+        if migrated:
+            invalidation_bus.publish(session, tables=[UserAnalytics.__tablename__] + [m.__tablename__ for m in SERIES_MODELS])
+            session.commit()
+        print(f"Migrated {migrated} analytics records.")
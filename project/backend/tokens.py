@@ -0,0 +1,96 @@
+import os
+import time
+from threading import Lock
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import insert, update
+from sqlmodel import Session, select
+
+from models import UserTokenVersion
+
+TOKEN_VERSION_CACHE_TTL = float(os.getenv("TOKEN_VERSION_CACHE_TTL", "5"))
+
+
+# Per-user token version counters. Bumping a user's version revokes every
+# stateless token issued before the bump; lookups are cached for a few seconds.
+class TokenVersionCache:
+    def __init__(self, ttl: float = TOKEN_VERSION_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = Lock()
+        self._entries: Dict[int, Tuple[int, float]] = {}
+
+    def _cached(self, user_id: int) -> Optional[int]:
+        entry = self._entries.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+        return None
+
+    def _store(self, user_id: int, row: Optional[UserTokenVersion]) -> int:
+        version = row.version if row else 0
+        with self._lock:
+            self._entries[user_id] = (version, time.monotonic() + self.ttl)
+        return version
+
+    def get(self, session: Session, user_id: int) -> int:
+        version = self._cached(user_id)
+        if version is None:
+            version = self._store(user_id, session.get(UserTokenVersion, user_id))
+        return version
+
+    async def aget(self, session, user_id: int) -> int:
+        version = self._cached(user_id)
+        if version is None:
+            version = self._store(user_id, await session.get(UserTokenVersion, user_id))
+        return version
+
+    # Adds the bump to the caller's transaction; the caller commits
+    def bump(self, session: Session, user_id: int):
+        row = session.get(UserTokenVersion, user_id)
+        if row is None:
+            row = UserTokenVersion(user_id=user_id, version=0)
+        row.version += 1
+        session.add(row)
+        self.forget(user_id)
+
+    async def abump(self, session, user_id: int):
+        row = await session.get(UserTokenVersion, user_id)
+        if row is None:
+            row = UserTokenVersion(user_id=user_id, version=0)
+        row.version += 1
+        session.add(row)
+        self.forget(user_id)
+
+    # Set-based bump for many users at once, also inside the caller's transaction
+    def bump_many(self, session: Session, user_ids: Iterable[int]):
+        user_ids = sorted(set(user_ids))
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            session.execute(
+                update(UserTokenVersion).where(UserTokenVersion.user_id.in_(chunk)).values(version=UserTokenVersion.version + 1)
+            )
+            existing = set(session.exec(select(UserTokenVersion.user_id).where(UserTokenVersion.user_id.in_(chunk))).all())
+            missing = [{"user_id": uid, "version": 1} for uid in chunk if uid not in existing]
+            if missing:
+                session.execute(insert(UserTokenVersion), missing)
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def forget(self, user_id: int):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def prune(self) -> int:
+        now = time.monotonic()
+        with self._lock:
+            expired = [uid for uid, (_, expires) in self._entries.items() if expires <= now]
+            for user_id in expired:
+                del self._entries[user_id]
+        return len(expired)
+
+
+token_versions = TokenVersionCache()
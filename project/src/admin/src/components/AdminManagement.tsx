@@ -307,7 +307,7 @@ const AdminManagement: React.FC = () => {
   const fetchUsersRolesPermissions = async () => {
     try {
       const [usersRes, rolesRes, permsRes] = await Promise.all([
-        fetch(`${import.meta.env.VITE_API_BASE_URL}/users`).then(r => r.json()),
+        usersAPI.getAll(),
         fetch(`${import.meta.env.VITE_API_BASE_URL}/roles`).then(r => r.json()),
         fetch(`${import.meta.env.VITE_API_BASE_URL}/permissions`).then(r => r.json()),
       ]);
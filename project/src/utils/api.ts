@@ -94,10 +94,32 @@ export const dashboardAPI = {
   },
 };
 
+// Follows a keyset-paged list to the end: every full page carries the id to
+// continue after in X-Next-After-Id
+export const fetchAllPages = async <T>(
+  endpoint: string,
+  params: Record<string, string> = {},
+  pageSize: number = 1000
+): Promise<T[]> => {
+  const items: T[] = [];
+  let afterId: string | null = '0';
+  while (afterId !== null) {
+    const query = new URLSearchParams({ ...params, limit: String(pageSize), after_id: afterId });
+    const response = await fetch(`${API_BASE_URL}${endpoint}?${query}`);
+    if (!response.ok) {
+      const error = await response.json().catch(() => ({}));
+      throw new Error(error.detail || `HTTP error! status: ${response.status}`);
+    }
+    items.push(...(await response.json()));
+    afterId = response.headers.get('X-Next-After-Id');
+  }
+  return items;
+};
+
 // Users API calls
 export const usersAPI = {
-  getAll: async () => {
-    return apiRequest('/users');
+  getAll: async (params: Record<string, string> = {}) => {
+    return fetchAllPages('/users', params);
   },
 
   getById: async (id: string) => {